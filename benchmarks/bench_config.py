@@ -0,0 +1,76 @@
+"""Per file cost of reading config files
+
+Compares the previous pipeline (yaml parse to detect sops, Jinja render,
+yaml parse) with read_config_file, caches disabled.
+
+    python benchmarks/bench_config.py
+"""
+import os
+import pathlib
+import subprocess
+import tempfile
+import timeit
+
+import jinja2
+import yaml
+
+from cloudbender import cache
+from cloudbender.jinja import read_config_file
+
+PLAIN = """
+stackTags:
+  Project: bench
+parameters:
+{}
+""".format("".join("  Param{0}: value{0}\n".format(i) for i in range(50)))
+
+TEMPLATED = PLAIN + "  Owner: {{ ENV.USER | default('nobody') }}\n"
+
+
+def legacy_read_config_file(path, variables={}):
+    def _loader(path):
+        with open(path, "r") as f:
+            config_raw = f.read()
+        try:
+            data = yaml.safe_load(config_raw)
+        except yaml.constructor.ConstructorError:
+            return config_raw
+        if data and "sops" in data and "DISABLE_SOPS" not in os.environ:
+            result = subprocess.run(
+                ["sops", "--input-type", "yaml", "--output-type", "yaml", "--decrypt", "/dev/stdin"],
+                stdout=subprocess.PIPE,
+                input=config_raw.encode("utf-8"),
+                env=dict(os.environ, **{"AWS_SDK_LOAD_CONFIG": "1"}),
+                check=True,
+            )
+            return result.stdout.decode("utf-8")
+        return config_raw
+
+    jinja_variables = dict(variables, ENV=os.environ)
+    jenv = jinja2.Environment(
+        enable_async=True,
+        auto_reload=False,
+        loader=jinja2.FunctionLoader(_loader),
+        undefined=jinja2.StrictUndefined,
+        extensions=["jinja2.ext.loopcontrols"],
+    )
+    template = jenv.get_template(str(path))
+    return yaml.safe_load(template.render(jinja_variables)) or {}
+
+
+def main(number=200):
+    cache.enabled = False
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, content in [("plain", PLAIN), ("templated", TEMPLATED)]:
+            path = pathlib.Path(tmp) / "{}.yaml".format(name)
+            path.write_text(content)
+            assert legacy_read_config_file(path) == read_config_file(path)
+
+            for label, func in [("before", legacy_read_config_file), ("after", read_config_file)]:
+                t = timeit.timeit(lambda: func(path), number=number)
+                print("{:10} {:7} {:8.3f} ms/file".format(name, label, t / number * 1000))
+
+
+if __name__ == "__main__":
+    main()
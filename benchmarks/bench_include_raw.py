@@ -0,0 +1,103 @@
+"""Cost of include_raw_gz for large cloud-init bundles
+
+Compares the previous implementation (string concatenation, gzip per
+call) with include_raw_gz, both for the first stack including a bundle
+and for every further stack including the same bundle.
+
+    python benchmarks/bench_include_raw.py
+"""
+import base64
+import gzip
+import io
+import re
+import tempfile
+import timeit
+
+import jinja2
+import markupsafe
+
+from cloudbender import jinja
+from cloudbender.jinja import JinjaEnv
+
+SCRIPT = """#!/bin/sh
+## template: jinja
+# Install and configure node {0}
+
+set -e
+
+  # indented comment {0}
+echo "node {0}" >> /var/log/bootstrap.log
+#!/not/a/comment
+systemctl restart kubelet-{0}
+
+"""
+
+
+@jinja2.pass_context
+def legacy_include_raw_gz(context, files=None, gz=True, remove_comments=False):
+    jenv = context.environment
+    output = ""
+
+    for name in files:
+        output = output + \
+            markupsafe.Markup(jenv.loader.get_source(jenv, name)[0])
+
+    if remove_comments:
+        _re_comment = re.compile(r"^\s*#[^!]")
+        _re_blank = re.compile(r"^\s*$")
+        _re_keep = re.compile(r"^## template: jinja$")
+        stripped_output = ""
+        for curline in output.splitlines():
+            if re.match(_re_blank, curline):
+                continue
+            elif re.match(_re_keep, curline):
+                stripped_output = stripped_output + curline + "\n"
+            elif re.match(_re_comment, curline):
+                pass
+            else:
+                stripped_output = stripped_output + curline + "\n"
+
+        output = stripped_output
+
+    if not gz:
+        return output
+
+    buf = io.BytesIO()
+    f = gzip.GzipFile(mode="w", fileobj=buf, mtime=0)
+    f.write(output.encode())
+    f.close()
+    return base64.b64encode(buf.getvalue()).decode("utf-8")
+
+
+def main(number=20):
+    with tempfile.TemporaryDirectory() as tmp:
+        jenv = JinjaEnv([tmp])
+        for kb in [100, 300, 600]:
+            name = "bundle-{}.sh".format(kb)
+            script = ""
+            i = 0
+            while len(script) < kb * 1024:
+                script += SCRIPT.format(i)
+                i += 1
+            with open("{}/{}".format(tmp, name), "w") as f:
+                f.write(script)
+
+            args = ([name], True, True)
+            context = jenv.from_string("").new_context()
+            assert legacy_include_raw_gz(context, *args) == jinja.include_raw_gz(context, *args)
+
+            def first():
+                jinja._pack_raw.cache_clear()
+                jinja.include_raw_gz(context, *args)
+
+            for label, func in [
+                ("before", lambda: legacy_include_raw_gz(context, *args)),
+                ("first", first),
+                ("cached", lambda: jinja.include_raw_gz(context, *args)),
+            ]:
+                t = timeit.timeit(func, number=number)
+                print("{:4} KB {:7} {:8.3f} ms/stack".format(kb, label, t / number * 1000))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+"""Cost of post-processing a rendered 1 MB template
+
+Compares the previous post-processing (parse, edit the text, parse
+again, walk for references twice) with Stack._post_process.
+
+    python benchmarks/bench_post_process.py
+"""
+import hashlib
+import pathlib
+import re
+import timeit
+
+import yaml
+
+from cloudbender.stack import SafeLoaderIgnoreUnknown, Stack
+from cloudbender.utils import search_refs
+
+HEAD = """AWSTemplateFormatVersion: "2010-09-09"
+Transform: [CloudBender]
+
+Description: "Benchmark"
+
+Metadata:
+  Template:
+    Name: bench
+    Hash: __HASH__
+
+Parameters:
+
+  Conglomerate:
+    Type: String
+    Description: Project / Namespace this stack is part of
+
+Conditions:
+
+Resources:
+"""
+
+RESOURCE = """
+  Queue{0}:
+    Type: AWS::SQS::Queue
+    Properties:
+      QueueName: !Sub "${{AWS::StackName}}-queue-{0}"
+      Tags:
+        - Key: Name
+          Value: !Ref AWS::StackName
+
+
+  Alarm{0}:
+    Type: AWS::CloudWatch::Alarm
+    Properties:
+      AlarmActions:
+        - !GetAtt Queue{0}.Arn
+      Dimensions:
+        - Name: QueueName
+          Value: !GetAtt [Queue{0}, QueueName]
+"""
+
+OUTPUTS = """
+Outputs:
+"""
+
+
+def legacy_post_process(stack):
+    stack.cfn_data = yaml.load(stack.cfn_template, Loader=SafeLoaderIgnoreUnknown)
+
+    if not re.search("CloudBender::", stack.cfn_template) and not re.search("Iterate:", stack.cfn_template):
+        stack.cfn_template = stack.cfn_template.replace("Transform: [CloudBender]", "")
+        _res = """
+  Conglomerate:
+    Type: String
+    Description: Project / Namespace this stack is part of
+"""
+        stack.cfn_template = re.sub(_res, "", stack.cfn_template)
+    else:
+        stack.dependencies.add("CloudBender")
+
+    include = []
+    search_refs(stack.cfn_data, include, stack.mode)
+
+    stack.cfn_data = yaml.load(stack.cfn_template, Loader=SafeLoaderIgnoreUnknown)
+
+    for key in ["Parameters", "Outputs", "Conditions"]:
+        if key in stack.cfn_data and not stack.cfn_data[key]:
+            del stack.cfn_data[key]
+            stack.cfn_template = stack.cfn_template.replace("\n" + key + ":", "")
+
+    stack.cfn_template = re.sub(r"\n\s*\n", "\n\n", stack.cfn_template)
+    stack.cfn_template = re.sub(r"^\s*", "", stack.cfn_template)
+    stack.cfn_template = re.sub(r"\s*$", "", stack.cfn_template)
+
+    stack.md5 = hashlib.md5(stack.cfn_template.encode("utf-8")).hexdigest()
+    stack.cfn_template = stack.cfn_template.replace("__HASH__", stack.md5)
+
+    include = []
+    search_refs(stack.cfn_data, include, stack.mode)
+
+
+def main(number=3):
+    template = HEAD
+    i = 0
+    while len(template) < 1024 * 1024:
+        template += RESOURCE.format(i)
+        i += 1
+    template += OUTPUTS
+
+    def run(func):
+        stack = Stack("bench", "bench", pathlib.Path("bench.yaml"), "", {})
+        stack.mode = "CloudBender"
+        stack.cfn_template = template
+        func(stack)
+        return stack
+
+    before = run(legacy_post_process)
+    after = run(Stack._post_process)
+    assert (before.cfn_template, before.cfn_data, before.md5) == (after.cfn_template, after.cfn_data, after.md5)
+
+    print("{} KB, {} resources".format(len(template) // 1024, i * 2))
+    for label, func in [("before", legacy_post_process), ("after", Stack._post_process)]:
+        t = timeit.timeit(lambda: run(func), number=number)
+        print("{:7} {:8.1f} ms".format(label, t / number * 1000))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+import os
+import pathlib
+import pickle
+import tempfile
+import threading
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Global switch, eg. via --no-cache
+enabled = True
+
+
+def cache_dir(*parts):
+    """Returns our cache directory joined with parts
+
+    $CLOUDBENDER_CACHE_DIR if set, $XDG_CACHE_HOME/cloudbender or
+    ~/.cache/cloudbender otherwise.
+    """
+    base = os.getenv("CLOUDBENDER_CACHE_DIR")
+    if not base:
+        xdg_cache = os.getenv("XDG_CACHE_HOME") or os.path.join(
+            os.path.expanduser("~"), ".cache"
+        )
+        base = os.path.join(xdg_cache, "cloudbender")
+
+    return pathlib.Path(base, *parts)
+
+
+def config_dir(*parts):
+    """Returns our config directory joined with parts
+
+    $XDG_CONFIG_HOME/cloudbender or ~/.config/cloudbender
+    """
+    xdg_config = os.getenv("XDG_CONFIG_HOME") or os.path.join(
+        os.path.expanduser("~"), ".config"
+    )
+    return pathlib.Path(xdg_config, "cloudbender", *parts)
+
+
+def makedirs(path):
+    """Creates path incl. all missing parents private to the current user,
+    mkdir(mode=) only applies to the last one"""
+    path = pathlib.Path(path)
+    missing = []
+    while not path.is_dir():
+        missing.append(path)
+        path = path.parent
+
+    for p in reversed(missing):
+        p.mkdir(mode=0o700, exist_ok=True)
+
+
+class FileCache(object):
+    """Persistent key/value store below cache_dir(name)
+
+    Keys are hex digests, values are pickled into one file per key.
+    Everything is private to the current user (0700 dirs, 0600 files) as
+    entries may contain rendered config data.
+    Any error reading or writing an entry is treated as a miss.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def _path(self, key):
+        return cache_dir(self.name, key[:2], key)
+
+    def _count(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def get(self, key):
+        """Returns the stored value or None"""
+        if not enabled:
+            return None
+
+        try:
+            with open(self._path(key), "rb") as f:
+                value = pickle.load(f)
+        except FileNotFoundError:
+            value = None
+        except Exception as e:
+            logger.debug("Ignoring broken cache entry {}: {}".format(
+                self._path(key), e))
+            value = None
+
+        self._count(value is not None)
+        return value
+
+    def set(self, key, value):
+        if not enabled:
+            return
+
+        path = self._path(key)
+        try:
+            makedirs(path.parent)
+
+            # write to tmp file first, concurrent readers must never see
+            # partial entries
+            fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=".tmp-")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(tmp, path)
+            except BaseException:
+                os.unlink(tmp)
+                raise
+
+        except OSError as e:
+            logger.debug("Cannot write cache entry {}: {}".format(path, e))
+
+    def stats(self):
+        return "{} cache: {} hits, {} misses".format(
+            self.name, self.hits, self.misses)
@@ -7,9 +7,16 @@ import re
 from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from . import __version__
+from . import cache
+from . import daemon
+from . import sops
+from . import timings
+from . import watch as watcher
 from .core import CloudBender
+from .index import StackIndex
+from .render import render_stacks
 from .utils import setup_logging, get_docker_version
-from .exceptions import InvalidProjectDir
+from .exceptions import InvalidProjectDir, DaemonRunning
 from .pulumi import get_pulumi_version
 
 import logging
@@ -17,7 +24,31 @@ import logging
 logger = logging.getLogger(__name__)
 
 
-@click.group()
+class CloudBenderGroup(click.Group):
+    """Records the stacks or stack groups the sub command is going to work
+    on, so cli() only has to read those, as well as the raw arguments to
+    forward them to a daemon"""
+
+    def parse_args(self, ctx, args):
+        ctx.meta["cloudbender.args"] = list(args)
+        return super().parse_args(ctx, args)
+
+    def resolve_command(self, ctx, args):
+        cmd_name, cmd, args = super().resolve_command(ctx, args)
+
+        if cmd:
+            params = cmd.make_context(
+                cmd_name, list(args), parent=ctx, resilient_parsing=True
+            ).params
+            for p in ["stack_names", "stack_name", "stack_group"]:
+                if p in params:
+                    ctx.meta["cloudbender.targets"] = [params[p]] if isinstance(
+                        params[p], str) else list(params[p])
+
+        return cmd_name, cmd, args
+
+
+@click.group(cls=CloudBenderGroup)
 @click.option(
     "--profile",
     "profile",
@@ -29,15 +60,42 @@ logger = logging.getLogger(__name__)
     help="Use region, overwrites any stack config",
 )
 @click.option("--dir", "directory", help="Specify cloudbender project directory.")
+@click.option(
+    "--workers",
+    "workers",
+    type=click.IntRange(min=1),
+    default=1,
+    envvar="CLOUDBENDER_WORKERS",
+    show_default=True,
+    help="Number of parallel workers used to read the config tree and render stacks",
+)
+@click.option(
+    "--no-cache",
+    "no_cache",
+    is_flag=True,
+    help="Do not use or update any persistent caches.",
+)
+@click.option(
+    "--no-sops-cache",
+    "no_sops_cache",
+    is_flag=True,
+    help="Always decrypt SOPS encrypted config files via sops.",
+)
+@click.option(
+    "--timings",
+    "timings_report",
+    is_flag=True,
+    help="Report time spent per phase and the slowest stacks at exit.",
+)
+@click.option(
+    "--timings-json",
+    "timings_json",
+    metavar="FILE",
+    help="Write the --timings report as JSON to FILE.",
+)
 @click.option("--debug", is_flag=True, help="Turn on debug logging.")
 @click.pass_context
-def cli(ctx, profile, region, debug, directory):
-    setup_logging(debug)
-
-    # Skip parsing all the things if we just want the versions
-    if ctx.invoked_subcommand == "version":
-        return
-
+def cli(ctx, profile, region, debug, directory, workers, no_cache, no_sops_cache, timings_report, timings_json):
     # Make sure our root is abs
     if directory:
         if not os.path.isabs(directory):
@@ -47,18 +105,55 @@ def cli(ctx, profile, region, debug, directory):
     else:
         directory = os.getcwd()
 
-    # Read global config
-    try:
-        cb = CloudBender(directory, profile, region)
-    except InvalidProjectDir as e:
-        logger.error(e)
-        sys.exit(1)
+    # Let a running daemon do the work if there is one for our project
+    # Watching would block the daemon for everybody else
+    if (
+        ctx.invoked_subcommand not in daemon.LOCAL_COMMANDS
+        and "--watch" not in ctx.meta["cloudbender.args"]
+        and not daemon.server
+    ):
+        code = daemon.forward(daemon.socket_path(directory), ctx.meta["cloudbender.args"], directory)
+        if code is not None:
+            sys.exit(code)
 
-    # Only load stackgroups to get profile and region
-    if ctx.invoked_subcommand in ["wrap", "list_stacks", "state_upgrade"]:
-        cb.read_config(loadStacks=False)
-    else:
-        cb.read_config()
+    setup_logging(debug)
+
+    if timings_report or timings_json:
+        timings.enable()
+        ctx.call_on_close(functools.partial(_report_timings, timings_report, timings_json))
+
+    if no_cache:
+        cache.enabled = False
+
+    if no_sops_cache:
+        sops.cache_enabled = False
+
+    # Skip parsing all the things if we just want the versions
+    if ctx.invoked_subcommand == "version":
+        return
+
+    # Within the daemon use its already loaded project
+    cb = None
+    if daemon.server:
+        cb = daemon.server.project(profile, region, ctx.meta.get("cloudbender.targets"))
+
+    if not cb:
+        # Read global config
+        try:
+            with timings.phase("discovery"):
+                cb = CloudBender(directory, profile, region, workers)
+        except InvalidProjectDir as e:
+            logger.error(e)
+            sys.exit(1)
+
+        # Only read the stacks or groups we are asked for, if any
+        targets = ctx.meta.get("cloudbender.targets")
+
+        # Only load stackgroups to get profile and region
+        if ctx.invoked_subcommand in ["wrap", "list_stacks", "state_upgrade"]:
+            cb.read_config(loadStacks=False, targets=targets)
+        else:
+            cb.read_config(targets=targets)
 
     if debug:
         cb.dump_config()
@@ -91,12 +186,20 @@ def version():
 @click.command()
 @click.argument("stack_names", nargs=-1)
 @click.option("--multi", is_flag=True, help="Allow more than one stack to match")
+@click.option("--watch", is_flag=True, help="Keep re-rendering stacks whose config or templates change")
 @click.pass_obj
-def render(cb, stack_names, multi):
+def render(cb, stack_names, multi, watch):
     """Renders template and its parameters - CFN only"""
 
     stacks = _find_stacks(cb, stack_names, multi)
-    _render(stacks)
+    render_stacks(stacks, cb.ctx["workers"])
+
+    if watch:
+        def _find():
+            cb.reload()
+            return _find_stacks(cb, stack_names, multi)
+
+        watcher.watch(stacks, _find, lambda s: render_stacks([s]))
 
 
 @click.command()
@@ -108,7 +211,7 @@ def sync(cb, stack_names, multi):
 
     stacks = _find_stacks(cb, stack_names, multi)
 
-    _render(stacks)
+    render_stacks(stacks, cb.ctx["workers"])
     _provision(cb, stacks)
 
 
@@ -375,6 +478,24 @@ def list_stacks(cb, stack_group):
     sg.list_stacks()
 
 
+@click.command("daemon")
+@click.pass_context
+def serve(ctx):
+    """Keeps the project loaded and runs all other commands for it"""
+    params = ctx.parent.params
+    try:
+        daemon.Daemon(
+            ctx.obj,
+            profile=params["profile"],
+            region=params["region"],
+            workers=params["workers"],
+            debug=params["debug"],
+        ).serve()
+    except DaemonRunning as e:
+        logger.error(e)
+        sys.exit(1)
+
+
 @click.command()
 @click.pass_obj
 def clean(cb):
@@ -383,7 +504,14 @@ def clean(cb):
 
 
 def sort_stacks(cb, stacks):
-    """Sort stacks by dependencies"""
+    """Sort stacks by dependencies
+
+    Only dependencies between the given stacks count, stacks provided by
+    any other stack are expected to exist already. A stack depending only on
+    those is part of the first step.
+    """
+
+    index = StackIndex(stacks)
 
     data = {}
     for s in stacks:
@@ -405,13 +533,15 @@ def sort_stacks(cb, stacks):
             continue
         deps = []
         for d in s.dependencies:
+            # Providers outside of stacks never change the order between our
+            # stacks, so there is no need to read any other stack
             # For now we assume deps are artifacts so we prepend them with our local profile and region to match stack.id
-            for dep_stack in cb.filter_stacks(
+            for dep_stack in index.filter(
                 {"region": s.region, "profile": s.profile, "provides": d}
             ):
                 deps.append(dep_stack.id)
             # also look for global services
-            for dep_stack in cb.filter_stacks(
+            for dep_stack in index.filter(
                 {"region": "global", "profile": s.profile, "provides": d}
             ):
                 deps.append(dep_stack.id)
@@ -437,9 +567,7 @@ def sort_stacks(cb, stacks):
         # return list of stack objects rather than just names
         result = []
         for o in ordered:
-            for s in stacks:
-                if s.id == o:
-                    result.append(s)
+            result.extend(index.by_id.get(o, []))
         yield result
 
         data = {
@@ -471,16 +599,6 @@ def _find_stacks(cb, stack_names, multi=False):
     return stacks
 
 
-def _render(stacks):
-    """Utility function to reuse code between tasks"""
-    for s in stacks:
-        if s.mode != "pulumi":
-            s.render()
-            s.write_template_file()
-        else:
-            logger.info("{} uses Pulumi, render skipped.".format(s.stackname))
-
-
 def _anyPulumi(step):
     for stack in step:
         if stack.mode == "pulumi":
@@ -517,6 +635,15 @@ def _provision(cb, stacks):
                     future.result()
 
 
+def _report_timings(report, out):
+    """Prints the --timings report to stderr and / or writes it as JSON to
+    out"""
+    if report:
+        click.echo(timings.report(), err=True, nl=False)
+    if out:
+        timings.write(out)
+
+
 cli.add_command(version)
 cli.add_command(render)
 cli.add_command(sync)
@@ -538,6 +665,7 @@ cli.add_command(state_upgrade)
 cli.add_command(assimilate)
 cli.add_command(execute)
 cli.add_command(wrap)
+cli.add_command(serve)
 
 if __name__ == "__main__":
     cli(obj={})
@@ -1,9 +1,7 @@
 import os
 import time
 
-import boto3
-import botocore.session
-from botocore import credentials
+from . import timings
 
 import logging
 
@@ -22,6 +20,9 @@ class BotoConnection:
         if sessions.get((profile, region)):
             return sessions[(profile, region)]
 
+        import botocore.session
+        from botocore import credentials
+
         # Construct botocore session with cache
         # Setup boto to cache STS tokens for MFA
         # Change the cache path from the default of ~/.aws/boto/cache to the one used by awscli
@@ -49,6 +50,8 @@ class BotoConnection:
             )
             return clients[(profile, region, service)]
 
+        import boto3
+
         session = self._get_session(profile, region)
         client = boto3.Session(botocore_session=session).client(service)
         logger.debug("New boto session for {} {} {}".format(
@@ -58,11 +61,14 @@ class BotoConnection:
         return client
 
     def call(self, service, command, kwargs={}, profile=None, region=None):
+        import botocore.exceptions
+
         while True:
             try:
                 client = self._get_client(service, profile, region)
                 logger.debug("Calling {}:{}".format(client, command))
-                return getattr(client, command)(**kwargs)
+                with timings.phase("aws", "{}:{}".format(service, command)):
+                    return getattr(client, command)(**kwargs)
 
             except botocore.exceptions.ClientError as e:
                 if e.response["Error"]["Code"] == "Throttling":
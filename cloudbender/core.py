@@ -1,8 +1,12 @@
+import os
 import pathlib
 import logging
 
+from . import timings
 from .stackgroup import StackGroup
-from .jinja import read_config_file
+from .index import StackIndex
+from .jinja import read_config_file, config_cache, config_bytecode_cache
+from .sops import sops_cache
 from .exceptions import InvalidProjectDir
 
 logger = logging.getLogger(__name__)
@@ -11,10 +15,13 @@ logger = logging.getLogger(__name__)
 class CloudBender(object):
     """Config Class to handle recursive conf/* config tree"""
 
-    def __init__(self, root_path, profile, region):
+    def __init__(self, root_path, profile, region, workers=1):
         self.root = pathlib.Path(root_path)
         self.sg = None
-        self.all_stacks = []
+        self._all_stacks = []
+        self._scoped = False
+        self._loadStacks = True
+        self._targets = None
         self.ctx = {
             "root": self.root,
             "config_path": self.root.joinpath("config"),
@@ -24,6 +31,7 @@ class CloudBender(object):
             "outputs_path": self.root.joinpath("outputs"),
             "profile": profile,
             "region": region,
+            "workers": workers,
         }
 
         if profile:
@@ -41,8 +49,16 @@ class CloudBender(object):
                 )
             )
 
-    def read_config(self, loadStacks=True):
-        """Load the <path>/config.yaml, <path>/*.yaml as stacks, sub-folders are sub-groups"""
+    def read_config(self, loadStacks=True, targets=None, loaded=None):
+        """Load the <path>/config.yaml, <path>/*.yaml as stacks, sub-folders are sub-groups
+
+        If targets, a list of stack or stack group tokens as passed on the
+        command line, is given only the config.yaml files along the way and
+        the matching stacks are read. All other stacks are read on demand via
+        all_stacks.
+        loaded optionally maps paths to stacks already read, which are kept
+        as they are.
+        """
 
         # Read top level config.yaml and extract CloudBender CTX
         _config = read_config_file(
@@ -78,10 +94,101 @@ class CloudBender(object):
                     if not v.is_absolute():
                         self.ctx[k] = self.root.joinpath(v)
 
-        self.sg = StackGroup(self.ctx["config_path"], self.ctx)
-        self.sg.read_config(loadStacks=loadStacks)
+        scope = None
+        if targets is not None:
+            with timings.phase("discovery"):
+                scope = self._resolve_scope(targets)
 
-        self.all_stacks = self.sg.get_stacks()
+        self.sg = StackGroup(self.ctx["config_path"], self.ctx)
+        self.sg.read_config(loadStacks=loadStacks, scope=scope, loaded=loaded)
+
+        self._all_stacks = self.sg.get_stacks()
+        self._scoped = scope is not None
+        self._loadStacks = loadStacks
+        self._targets = targets
+
+        logger.debug(config_cache.stats())
+        logger.debug(config_bytecode_cache.stats())
+        logger.debug(sops_cache.stats())
+
+    @property
+    def all_stacks(self):
+        """All stacks of the project, reads the full tree if we only read
+        parts of it so far"""
+        self._read_all()
+        return self._all_stacks
+
+    def reload(self):
+        """Reads the config again, limited to the same targets as before"""
+        self.read_config(loadStacks=self._loadStacks, targets=self._targets)
+
+    def reload_stacks(self, paths):
+        """Re-reads the stack files at paths in place
+
+        Returns False if any of them is not a stack we know, in which case
+        the caller has to read the whole config again.
+        """
+        index = self.sg._get_index()
+        by_path = {str(s.path): s for s in index.stacks}
+        groups = {str(sg.path): sg for sg in index.groups}
+
+        for path in paths:
+            if path not in by_path or os.path.dirname(path) not in groups:
+                return False
+
+        for path in paths:
+            groups[os.path.dirname(path)].reload_stack(by_path[path])
+
+        self.sg._set_index(StackIndex(root=self.sg))
+        self._all_stacks = self.sg.get_stacks()
+        return True
+
+    def _read_all(self):
+        if self._scoped:
+            logger.debug("Reading all stacks")
+            # Keep the stacks we already handed out
+            self.read_config(
+                loadStacks=self._loadStacks,
+                loaded={s.path: s for s in self._all_stacks})
+
+    def _resolve_scope(self, targets):
+        """Returns the set of stack files and group folders matching targets
+
+        Mirrors resolve_stacks and StackGroup.get_stackgroup by walking
+        the folders only, without reading any config.
+        """
+        files = []
+        groups = []
+
+        def _walk(path):
+            if not path.is_dir():
+                return
+            groups.append(path)
+            files.extend(s for s in path.glob(
+                "*.yaml") if not s.name == "config.yaml")
+            for sub_group in [s for s in path.iterdir() if s.is_dir()]:
+                _walk(sub_group)
+
+        _walk(self.ctx["config_path"])
+
+        scope = set()
+        for token in targets:
+            tokens = [token]
+            # remove optional leading "config/" to allow bash path expansions
+            if token.startswith("config/"):
+                tokens.append(token[7:])
+
+            for t in tokens:
+                if t.endswith(".yaml"):
+                    scope.update(s for s in files if s.match(t))
+                else:
+                    t = t.rstrip("/")
+                    for sg in groups:
+                        if sg.match(t):
+                            scope.add(sg)
+                            break
+
+        return scope
 
     def dump_config(self):
         logger.debug("<CloudBender: {}>".format(vars(self)))
@@ -118,18 +225,7 @@ class CloudBender(object):
 
         # if no group of stacks provided, look in all available
         if not stacks:
-            stacks = self.all_stacks
-
-        matching_stacks = []
-        for s in stacks:
-            match = True
-
-            for p, v in filter_by.items():
-                if not (hasattr(s, p) and getattr(s, p) == v):
-                    match = False
-                    break
-
-            if match:
-                matching_stacks.append(s)
+            self._read_all()
+            return self.sg.index.filter(filter_by)
 
-        return matching_stacks
+        return StackIndex(stacks).filter(filter_by)
@@ -0,0 +1,335 @@
+import copy
+import contextlib
+import hashlib
+import io
+import json
+import os
+import pathlib
+import socket
+import sys
+import tempfile
+
+from . import cache
+from . import connection
+from . import sops
+from . import timings
+from .core import CloudBender
+from .exceptions import DaemonRunning
+from .jinja import env_used, reset_env_used
+from .stack import reset_template_envs, template_library_paths
+from .utils import setup_logging
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Set within the daemon, cli() then uses its warm project
+server = None
+
+# Commands which need a terminal or the daemon itself, never forwarded
+LOCAL_COMMANDS = ["daemon", "version", "wrap", "assimilate", "state-upgrade"]
+
+# Environment variables which differ between any two shells but never
+# affect a command
+VOLATILE_ENV = ["PWD", "OLDPWD", "SHLVL", "_"]
+
+
+def socket_path(root):
+    """Returns the unix socket of the daemon serving the project at root"""
+    if os.getenv("CLOUDBENDER_DAEMON_SOCKET"):
+        return os.getenv("CLOUDBENDER_DAEMON_SOCKET")
+
+    digest = hashlib.sha256(str(root).encode("utf-8")).hexdigest()[:12]
+    return os.path.join(
+        tempfile.gettempdir(), "cloudbender-{}-{}.sock".format(os.getuid(), digest)
+    )
+
+
+def forward(path, args, root):
+    """Runs the command line args for the project at root via the daemon
+    listening at path, within our environment
+
+    Returns the exit code of the command or None if there is no daemon or
+    it serves another project.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except OSError:
+        sock.close()
+        return None
+
+    with sock, sock.makefile("rw", encoding="utf-8") as f:
+        f.write(json.dumps({
+            "args": args,
+            "cwd": os.getcwd(),
+            "env": dict(os.environ),
+            "root": str(root),
+        }) + "\n")
+        f.flush()
+
+        for line in f:
+            msg = json.loads(line)
+            if "exit" in msg:
+                return msg["exit"]
+            if "refused" in msg:
+                logger.debug("Not using daemon at {}: {}".format(path, msg["refused"]))
+                return None
+
+            out = sys.stdout if msg["fd"] == 1 else sys.stderr
+            out.write(msg["data"])
+            out.flush()
+
+    # Daemon went away mid command
+    return 1
+
+
+class _Stream(io.TextIOBase):
+    """Sends everything written to stdout / stderr back to the client"""
+
+    encoding = "utf-8"
+
+    def __init__(self, f, fd):
+        self.f = f
+        self.fd = fd
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.f.write(json.dumps({"fd": self.fd, "data": data}) + "\n")
+        self.f.flush()
+        return len(data)
+
+
+class Daemon(object):
+    """Keeps a fully read project in memory and runs forwarded commands
+
+    Config files are checked for changes before each command. Changed stack
+    files are re-read individually, any other change to the config tree
+    reads the whole project again.
+    Each command works on its own copy of the stacks it targets, as commands
+    modify their stacks while rendering or provisioning.
+    Commands run within the environment of their client, the project is
+    read again whenever any ENV variable the config files used differs from
+    the one it was read with.
+    Jinja environments of the templates are kept between commands, until
+    any file of a local library changes.
+    """
+
+    def __init__(self, cb, profile=None, region=None, workers=1, debug=False):
+        self.cb = cb
+        self.profile = profile
+        self.region = region
+        self.workers = workers
+        self.debug = debug
+        self.path = socket_path(cb.root)
+        self.snapshot = _snapshot([cb.ctx["config_path"]])
+        self.environ = _environ(os.environ)
+        self.client_environ = self.environ
+        self.library_paths = []
+        self.libraries = {}
+        self.cwd = os.getcwd()
+        self.own_environ = dict(os.environ)
+
+    def refresh(self):
+        """Re-reads whatever changed in the config tree or environment
+        since last time, drops the Jinja environments if any library
+        changed"""
+        if _snapshot(self.library_paths) != self.libraries:
+            logger.info("Library changed, compiling templates again")
+            reset_template_envs()
+
+        env = _environ(os.environ)
+        if env != self.client_environ:
+            # Sessions hold on to credentials from the environment
+            connection.sessions.clear()
+            connection.clients.clear()
+            self.client_environ = env
+
+        if _env_changed(self.environ, env):
+            logger.info("Environment changed, reading project")
+            self.environ = env
+            self.snapshot = _snapshot([self.cb.ctx["config_path"]])
+            self._read()
+            return
+
+        snapshot = _snapshot([self.cb.ctx["config_path"]])
+        changed = [p for p in snapshot if snapshot[p] != self.snapshot.get(p)]
+        removed = set(self.snapshot) - set(snapshot)
+        self.snapshot = snapshot
+
+        if not changed and not removed:
+            return
+
+        stacks = [p for p in changed if p.endswith(".yaml") and os.path.basename(p) != "config.yaml"]
+        if removed or len(stacks) != len(changed) or not self.cb.reload_stacks(stacks):
+            logger.info("Config changed, reading project")
+            self._read()
+        else:
+            logger.info("Re-read {}".format(", ".join(stacks)))
+
+    def _read(self):
+        self.cb = CloudBender(self.cb.root, self.profile, self.region, self.workers)
+        reset_env_used()
+        self.cb.read_config()
+
+    def project(self, profile, region, targets=None):
+        """Returns a copy of the current project or None if the command asks
+        for a different profile or region
+
+        Only the stacks matching targets, as passed on the command line, are
+        private to the copy, all other stacks are shared with the daemon.
+        """
+        if (profile, region) != (self.profile, self.region):
+            return None
+
+        self.refresh()
+
+        # The index is keyed by id(), each copy builds its own
+        memo = {id(self.cb.sg.index): None}
+        if targets is not None:
+            scope = self.cb._resolve_scope(targets)
+            for stack in self.cb.sg._get_index().stacks:
+                path = pathlib.Path(stack.path)
+                if path not in scope and not scope.intersection(path.parents):
+                    memo[id(stack)] = stack
+
+        return copy.deepcopy(self.cb, memo)
+
+    def serve(self):
+        global server
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if os.path.exists(self.path):
+            if _alive(self.path):
+                raise DaemonRunning(
+                    "Another daemon is already serving {}".format(self.path))
+            os.unlink(self.path)
+
+        umask = os.umask(0o177)
+        try:
+            sock.bind(self.path)
+        finally:
+            os.umask(umask)
+        sock.listen()
+
+        server = self
+        logger.info("Serving {} on {}".format(self.cb.root, self.path))
+        try:
+            while True:
+                conn, _ = sock.accept()
+                with conn:
+                    self._handle(conn)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server = None
+            sock.close()
+            os.unlink(self.path)
+
+    def _handle(self, conn):
+        from .cli import cli
+
+        with conn.makefile("rw", encoding="utf-8") as f:
+            line = f.readline()
+            if not line:
+                return
+
+            try:
+                request = json.loads(line)
+                (args, env) = (list(request["args"]), dict(request["env"]))
+                if not all(isinstance(v, str) for v in args + list(env) + list(env.values())):
+                    raise TypeError("args and env must be strings")
+                logger.debug("Running {}".format(" ".join(args)))
+                if os.path.normpath(request["root"]) != os.path.normpath(self.cb.root):
+                    f.write(json.dumps({"refused": "serving {}".format(self.cb.root)}) + "\n")
+                    f.flush()
+                    return
+                os.chdir(request["cwd"])
+            except (ValueError, KeyError, TypeError, OSError) as e:
+                logger.warning("Invalid request: {}".format(e))
+                f.write(json.dumps({"fd": 2, "data": "Invalid request: {}\n".format(e)}) + "\n")
+                f.write(json.dumps({"exit": 2}) + "\n")
+                f.flush()
+                return
+
+            saved = (cache.enabled, sops.cache_enabled)
+            code = 1
+            try:
+                with contextlib.redirect_stdout(_Stream(f, 1)), contextlib.redirect_stderr(_Stream(f, 2)):
+                    os.environ.clear()
+                    os.environ.update(env)
+                    code = _run(cli, args)
+            finally:
+                os.chdir(self.cwd)
+                os.environ.clear()
+                os.environ.update(self.own_environ)
+                (cache.enabled, sops.cache_enabled) = saved
+                timings.reset()
+                self.library_paths = template_library_paths()
+                self.libraries = _snapshot(self.library_paths)
+                setup_logging(self.debug)
+
+            f.write(json.dumps({"exit": code}) + "\n")
+            f.flush()
+
+
+def _environ(env):
+    return {k: v for k, v in env.items() if k not in VOLATILE_ENV}
+
+
+def _env_changed(before, after):
+    """True if any ENV variable the config files used differs"""
+    used = env_used()
+    if used is None:
+        return before != after
+
+    return any(before.get(k) != after.get(k) for k in used)
+
+
+def _snapshot(paths):
+    """Returns modification time and size of all files below paths"""
+    files = {}
+    for root in paths:
+        for path, _, names in os.walk(root):
+            for name in names:
+                try:
+                    st = os.stat(os.path.join(path, name))
+                except OSError:
+                    continue
+                files[os.path.join(path, name)] = (st.st_mtime_ns, st.st_size)
+
+    return files
+
+
+def _alive(path):
+    """True if a daemon accepts connections at path"""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    with sock:
+        try:
+            sock.connect(path)
+        except OSError:
+            return False
+
+    return True
+
+
+def _run(cli, args):
+    """Runs cli like click's standalone mode, returns the exit code"""
+    import click
+
+    try:
+        code = cli.main(args=args, prog_name="cloudbender", standalone_mode=False)
+        return code if isinstance(code, int) else 0
+    except click.ClickException as e:
+        e.show()
+        return e.exit_code
+    except click.Abort:
+        click.echo("Aborted!", err=True)
+        return 1
+    except SystemExit as e:
+        return e.code if isinstance(e.code, int) else 1
+    except Exception:
+        logger.exception("Command failed")
+        return 1
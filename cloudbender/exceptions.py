@@ -16,3 +16,7 @@ class InvalidHook(Exception):
 
 class ChecksumError(Exception):
     """My documentation"""
+
+
+class DaemonRunning(Exception):
+    """Another daemon already serves the project"""
@@ -0,0 +1,119 @@
+import pathlib
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Characters turning a path token into a glob pattern
+_GLOB_CHARS = set("*?[")
+
+
+class StackIndex(object):
+    """Hash indexes of a list of stacks and optionally a stack group tree
+
+    Stacks and groups are kept in the same depth-first order as the tree
+    walks of StackGroup, so the stacks and groups below any group are a
+    contiguous slice, see ranges.
+    """
+
+    def __init__(self, stacks=[], root=None):
+        self.stacks = []
+        self.groups = []
+
+        # id(group) -> (first stack, end of stacks, first group, end of groups)
+        self.ranges = {}
+
+        if root:
+            self._walk(root)
+        else:
+            self.stacks = list(stacks)
+
+        self.positions = {id(s): i for i, s in enumerate(self.stacks)}
+        self.by_id = {}
+        self.by_name = {}
+        self.by_filename = {}
+        self.by_provides = {}
+        self.by_profile_region = {}
+        for s in self.stacks:
+            self.by_id.setdefault(s.id, []).append(s)
+            self.by_name.setdefault(s.stackname, []).append(s)
+            self.by_filename.setdefault(s.path.name, []).append(s)
+            self.by_provides.setdefault(s.provides, []).append(s)
+            self.by_profile_region.setdefault(
+                (s.profile, s.region), []).append(s)
+
+        self.group_positions = {id(sg): i for i, sg in enumerate(self.groups)}
+        self.groups_by_name = {}
+        for sg in self.groups:
+            self.groups_by_name.setdefault(sg.path.name, []).append(sg)
+
+    def _walk(self, sg):
+        first_stack = len(self.stacks)
+        first_group = len(self.groups)
+
+        self.groups.append(sg)
+        self.stacks.extend(sg.stacks)
+        for child in sg.sgs:
+            self._walk(child)
+
+        self.ranges[id(sg)] = (first_stack, len(self.stacks),
+                               first_group, len(self.groups))
+
+    def filter(self, filter_by):
+        """Returns all stacks whose attributes match filter_by"""
+        if "provides" in filter_by:
+            candidates = self.by_provides.get(filter_by["provides"], [])
+        elif "profile" in filter_by and "region" in filter_by:
+            candidates = self.by_profile_region.get(
+                (filter_by["profile"], filter_by["region"]), [])
+        elif "stackname" in filter_by:
+            candidates = self.by_name.get(filter_by["stackname"], [])
+        else:
+            candidates = self.stacks
+
+        return [
+            s
+            for s in candidates
+            if all(hasattr(s, p) and getattr(s, p) == v for p, v in filter_by.items())
+        ]
+
+    def get_stacks(self, sg, name=None, recursive=True, match_by="name"):
+        """Same as StackGroup.get_stacks for any group of the tree"""
+        (first, end, _, _) = self.ranges[id(sg)]
+        if not recursive:
+            end = first + len(sg.stacks)
+
+        if not name:
+            return self.stacks[first:end]
+
+        if match_by == "name":
+            candidates = self.by_name.get(name, [])
+        else:
+            candidates = self._path_candidates(
+                name, self.by_filename, self.stacks)
+
+        return [
+            s
+            for s in candidates
+            if first <= self.positions[id(s)] < end
+            and (match_by == "name" or s.path.match(name))
+        ]
+
+    def get_stackgroup(self, sg, name):
+        """Same as StackGroup.get_stackgroup for any group of the tree"""
+        (_, _, first, end) = self.ranges[id(sg)]
+
+        for candidate in self._path_candidates(name, self.groups_by_name, self.groups):
+            if first <= self.group_positions[id(candidate)] < end and candidate.path.match(name):
+                return candidate
+
+        return None
+
+    def _path_candidates(self, pattern, by_name, everything):
+        """Only entries with the same final name can match a pattern
+        unless its final part is a glob itself"""
+        name = pathlib.PurePath(pattern).name
+        if not name or _GLOB_CHARS & set(name):
+            return everything
+
+        return by_name.get(name, [])
@@ -1,25 +1,66 @@
 import os
+import contextlib
+import functools
 import io
+import collections.abc
+import hashlib
+import importlib.metadata
 import gzip
 import re
 import base64
 import yaml
-import copy
-import subprocess
 import sys
+import threading
+import types
 import zlib
 
 import jinja2
-import python_minifier
 import markupsafe
 
 from jinja2.filters import make_attrgetter
+from jinja2.loaders import split_template_path
 from jinja2.runtime import Undefined
 
+from . import __version__
+from . import cache
+from . import sops
+from . import timings
+from .cache import FileCache, cache_dir, makedirs
+from .utils import freeze
+
 import logging
 
 logger = logging.getLogger(__name__)
 
+# Rendered and parsed config files, see read_config_file
+config_cache = FileCache("config")
+
+# Packed output of the pyminify filter
+pyminify_cache = FileCache("pyminify")
+
+# Shared by all config files, see _get_config_env
+_config_env = None
+_config_env_lock = threading.Lock()
+
+# Sources of the config file currently rendered by this thread and the
+# files included by config files read within record_config_files
+_config_state = threading.local()
+
+# Files loaded by the templates currently rendered by this thread, see
+# record_template_files
+_template_state = threading.local()
+
+# ENV variables used by the config files read so far, None once any of them
+# used all of them, see env_used
+_env_used = set()
+_env_used_lock = threading.Lock()
+
+# Any Jinja block, variable or comment
+_JINJA_SYNTAX = re.compile(r"\{[{%#]")
+
+# Top level sops metadata of encrypted files
+_SOPS_KEY = re.compile(r"^sops:", re.MULTILINE)
+
 
 @jinja2.pass_context
 def option(context, attribute, default_value="", source="options"):
@@ -46,46 +87,53 @@ def option(context, attribute, default_value="", source="options"):
 @jinja2.pass_context
 def include_raw_gz(context, files=None, gz=True, remove_comments=False):
     jenv = context.environment
-    output = ""
+    source = "".join(jenv.loader.get_source(jenv, name)[0] for name in files)
+
+    (output, size, packed_size) = _pack_raw(source, gz, remove_comments)
+    if not gz:
+        return markupsafe.Markup(output)
+
+    # MaxSize is 21847
+    logger.info(
+        "Compressed user-data from {} to {}".format(size, packed_size)
+    )
+    return output
+
+
+# Remove full line comments but not shebang
+_re_comment = re.compile(r"\s*#[^!]")
+_re_blank = re.compile(r"\s*$")
+_re_keep = re.compile(r"## template: jinja$")
+
+
+# Bundles can be large, but few of them are shared by many stacks
+@functools.lru_cache(maxsize=32)
+def _pack_raw(source, gz, remove_comments):
+    """Returns the output of include_raw_gz for source, its size and its
+    size compressed, the same user-data is included by many stacks"""
+    output = source
 
     # For shell script we can even remove whitespaces so treat them individually
     # sed -e '2,$ {/^ *$/d ; /^ *#/d ; /^[ \t] *#/d ; /*^/d ; s/^[ \t]*// ; s/*[ \t]$// ; s/ $//}'
-    for name in files:
-        output = output + \
-            markupsafe.Markup(jenv.loader.get_source(jenv, name)[0])
-
     if remove_comments:
-        # Remove full line comments but not shebang
-        _re_comment = re.compile(r"^\s*#[^!]")
-        _re_blank = re.compile(r"^\s*$")
-        _re_keep = re.compile(r"^## template: jinja$")
-        stripped_output = ""
-        for curline in output.splitlines():
-            if re.match(_re_blank, curline):
+        lines = []
+        for curline in source.splitlines():
+            if _re_blank.match(curline):
                 continue
-            elif re.match(_re_keep, curline):
-                stripped_output = stripped_output + curline + "\n"
-            elif re.match(_re_comment, curline):
-                logger.debug("Removed {}".format(curline))
+            elif _re_keep.match(curline) or not _re_comment.match(curline):
+                lines.append(curline + "\n")
             else:
-                stripped_output = stripped_output + curline + "\n"
-
-        output = stripped_output
+                logger.debug("Removed {}".format(curline))
+        output = "".join(lines)
 
     if not gz:
-        return output
+        return (output, len(output), None)
 
     buf = io.BytesIO()
-    f = gzip.GzipFile(mode="w", fileobj=buf, mtime=0)
-    f.write(output.encode())
-    f.close()
+    with gzip.GzipFile(mode="w", fileobj=buf, mtime=0) as f:
+        f.write(output.encode())
 
-    # MaxSize is 21847
-    logger.info(
-        "Compressed user-data from {} to {}".format(
-            len(output), len(buf.getvalue()))
-    )
-    return base64.b64encode(buf.getvalue()).decode("utf-8")
+    return (base64.b64encode(buf.getvalue()).decode("utf-8"), len(output), len(buf.getvalue()))
 
 
 @jinja2.pass_context
@@ -129,9 +177,16 @@ def sub(value="", pattern="", replace="", ignorecase=False):
 
 
 def pyminify(source):
-    minified = python_minifier.awslambda(
-        source, filename=None, entrypoint=None)
-    gz_source = gz_pack(minified)
+    import python_minifier
+
+    # Packing depends on nothing but source and the minifier
+    key = _digest("{}|{}".format(importlib.metadata.version("python_minifier"), source))
+    gz_source = pyminify_cache.get(key)
+    if gz_source is None:
+        minified = python_minifier.awslambda(
+            source, filename=None, entrypoint=None)
+        gz_source = gz_pack(minified)
+        pyminify_cache.set(key, gz_source)
 
     logger.info(
         "Compressed python code from {} to {}".format(
@@ -179,13 +234,11 @@ def JinjaEnv(template_locations=[]):
         lstrip_blocks=True,
         undefined=LoggingUndefined,
         extensions=["jinja2.ext.loopcontrols", "jinja2.ext.do"],
+        bytecode_cache=template_bytecode_cache,
     )
 
     if template_locations:
-        jinja_loaders = []
-        for _dir in template_locations:
-            jinja_loaders.append(jinja2.FileSystemLoader(str(_dir)))
-        jenv.loader = jinja2.ChoiceLoader(jinja_loaders)
+        jenv.loader = IndexedLoader(template_locations)
 
     else:
         jenv.loader = jinja2.BaseLoader()
@@ -205,83 +258,486 @@ def JinjaEnv(template_locations=[]):
     return jenv
 
 
+class IndexedLoader(jinja2.BaseLoader):
+    """Loads templates from a list of folders, the first folder providing a
+    template wins, same as a ChoiceLoader of FileSystemLoaders
+
+    All files are indexed once, so looking up a template does not probe
+    every folder. Names missing from the index, eg. below symlinked folders
+    or added later, are still looked up in all folders.
+    Records the files of all templates, includes and include_raw loaded,
+    see record_template_files.
+    """
+
+    def __init__(self, searchpath):
+        self.searchpath = [os.path.normpath(str(p)) for p in searchpath]
+        self.index = {}
+        for base in self.searchpath:
+            for (root, dirs, files) in os.walk(base):
+                for f in files:
+                    path = os.path.join(root, f)
+                    name = os.path.relpath(path, base).replace(os.sep, "/")
+                    self.index.setdefault(name, path)
+
+    def _find(self, pieces):
+        name = "/".join(pieces)
+        if name in self.index:
+            return self.index[name]
+
+        for base in self.searchpath:
+            path = os.path.join(base, *pieces)
+            if os.path.isfile(path):
+                self.index[name] = path
+                return path
+
+        return None
+
+    def get_source(self, environment, template):
+        pieces = split_template_path(template)
+        path = self._find(pieces)
+        if path is None:
+            raise jinja2.TemplateNotFound(template)
+
+        try:
+            with open(path, encoding="utf-8") as f:
+                source = f.read()
+            mtime = os.path.getmtime(path)
+        except FileNotFoundError:
+            # Removed since we indexed it, any later folder might provide it
+            del self.index["/".join(pieces)]
+            return self.get_source(environment, template)
+
+        _record_template_file(path)
+
+        # Jinja calls uptodate whenever it reuses the template from its cache
+        def uptodate():
+            _record_template_file(path)
+            try:
+                return os.path.getmtime(path) == mtime
+            except OSError:
+                return False
+
+        return (source, path, uptodate)
+
+    def list_templates(self):
+        return sorted(self.index)
+
+
+def _record_template_file(filename):
+    files = getattr(_template_state, "files", None)
+    if files is not None:
+        files.add(filename)
+
+
+@contextlib.contextmanager
+def record_template_files():
+    """Yields the set of files any template rendered within loads"""
+    _template_state.files = set()
+    try:
+        yield _template_state.files
+    finally:
+        _template_state.files = None
+
+
+@contextlib.contextmanager
+def record_config_files():
+    """Yields the set of files any config file read within includes"""
+    _config_state.files = set()
+    try:
+        yield _config_state.files
+    finally:
+        _config_state.files = None
+
+
+def _record_config_files(paths):
+    files = getattr(_config_state, "files", None)
+    if files is not None:
+        files.update(paths)
+
+
 def render_docs(docs, outputs):
     jenv = jinja2.Environment(undefined=jinja2.ChainableUndefined)
 
     return jenv.from_string(docs).render(outputs)
 
 
-def read_config_file(path, variables={}):
+class DecryptedConfig(dict):
+    """Config data of a SOPS encrypted file, see read_config_file"""
+
+
+def read_config_file(path, variables={}, decrypted=False):
     """reads yaml config file, passes it through jinja and returns data structre
 
     - OS ENV are available as {{ ENV.<VAR> }}
     - variables defined in parent configs are available as {{ <VAR> }}
+
+    Results are cached in config_cache keyed by the file content and
+    variables, entries are only used if all ENV variables and included files
+    the file referenced are still unchanged. SOPS encrypted files are never
+    cached and returned as DecryptedConfig, neither are files whose
+    variables hold decrypted values, ie. decrypted is set.
     """
-    jinja_variables = copy.deepcopy(variables)
-    jinja_variables["ENV"] = os.environ
+    with timings.phase("config", path):
+        return _read_config_file(path, variables, decrypted)
+
+
+def _read_config_file(path, variables, decrypted):
+    # variables are shared read-only, no need to copy them for each file
+    jinja_variables = dict(freeze(variables))
+    environ = _EnvRecorder(os.environ)
+    jinja_variables["ENV"] = environ
 
     if path.exists():
         logger.debug("Reading config file: {}".format(path))
 
-        # First check for sops being present
+        cache_key = _config_cache_key(path, variables)
+        entry = None if decrypted else config_cache.get(cache_key)
+        if entry and _config_cache_valid(entry):
+            _record_env_used(entry["env"], entry["env_all"])
+            _record_config_files(entry["files"])
+            return entry["data"]
+
         try:
-            jenv = jinja2.Environment(
-                enable_async=True,
-                auto_reload=False,
-                loader=jinja2.FunctionLoader(_sops_loader),
-                undefined=jinja2.StrictUndefined,
-                extensions=["jinja2.ext.loopcontrols"],
-            )
-            template = jenv.get_template(str(path))
-            rendered_template = template.render(jinja_variables)
-            data = yaml.safe_load(rendered_template)
-            if data:
-                return data
+            sources = _ConfigSources()
+            source = sources(str(path))
+
+            # Plain yaml, no need to compile a template
+            if _JINJA_SYNTAX.search(source):
+                _config_state.sources = sources
+                try:
+                    template = _get_config_env().get_template(str(path))
+                    source = template.render(jinja_variables)
+                finally:
+                    _config_state.sources = None
+
+            data = yaml.safe_load(source)
+            if not data:
+                data = {}
 
         except Exception as e:
             logger.exception(
                 "Error reading config file: {} ({})".format(path, e))
             sys.exit(1)
 
+        _record_env_used(environ.used, environ.used_all)
+        _record_config_files(p for p in sources.files if p != str(path))
+
+        if sources.decrypted:
+            return DecryptedConfig(data)
+
+        if not decrypted:
+            sources.files.pop(str(path), None)
+            config_cache.set(
+                cache_key,
+                {
+                    "data": data,
+                    "env": {k: _digest(os.environ.get(k)) for k in environ.used},
+                    "env_all": _environ_digest() if environ.used_all else None,
+                    "files": sources.files,
+                },
+            )
+
+        return data
+
     return {}
 
 
+def env_used():
+    """Returns the names of all ENV variables the config files read so far
+    depend on, or None if any of them depends on all of them"""
+    with _env_used_lock:
+        return None if _env_used is None else set(_env_used) | {"DISABLE_SOPS"}
+
+
+def reset_env_used():
+    global _env_used
+
+    with _env_used_lock:
+        _env_used = set()
+
+
+def _record_env_used(used, used_all):
+    global _env_used
+
+    with _env_used_lock:
+        if used_all:
+            _env_used = None
+        elif _env_used is not None:
+            _env_used.update(used)
+
+
+def _get_config_env():
+    """Returns the Jinja environment shared by all config files
+
+    Templates are not kept in the environment itself, as we need to see
+    every file loaded to track the dependencies of each config file, but
+    the compiled code is reused via config_bytecode_cache.
+    """
+    global _config_env
+
+    with _config_env_lock:
+        if not _config_env:
+            _config_env = jinja2.Environment(
+                cache_size=0,
+                loader=jinja2.FunctionLoader(_load_config_source),
+                bytecode_cache=config_bytecode_cache,
+                undefined=jinja2.StrictUndefined,
+                extensions=["jinja2.ext.loopcontrols"],
+            )
+
+    return _config_env
+
+
+def _load_config_source(path):
+    sources = _config_state.sources
+    source = sources(path)
+    if sources.decrypted:
+        config_bytecode_cache.skip(source)
+
+    return source
+
+
+class BytecodeCache(jinja2.FileSystemBytecodeCache):
+    """Jinja bytecode cache, in memory and on disk in cache_dir("jinja", name)
+
+    Compiled templates of sops decrypted sources contain plain text secrets
+    and are never written to disk.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.pattern = "%s.cache"
+        self.code = {}
+        self.skipped = set()
+        self.compiled = 0
+        self.reused = 0
+        self.lock = threading.Lock()
+
+    @property
+    def directory(self):
+        return str(cache_dir("jinja", self.name))
+
+    def skip(self, source):
+        """Never persist the compiled form of source"""
+        with self.lock:
+            self.skipped.add(self.get_source_checksum(source))
+
+    def load_bytecode(self, bucket):
+        with self.lock:
+            checksum, code = self.code.get(bucket.key, (None, None))
+
+        if checksum == bucket.checksum:
+            bucket.code = code
+        elif cache.enabled:
+            super().load_bytecode(bucket)
+
+        if bucket.code is not None:
+            with self.lock:
+                self.reused += 1
+                self.code[bucket.key] = (bucket.checksum, bucket.code)
+
+    def dump_bytecode(self, bucket):
+        with self.lock:
+            self.compiled += 1
+            self.code[bucket.key] = (bucket.checksum, bucket.code)
+            skip = bucket.checksum in self.skipped
+
+        if cache.enabled and not skip:
+            makedirs(self.directory)
+            super().dump_bytecode(bucket)
+
+    def stats(self):
+        return "{} templates: {} compiled, {} reused".format(
+            self.name, self.compiled, self.reused)
+
+
+# Compiled config templates
+config_bytecode_cache = BytecodeCache("config")
+
+
+class TemplateBytecodeCache(BytecodeCache):
+    """Bytecode cache for CloudFormation templates of all libraries
+
+    Remote libraries are unpacked to a new work_dir for every run, so
+    entries are keyed by template name and source instead of its filename,
+    which makes them shared by all stacks and runs using the same version
+    of a template. Cached code is relocated to the current filename.
+    The least recently used entries are removed once the cache on disk
+    exceeds max_size bytes.
+    """
+
+    def __init__(self, name, max_size):
+        super().__init__(name)
+        self.max_size = max_size
+
+    def get_bucket(self, environment, name, filename, source):
+        checksum = self.get_source_checksum(source)
+        key = hashlib.sha1("{}|{}".format(name, checksum).encode("utf-8")).hexdigest()
+
+        bucket = jinja2.bccache.Bucket(environment, key, checksum)
+        self.load_bytecode(bucket)
+        if bucket.code is not None and filename and bucket.code.co_filename != filename:
+            bucket.code = _relocate(bucket.code, filename)
+
+        return bucket
+
+    def load_bytecode(self, bucket):
+        super().load_bytecode(bucket)
+
+        # Keep track of use for the eviction
+        if bucket.code is not None and cache.enabled:
+            with contextlib.suppress(OSError):
+                os.utime(self._get_cache_filename(bucket))
+
+    def dump_bytecode(self, bucket):
+        super().dump_bytecode(bucket)
+        if cache.enabled:
+            self._evict()
+
+    def _evict(self):
+        entries = []
+        with os.scandir(self.directory) as it:
+            for e in it:
+                if e.name.endswith(".cache"):
+                    with contextlib.suppress(OSError):
+                        st = e.stat()
+                        entries.append((st.st_mtime, st.st_size, e.path))
+
+        size = sum(e[1] for e in entries)
+        for (_, entry_size, path) in sorted(entries):
+            if size <= self.max_size:
+                break
+            with contextlib.suppress(OSError):
+                os.remove(path)
+                logger.debug("Evicted {} from {} bytecode cache".format(path, self.name))
+            size -= entry_size
+
+
+def _relocate(code, filename):
+    """Returns code and all nested code objects pointing to filename"""
+    consts = tuple(
+        _relocate(c, filename) if isinstance(c, types.CodeType) else c
+        for c in code.co_consts
+    )
+    return code.replace(co_filename=filename, co_consts=consts)
+
+
+# Upper limit of compiled CloudFormation templates kept on disk
+TEMPLATE_CACHE_SIZE = 256 * 1024 * 1024
+
+template_bytecode_cache = TemplateBytecodeCache("cloudformation", TEMPLATE_CACHE_SIZE)
+
+
+def _digest(value):
+    if value is None:
+        return None
+    return hashlib.sha256(value.encode("utf-8", "surrogateescape")).hexdigest()
+
+
+def _environ_digest():
+    return _digest(repr(sorted(os.environ.items())))
+
+
+def _config_cache_key(path, variables):
+    h = hashlib.sha256()
+    for part in [
+        __version__,
+        str(path),
+        repr(variables),
+        str("DISABLE_SOPS" in os.environ),
+    ]:
+        h.update(part.encode("utf-8", "surrogateescape"))
+        h.update(b"\0")
+    with open(path, "rb") as f:
+        h.update(f.read())
+    return h.hexdigest()
+
+
+def _config_cache_valid(entry):
+    """Verifies all external inputs of a cached config file are unchanged"""
+    for k, digest in entry["env"].items():
+        if _digest(os.environ.get(k)) != digest:
+            return False
+
+    if entry["env_all"] and entry["env_all"] != _environ_digest():
+        return False
+
+    for path, digest in entry["files"].items():
+        try:
+            with open(path, "r") as f:
+                if _digest(f.read()) != digest:
+                    return False
+        except OSError:
+            return False
+
+    return True
+
+
+class _EnvRecorder(collections.abc.Mapping):
+    """Read-only view of os.environ, recording which variables were used"""
+
+    def __init__(self, environ):
+        self._environ = environ
+        self.used = set()
+        self.used_all = False
+
+    def __getitem__(self, key):
+        self.used.add(key)
+        return self._environ[key]
+
+    def __iter__(self):
+        self.used_all = True
+        return iter(self._environ)
+
+    def __len__(self):
+        self.used_all = True
+        return len(self._environ)
+
+
+class _ConfigSources(object):
+    """Jinja FunctionLoader for config files
+
+    Records each file loaded incl. includes, and whether any of them had to
+    be decrypted by sops.
+    """
+
+    def __init__(self):
+        self.files = {}
+        self.sources = {}
+        self.decrypted = False
+
+    def __call__(self, path):
+        path = str(path)
+        if path not in self.sources:
+            config_raw, decrypted = _read_config_source(path)
+            self.files[path] = _digest(config_raw)
+            if decrypted is not None:
+                self.decrypted = True
+                self.sources[path] = decrypted
+            else:
+                self.sources[path] = config_raw
+
+        return self.sources[path]
+
+
 def _sops_loader(path):
     """Tries to loads yaml file
     If "sops" key is detected the file is piped through sops before returned
     """
+    config_raw, decrypted = _read_config_source(path)
+    if decrypted is not None:
+        return decrypted
+
+    return config_raw
+
+
+def _read_config_source(path):
+    """Returns the raw file content and its sops decrypted form or None"""
     with open(path, "r") as f:
         config_raw = f.read()
 
-        try:
-            data = yaml.safe_load(config_raw)
-        except yaml.constructor.ConstructorError:
-            return config_raw
+    # sops always adds its metadata as top level key, no need to parse
+    if "DISABLE_SOPS" not in os.environ and _SOPS_KEY.search(config_raw):
+        return (config_raw, sops.decrypt(path, config_raw))
 
-        if data and "sops" in data and "DISABLE_SOPS" not in os.environ:
-            try:
-                result = subprocess.run(
-                    [
-                        "sops",
-                        "--input-type",
-                        "yaml",
-                        "--output-type",
-                        "yaml",
-                        "--decrypt",
-                        "/dev/stdin",
-                    ],
-                    stdout=subprocess.PIPE,
-                    input=config_raw.encode("utf-8"),
-                    env=dict(os.environ, **{"AWS_SDK_LOAD_CONFIG": "1"}),
-                )
-            except FileNotFoundError:
-                logger.exception(
-                    "SOPS encrypted config {},  but unable to find sops binary! Try eg: https://github.com/mozilla/sops/releases/download/v3.5.0/sops-v3.5.0.linux".format(
-                        path
-                    )
-                )
-                sys.exit(1)
-
-            return result.stdout.decode("utf-8")
-        else:
-            return config_raw
+    return (config_raw, None)
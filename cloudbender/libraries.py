@@ -9,6 +9,10 @@ from .utils import get_s3_url
 
 logger = logging.getLogger(__name__)
 
+# Fetched archives per (profile, region, url): (ETag, body), revalidated on
+# every fetch, so stacks sharing libraries, or a daemon, only download once
+archives = {}
+
 
 def fetch_library(conn, profile, region, url, version, dest_dir, root=None):
     """Resolve a Pulumi library to a local directory root.
@@ -22,7 +26,7 @@ def fetch_library(conn, profile, region, url, version, dest_dir, root=None):
     scheme = urllib.parse.urlparse(url).scheme
 
     if scheme == "local":
-        return _local_path(url, root)
+        return local_path(url, root)
 
     if scheme == "s3":
         archive_url = "{}-{}.tar.gz".format(url, version)
@@ -35,7 +39,7 @@ def fetch_library(conn, profile, region, url, version, dest_dir, root=None):
     )
 
 
-def _local_path(url, root=None):
+def local_path(url, root=None):
     """Return the directory referenced by a local:// URL.
 
     Relative paths resolve against root (the CloudBender project directory),
@@ -61,19 +65,24 @@ def _local_path(url, root=None):
 def _fetch_s3(conn, profile, region, archive_url, dest_dir):
     bucket, key = get_s3_url(archive_url)
 
+    kwargs = {"Bucket": bucket, "Key": key}
+    cached = archives.get((profile, region, archive_url))
+    if cached:
+        kwargs["IfNoneMatch"] = cached[0]
+
     try:
-        response = conn.call(
-            "s3",
-            "get_object",
-            {"Bucket": bucket, "Key": key},
-            profile=profile,
-            region=region,
-        )
+        response = conn.call("s3", "get_object", kwargs, profile=profile, region=region)
         body = response["Body"].read()
+        if response.get("ETag"):
+            archives[(profile, region, archive_url)] = (response["ETag"], body)
     except Exception as e:
-        raise FileNotFoundError(
-            "Could not fetch library s3://{}/{}: {}".format(bucket, key, e)
-        ) from None
+        if cached and _not_modified(e):
+            logger.debug("Library {} unchanged".format(archive_url))
+            body = cached[1]
+        else:
+            raise FileNotFoundError(
+                "Could not fetch library s3://{}/{}: {}".format(bucket, key, e)
+            ) from None
 
     name = pathlib.PurePosixPath(key).name.removesuffix(".tar.gz")
     lib_root = pathlib.Path(dest_dir) / name
@@ -83,6 +92,12 @@ def _fetch_s3(conn, profile, region, archive_url, dest_dir):
     return lib_root
 
 
+def _not_modified(e):
+    """True if e is S3's answer to a matching IfNoneMatch"""
+    response = getattr(e, "response", None) or {}
+    return response.get("ResponseMetadata", {}).get("HTTPStatusCode") == 304
+
+
 def _extract(body, lib_root, archive_url):
     lib_root.mkdir(parents=True, exist_ok=True)
     try:
@@ -0,0 +1,88 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Next to the rendered templates of each folder of template_path
+MANIFEST = ".manifest.json"
+
+# Loaded manifests per folder: (mtime, entries)
+_manifests = {}
+_lock = threading.Lock()
+
+
+def digest(value):
+    """Returns the sha256 of the JSON representation of value"""
+    return hashlib.sha256(
+        json.dumps(value, sort_keys=True, default=str).encode("utf-8")
+    ).hexdigest()
+
+
+def file_digests(paths):
+    """Returns the sha256 of the contents of all existing paths"""
+    digests = {}
+    for p in paths:
+        try:
+            with open(p, "rb") as f:
+                digests[p] = hashlib.sha256(f.read()).hexdigest()
+        except OSError:
+            pass
+
+    return digests
+
+
+def _load(folder):
+    """Returns the entries of the manifest in folder, re-read if the file
+    changed since we loaded it last time"""
+    path = os.path.join(folder, MANIFEST)
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except OSError:
+        return {}
+
+    cached = _manifests.get(folder)
+    if cached and cached[0] == mtime:
+        return cached[1]
+
+    try:
+        with open(path) as f:
+            entries = json.load(f)
+    except (OSError, ValueError) as e:
+        logger.debug("Ignoring manifest {}: {}".format(path, e))
+        entries = {}
+
+    _manifests[folder] = (mtime, entries)
+    return entries
+
+
+def get(folder, name):
+    """Returns the fingerprint recorded for template name in folder"""
+    with _lock:
+        return _load(folder).get(name)
+
+
+def update(folder, name, entry):
+    """Records entry for template name in folder, None removes it"""
+    with _lock:
+        entries = dict(_load(folder))
+        if entries.get(name) == entry:
+            return
+
+        if entry is None:
+            entries.pop(name)
+        else:
+            entries[name] = entry
+
+        path = os.path.join(folder, MANIFEST)
+        os.makedirs(folder, exist_ok=True)
+        (fd, tmp) = tempfile.mkstemp(dir=folder, prefix=MANIFEST)
+        with os.fdopen(fd, "w") as f:
+            json.dump(entries, f, indent=2, sort_keys=True)
+        os.replace(tmp, path)
+
+        _manifests[folder] = (os.stat(path).st_mtime_ns, entries)
@@ -5,15 +5,14 @@ import shutil
 import importlib
 import importlib.util
 import click
-import pulumi
 import subprocess
-import semver
 
 from functools import wraps
 
 import logging
 
 from . import __version__
+from . import timings
 
 logger = logging.getLogger(__name__)
 
@@ -36,6 +35,8 @@ def get_pulumi_version():
 
 
 def resolve_outputs(outputs):
+    import pulumi
+
     my_outputs = {}
 
     for k, v in outputs.items():
@@ -50,14 +51,26 @@ def resolve_outputs(outputs):
     return my_outputs
 
 
+class _NoError(Exception):
+    """Never raised, stands in for Pulumi errors of non Pulumi stacks"""
+
+
 def pulumi_ws(func):
     @wraps(func)
     def decorated(self, *args, **kwargs):
         # search paths we add for the import below, removed again on cleanup
         appended = []
 
+        # Pulumi is only imported for Pulumi stacks
+        CommandError = _NoError
+
         # setup temp workspace
         if self.mode == "pulumi":
+            import pulumi
+            import semver
+
+            CommandError = pulumi.automation.errors.CommandError
+
             # Fetch configured libraries (creates self.work_dir). pulumi_paths
             # holds the pulumi/ folders used for template discovery;
             # search_paths additionally exposes each library's artifacts/
@@ -206,9 +219,13 @@ def pulumi_ws(func):
             # self.pulumi_workspace = pulumi.automation.LocalWorkspace(self.pulumi_ws_opts)
 
         try:
-            response = func(self, *args, **kwargs)
+            if self.mode == "pulumi":
+                with timings.phase("pulumi", "{} {}".format(self.stackname, func.__name__)):
+                    response = func(self, *args, **kwargs)
+            else:
+                response = func(self, *args, **kwargs)
 
-        except pulumi.automation.errors.CommandError:
+        except CommandError:
             # Streamed operations already surface Pulumi's diagnostics via
             # on_output (_log_pulumi); drop the exception's duplicate stderr dump.
             if func.__name__ in ("create", "preview", "refresh", "delete"):
@@ -0,0 +1,193 @@
+import collections
+import copy
+import logging
+import multiprocessing
+import os
+import pickle
+
+from concurrent.futures import ProcessPoolExecutor
+
+from . import cache
+from . import timings
+from .jinja import pyminify_cache, template_bytecode_cache
+
+logger = logging.getLogger(__name__)
+
+# Stack attributes set by Stack.render, shipped back from the workers
+RESULTS = [
+    "cfn_template",
+    "cfn_data",
+    "md5",
+    "dependencies",
+    "hooks",
+    "template_files",
+    "loaded_libraries",
+    "policy_paths",
+    "fingerprint",
+    "refs",
+]
+
+# Cache statistics of the workers, added to our own
+COUNTERS = [
+    (template_bytecode_cache, ["compiled", "reused"]),
+    (pyminify_cache, ["hits", "misses"]),
+]
+
+
+def render_stacks(stacks, workers=1):
+    """Renders and writes the templates of all CloudFormation stacks
+
+    With workers > 1 the stacks are rendered by a pool of processes, as
+    rendering is CPU bound. Templates are still written and the logs of
+    the workers replayed in the order of stacks, so the outcome is the same
+    as rendering them one by one.
+
+    Stacks with the same render inputs, eg. the same stack in multiple
+    regions, are only rendered once and share the result.
+    """
+    # The first stack of each set of identical ones renders for all
+    keys = {id(s): s._render_key() for s in stacks if s.mode != "pulumi"}
+    first = {}
+    for s in stacks:
+        if id(s) in keys:
+            first.setdefault(keys[id(s)], s)
+    cfn = list(first.values())
+
+    pool = None
+    futures = {}
+    # Dependencies each rendered stack got from its template
+    rendered = {}
+    written = collections.Counter()
+    if workers > 1 and len(cfn) > 1:
+        # Forking while the config reader threads may hold locks is unsafe
+        pool = ProcessPoolExecutor(
+            max_workers=min(workers, len(cfn)),
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(
+                logging.getLogger("cloudbender").level,
+                logging.getLogger("botocore").level,
+                cache.enabled,
+                timings.enabled,
+            ),
+        )
+        futures = {id(s): pool.submit(_render_job, s) for s in cfn}
+
+    try:
+        for s in stacks:
+            if s.mode == "pulumi":
+                logger.info("{} uses Pulumi, render skipped.".format(s.stackname))
+                continue
+
+            leader = first[keys[id(s)]]
+            if leader is not s:
+                _reuse(s, leader, rendered[id(leader)])
+                logger.info("{} renders the same as {}, render reused.".format(
+                    os.path.join(s.rel_path, s.stackname), os.path.join(leader.rel_path, leader.stackname)))
+            else:
+                dependencies = set(s.dependencies)
+                if pool:
+                    _apply(s, futures[id(s)].result())
+                else:
+                    s.render()
+                rendered[id(s)] = s.dependencies - dependencies
+
+            written.update(s.write_template_file())
+
+    finally:
+        if pool:
+            pool.shutdown(cancel_futures=True)
+
+    if written:
+        logger.info(
+            "Templates: {written} written, {unchanged} unchanged, {uploaded} uploaded, {upload_unchanged} unchanged in S3".format_map(written))
+    logger.debug(template_bytecode_cache.stats())
+    logger.debug(pyminify_cache.stats())
+
+
+def _apply(stack, result):
+    """Replays the logs of a worker and applies its results to stack"""
+    (records, phases, counts, attributes, error) = result
+
+    for record in records:
+        logging.getLogger(record.name).handle(record)
+    timings.merge(phases)
+    for ((c, names), values) in zip(COUNTERS, counts):
+        for (name, value) in zip(names, values):
+            setattr(c, name, getattr(c, name) + value)
+
+    if error:
+        raise error
+
+    for k, v in attributes.items():
+        setattr(stack, k, v)
+
+
+def _reuse(stack, leader, dependencies):
+    """Applies the results of leader to stack, which has the same inputs,
+    dependencies are the ones leader got from its template
+
+    Stacks modify their results later on, eg. hooks, so nothing is shared.
+    """
+    own = stack.dependencies
+    for k in RESULTS:
+        setattr(stack, k, copy.deepcopy(getattr(leader, k)))
+
+    stack.dependencies = own | dependencies
+
+
+class _RecordingHandler(logging.Handler):
+    """Keeps all records of the current job to be replayed by the parent"""
+
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        # Arguments and tracebacks might not survive pickling
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        self.records.append(record)
+
+
+_handler = None
+
+
+def _init_worker(level, botocore_level, cache_enabled, timings_enabled):
+    global _handler
+
+    _handler = _RecordingHandler()
+    logging.getLogger("cloudbender").addHandler(_handler)
+    logging.getLogger("cloudbender").setLevel(level)
+    logging.getLogger("botocore").setLevel(botocore_level)
+
+    cache.enabled = cache_enabled
+    if timings_enabled:
+        timings.enable()
+
+
+def _render_job(stack):
+    _handler.records = []
+    before = _counts()
+
+    attributes = None
+    error = None
+    try:
+        stack.render()
+        attributes = {k: getattr(stack, k) for k in RESULTS}
+    except Exception as e:
+        error = e
+        try:
+            pickle.loads(pickle.dumps(error))
+        except Exception:
+            error = RuntimeError("{}: {}".format(type(e).__name__, e))
+
+    counts = [[v - b for (v, b) in zip(values, old)] for (values, old) in zip(_counts(), before)]
+    return (_handler.records, timings.collect(), counts, attributes, error)
+
+
+def _counts():
+    return [[getattr(c, name) for name in names] for (c, names) in COUNTERS]
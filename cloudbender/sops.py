@@ -0,0 +1,515 @@
+import os
+import re
+import sys
+import base64
+import decimal
+import hashlib
+import hmac
+import subprocess
+import tempfile
+import time
+import yaml
+
+from . import timings
+from .cache import FileCache, config_dir, makedirs
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Decrypted sops files, encrypted at rest, see decrypt
+sops_cache = FileCache("sops")
+
+# eg. via --no-sops-cache
+cache_enabled = True
+
+# Plain text must not outlive revoked KMS permissions forever
+CACHE_MAX_AGE = 24 * 3600
+
+
+def decrypt(path, config_raw):
+    """Returns the decrypted content of the sops encrypted config_raw
+
+    Results are cached keyed by the hash of the encrypted file so any change
+    to the file invalidates its entry. Entries are encrypted using AES-GCM
+    with a key derived from a local secret and the encrypted file itself,
+    so neither the cache nor the key file alone reveal any plain text.
+    """
+    with timings.phase("sops", path):
+        digest = hashlib.sha256(config_raw.encode("utf-8")).digest()
+
+        if cache_enabled:
+            plain = _cache_get(digest)
+            if plain is not None:
+                logger.debug("Using cached sops decryption for {}".format(path))
+                return plain
+
+        plain = _decrypt_age(config_raw)
+        if plain is not None:
+            logger.debug("Decrypted {} using age".format(path))
+            ok = True
+        else:
+            (plain, ok) = _decrypt_sops(path, config_raw)
+
+        if cache_enabled and ok:
+            _cache_set(digest, plain)
+
+        return plain
+
+
+def _decrypt_sops(path, config_raw):
+    """Pipes config_raw through sops, returns the output and if sops
+    succeeded"""
+    try:
+        result = subprocess.run(
+            [
+                "sops",
+                "--input-type",
+                "yaml",
+                "--output-type",
+                "yaml",
+                "--decrypt",
+                "/dev/stdin",
+            ],
+            stdout=subprocess.PIPE,
+            input=config_raw.encode("utf-8"),
+            env=dict(os.environ, **{"AWS_SDK_LOAD_CONFIG": "1"}),
+        )
+    except FileNotFoundError:
+        logger.exception(
+            "SOPS encrypted config {},  but unable to find sops binary! Try eg: https://github.com/mozilla/sops/releases/download/v3.5.0/sops-v3.5.0.linux".format(
+                path
+            )
+        )
+        sys.exit(1)
+
+    return (result.stdout.decode("utf-8"), result.returncode == 0)
+
+
+def _cache_key(digest):
+    return hashlib.sha256(b"sops-cache-v1\0" + digest).hexdigest()
+
+
+def _entry_key(digest):
+    """AES key for one cache entry derived from the local secret and the
+    hash of the encrypted file"""
+    return hmac.new(_local_secret(), digest, hashlib.sha256).digest()
+
+
+def _cache_get(digest):
+    entry = sops_cache.get(_cache_key(digest))
+    if not entry:
+        return None
+
+    if time.time() - entry["created"] > CACHE_MAX_AGE:
+        return None
+
+    try:
+        from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+        from cryptography.exceptions import InvalidTag
+
+        try:
+            plain = AESGCM(_entry_key(digest)).decrypt(
+                entry["nonce"], entry["data"], digest)
+        except InvalidTag:
+            logger.debug("Ignoring sops cache entry with invalid tag")
+            return None
+
+    except ImportError:
+        return None
+
+    return plain.decode("utf-8")
+
+
+def _cache_set(digest, plain):
+    try:
+        from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+    except ImportError:
+        logger.debug("cryptography not available, sops cache disabled")
+        return
+
+    nonce = os.urandom(12)
+    sops_cache.set(
+        _cache_key(digest),
+        {
+            "created": time.time(),
+            "nonce": nonce,
+            "data": AESGCM(_entry_key(digest)).encrypt(
+                nonce, plain.encode("utf-8"), digest),
+        },
+    )
+
+
+def _local_secret():
+    """Returns the local secret for the sops cache
+
+    Either $CLOUDBENDER_SOPS_CACHE_KEY or a random key generated once and
+    stored in the users config dir, outside of the cache itself.
+    """
+    secret = os.getenv("CLOUDBENDER_SOPS_CACHE_KEY")
+    if secret:
+        return hashlib.sha256(secret.encode("utf-8")).digest()
+
+    path = config_dir("sops-cache.key")
+    try:
+        with open(path, "rb") as f:
+            return f.read()
+    except FileNotFoundError:
+        pass
+
+    makedirs(path.parent)
+    fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=".tmp-")
+    with os.fdopen(fd, "wb") as f:
+        f.write(os.urandom(32))
+
+    # first one wins, never replace an existing key
+    try:
+        os.link(tmp, path)
+    except FileExistsError:
+        pass
+    finally:
+        os.unlink(tmp)
+
+    with open(path, "rb") as f:
+        return f.read()
+
+
+# In process decryption of sops files with age recipients, saves forking the
+# sops binary for every file. Whenever something is unexpected None is
+# returned and the caller falls back to the sops binary, which handles all
+# other key types (KMS, PGP, ...) as well.
+
+_ENC_VALUE = re.compile(
+    r"ENC\[AES256_GCM,data:(?P<data>[^,\]]*),iv:(?P<iv>[^,\]]*),"
+    r"tag:(?P<tag>[^,\]]*),type:(?P<type>[a-z]+)\]"
+)
+_ENC_SCALAR = re.compile(r"""(?P<quote>["']?)""" + _ENC_VALUE.pattern + r"(?P=quote)")
+# Strings sops emits as plain scalars, see _sops_scalar
+_PLAIN_STR = re.compile(r"[A-Za-z_/][A-Za-z0-9_./+=@-]*")
+_OLD_BOOLS = ["y", "Y", "n", "N"]
+_GO_INT = re.compile(r"-?(0|[1-9][0-9]*)")
+_SOPS_BLOCK = re.compile(r"^sops:[ \t]*\n(?:(?:[ \t].*|[ \t]*)(?:\n|$))*", re.MULTILINE)
+_LASTMODIFIED = re.compile(r"""^[ \t]+lastmodified:[ \t]*["']?([^"'\n]+)""", re.MULTILINE)
+
+_BECH32_CHARSET = "qpzry9x8gf2tvdw0s3jn54khce6mua7l"
+_AGE_INTRO = b"age-encryption.org/v1\n"
+_AGE_CHUNK_SIZE = 64 * 1024
+
+
+def _decrypt_age(config_raw):
+    """Returns the decrypted config_raw or None if we cannot decrypt it
+
+    The original layout is kept and only the encrypted values and the sops
+    metadata are replaced. That equals the output of sops byte by byte for
+    files written by sops as long as every value is emitted the way sops
+    does, anything else is left to the sops binary.
+    """
+    try:
+        from cryptography.exceptions import InvalidTag
+    except ImportError:
+        return None
+
+    try:
+        data = yaml.safe_load(config_raw)
+        metadata = data["sops"]
+        if not metadata.get("age") or metadata.get("key_groups"):
+            return None
+
+        identities = _age_identities()
+        if not identities:
+            return None
+
+        data_key = None
+        for recipient in metadata["age"]:
+            data_key = _age_decrypt(_age_dearmor(recipient["enc"]), identities)
+            if data_key:
+                break
+        else:
+            return None
+
+        values = _decrypt_tree(data, data_key, metadata, config_raw)
+        if values is None:
+            return None
+
+        def _scalar(m):
+            # sops never quotes encrypted values
+            if m.group("quote"):
+                raise ValueError("Quoted value {}".format(m.group(0)))
+            return _sops_scalar(*values[m.group(0)])
+
+        return _ENC_SCALAR.sub(_scalar, _SOPS_BLOCK.sub("", config_raw))
+
+    except (InvalidTag, ValueError, KeyError, TypeError, AttributeError, yaml.YAMLError) as e:
+        logger.debug("Unable to decrypt sops file in process: {}".format(e))
+        return None
+
+
+def _sops_scalar(_type, plain):
+    """Returns the decrypted value as sops emits it
+
+    Raises ValueError for any value sops might emit differently, eg. strings
+    which need quoting or folding.
+    """
+    if _type == "comment":
+        return plain
+    if _type == "str" and _PLAIN_STR.fullmatch(plain) and plain not in _OLD_BOOLS and yaml.safe_load(plain) == plain:
+        return plain
+    if _type == "int" and _GO_INT.fullmatch(plain):
+        return plain
+    if _type == "bool" and plain in ("True", "False"):
+        return plain.lower()
+    if _type == "float":
+        return _go_float(plain)
+
+    raise ValueError("Unable to emit {} value like sops".format(_type))
+
+
+def _go_float(plain):
+    """Go strconv.FormatFloat(f, 'g', -1, 64) as used by sops to emit floats"""
+    value = decimal.Decimal(repr(float(plain)))
+    if not value.is_finite():
+        raise ValueError("Unable to emit {} like sops".format(plain))
+
+    (sign, digits, exp) = value.normalize().as_tuple()
+    digits = "".join(str(d) for d in digits)
+    # position of the decimal point relative to the digits
+    point = len(digits) + exp
+    sign = "-" if sign else ""
+
+    if not -4 <= point - 1 < 6:
+        mantissa = digits[0] + ("." + digits[1:] if len(digits) > 1 else "")
+        return "{}{}e{}{:02d}".format(sign, mantissa, "-" if point < 1 else "+", abs(point - 1))
+    if point <= 0:
+        return "{}0.{}{}".format(sign, "0" * -point, digits)
+    if point >= len(digits):
+        return sign + digits + "0" * (point - len(digits))
+    return "{}{}.{}".format(sign, digits[:point], digits[point:])
+
+
+def _decrypt_tree(data, data_key, metadata, config_raw):
+    """Decrypts all ENC[] values and verifies the sops MAC
+
+    Returns a dict of each ENC[] token to its type and plain text, None if
+    the MAC does not match or a value type is not supported.
+    """
+    mac_only_encrypted = metadata.get("mac_only_encrypted", False)
+    mac = hashlib.sha512()
+    values = {}
+
+    # sops walks the tree in document order, list items share the path of
+    # their parent. Comments are encrypted with the path of their branch.
+    branches = [":"]
+
+    def _walk(node, path):
+        if isinstance(node, dict):
+            for k, v in node.items():
+                if not path and k == "sops":
+                    continue
+                branches.append(":".join(path + [str(k)]) + ":")
+                _walk(v, path + [str(k)])
+        elif isinstance(node, list):
+            for v in node:
+                _walk(v, path)
+        elif node is not None:
+            m = _ENC_VALUE.fullmatch(node) if isinstance(node, str) else None
+            if m:
+                values[node] = _decrypt_value(m, data_key, ":".join(path) + ":")
+                mac.update(values[node][1].encode("utf-8"))
+            elif not mac_only_encrypted:
+                mac.update(_mac_bytes(node))
+
+    _walk(data, [])
+
+    if any(_type not in ("str", "int", "float", "bool") for (_type, plain) in values.values()):
+        return None
+
+    # Comments are not part of the parsed tree
+    for m in _ENC_VALUE.finditer(config_raw):
+        if m.group("type") == "comment" and m.group(0) not in values:
+            values[m.group(0)] = _decrypt_comment(m, data_key, branches)
+
+    (_type, their_mac) = _decrypt_value(
+        _ENC_VALUE.fullmatch(metadata["mac"]),
+        data_key,
+        _LASTMODIFIED.search(config_raw.split("\nsops:", 1)[-1]).group(1),
+    )
+    if not hmac.compare_digest(mac.hexdigest().upper(), their_mac):
+        logger.debug("sops MAC mismatch")
+        return None
+
+    return values
+
+
+def _decrypt_value(m, data_key, aad):
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+    plain = AESGCM(data_key).decrypt(
+        base64.b64decode(m.group("iv")),
+        base64.b64decode(m.group("data")) + base64.b64decode(m.group("tag")),
+        aad.encode("utf-8"),
+    )
+    return (m.group("type"), plain.decode("utf-8"))
+
+
+def _decrypt_comment(m, data_key, branches):
+    from cryptography.exceptions import InvalidTag
+
+    for aad in branches:
+        try:
+            return _decrypt_value(m, data_key, aad)
+        except InvalidTag:
+            pass
+
+    raise ValueError("Unable to decrypt comment")
+
+
+def _mac_bytes(value):
+    """Plain values as sops feeds them into the MAC"""
+    if isinstance(value, bool):
+        return str(value).encode("utf-8")
+    if isinstance(value, int):
+        return str(value).encode("utf-8")
+    if isinstance(value, float):
+        # Go strconv.FormatFloat(f, 'f', -1, 64)
+        value = format(decimal.Decimal(repr(value)), "f")
+        if "." in value:
+            value = value.rstrip("0").rstrip(".")
+        return value.encode("utf-8")
+    if isinstance(value, str):
+        return value.encode("utf-8")
+
+    raise TypeError("Unsupported value {}".format(type(value)))
+
+
+def _age_identities():
+    """Returns the X25519 private keys of all age identities sops would use"""
+    keys = os.getenv("SOPS_AGE_KEY", "")
+
+    key_file = os.getenv("SOPS_AGE_KEY_FILE")
+    if not key_file:
+        key_file = os.path.join(
+            os.getenv("XDG_CONFIG_HOME") or os.path.expanduser("~/.config"),
+            "sops",
+            "age",
+            "keys.txt",
+        )
+    try:
+        with open(key_file) as f:
+            keys += "\n" + f.read()
+    except OSError:
+        pass
+
+    identities = []
+    for line in keys.splitlines():
+        line = line.strip()
+        if line.startswith("AGE-SECRET-KEY-1"):
+            identities.append(_bech32_decode(line, "age-secret-key-"))
+
+    return identities
+
+
+def _bech32_decode(s, hrp):
+    s = s.lower()
+    pos = s.rfind("1")
+    if s[:pos] != hrp:
+        raise ValueError("Invalid age identity")
+
+    data = [_BECH32_CHARSET.index(c) for c in s[pos + 1:]]
+
+    # verify checksum
+    chk = 1
+    for v in [ord(c) >> 5 for c in hrp] + [0] + [ord(c) & 31 for c in hrp] + data:
+        b = chk >> 25
+        chk = (chk & 0x1FFFFFF) << 5 ^ v
+        for i, g in enumerate([0x3B6A57B2, 0x26508E6D, 0x1EA119FA, 0x3D4233DD, 0x2A1462B3]):
+            chk ^= g if ((b >> i) & 1) else 0
+    if chk != 1:
+        raise ValueError("Invalid age identity checksum")
+
+    # 5 to 8 bit groups
+    acc = bits = 0
+    key = bytearray()
+    for v in data[:-6]:
+        acc = (acc << 5) | v
+        bits += 5
+        if bits >= 8:
+            bits -= 8
+            key.append((acc >> bits) & 0xFF)
+
+    return bytes(key)
+
+
+def _age_dearmor(enc):
+    lines = enc.strip().splitlines()
+    if lines[0] != "-----BEGIN AGE ENCRYPTED FILE-----" or lines[-1] != "-----END AGE ENCRYPTED FILE-----":
+        raise ValueError("Invalid age armor")
+
+    return base64.b64decode("".join(line.strip() for line in lines[1:-1]))
+
+
+def _b64_raw(s):
+    return base64.b64decode(s + "=" * (-len(s) % 4))
+
+
+def _age_decrypt(payload, identities):
+    """Decrypts an age file for one of the X25519 identities, returns None
+    if none of the identities is a recipient"""
+    from cryptography.hazmat.primitives import hashes, hmac as crypto_hmac
+    from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey, X25519PublicKey
+    from cryptography.hazmat.primitives.ciphers.aead import ChaCha20Poly1305
+    from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+    from cryptography.hazmat.primitives.serialization import Encoding, PublicFormat
+    from cryptography.exceptions import InvalidTag
+
+    def _hkdf(key, salt, info):
+        return HKDF(algorithm=hashes.SHA256(), length=32, salt=salt, info=info).derive(key)
+
+    if not payload.startswith(_AGE_INTRO):
+        raise ValueError("Unsupported age version")
+
+    # Header: stanzas "-> type args\nbody" until the "--- mac" line
+    (header, payload) = payload.split(b"\n--- ", 1)
+    (mac, payload) = payload.split(b"\n", 1)
+    stanzas = []
+    for line in header[len(_AGE_INTRO):].split(b"\n"):
+        if line.startswith(b"-> "):
+            stanzas.append((line[3:].split(b" "), b""))
+        else:
+            stanzas[-1] = (stanzas[-1][0], stanzas[-1][1] + line)
+
+    file_key = None
+    for identity in identities:
+        private_key = X25519PrivateKey.from_private_bytes(identity)
+        public = private_key.public_key().public_bytes(Encoding.Raw, PublicFormat.Raw)
+        for (args, body) in stanzas:
+            if args[0] != b"X25519":
+                continue
+            ephemeral = _b64_raw(args[1].decode())
+            shared = private_key.exchange(X25519PublicKey.from_public_bytes(ephemeral))
+            wrap_key = _hkdf(shared, ephemeral + public, b"age-encryption.org/v1/X25519")
+            try:
+                file_key = ChaCha20Poly1305(wrap_key).decrypt(
+                    b"\0" * 12, _b64_raw(body.decode()), None)
+                break
+            except InvalidTag:
+                pass
+        if file_key:
+            break
+    else:
+        return None
+
+    h = crypto_hmac.HMAC(_hkdf(file_key, b"", b"header"), hashes.SHA256())
+    h.update(header + b"\n---")
+    h.verify(_b64_raw(mac.decode()))
+
+    # Payload: 16 byte nonce, STREAM of 64k chunks
+    key = ChaCha20Poly1305(_hkdf(file_key, payload[:16], b"payload"))
+    payload = payload[16:]
+    chunk_size = _AGE_CHUNK_SIZE + 16
+    plain = b""
+    for i in range(0, max(len(payload), 1), chunk_size):
+        last = i + chunk_size >= len(payload)
+        nonce = (i // chunk_size).to_bytes(11, "big") + (b"\1" if last else b"\0")
+        plain += key.decrypt(nonce, payload[i:i + chunk_size], None)
+
+    return plain
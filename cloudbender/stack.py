@@ -8,36 +8,27 @@ import shutil
 import tempfile
 import pathlib
 import pprint
+import atexit
+import threading
 import jinja2
-import pulumi
-import importlib
+import importlib.resources
 
-from datetime import datetime, timedelta
-from dateutil.tz import tzutc
-from packaging.version import Version
-
-from botocore.exceptions import ClientError
-
-import ruamel.yaml
-
-import rich.console
-import rich.table
+from datetime import datetime, timedelta, timezone
 
 import typing
-from pydantic import BaseModel
 
-from .utils import dict_merge, search_refs, ensure_dir, get_s3_url
+from .utils import dict_merge, thaw, template_metadata, ensure_dir, get_s3_url
 from .connection import BotoConnection
-from .jinja import JinjaEnv, read_config_file, render_docs
+from .jinja import JinjaEnv, read_config_file, render_docs, record_template_files, record_config_files
 from . import __version__
+from . import cache
+from . import manifest
+from . import timings
 from .exceptions import ParameterNotFound, ParameterIllegalValue, ChecksumError
 from .hooks import exec_hooks
-from .libraries import fetch_library
+from .libraries import fetch_library, local_path
 from .pulumi import pulumi_ws, resolve_outputs
 
-import cfnlint.core
-import cfnlint.template
-
 from . import templates
 
 import logging
@@ -45,8 +36,15 @@ import logging
 logger = logging.getLogger(__name__)
 
 
+# Parsing large templates is a lot faster with libyaml, if available
+try:
+    _SafeLoader = yaml.CSafeLoader
+except AttributeError:
+    _SafeLoader = yaml.SafeLoader
+
+
 # Ignore any !<Constructors> during re-loading of CFN templates
-class SafeLoaderIgnoreUnknown(yaml.SafeLoader):
+class SafeLoaderIgnoreUnknown(_SafeLoader):
     def ignore_unknown(self, node):
         return node.tag
 
@@ -55,6 +53,102 @@ SafeLoaderIgnoreUnknown.add_constructor(
     None, SafeLoaderIgnoreUnknown.ignore_unknown)
 
 
+# Keeps everything needed to write CFN templates as JSON: short form
+# intrinsic functions turn into their long form, numbers and timestamps
+# YAML would read differently than written stay strings
+class IntrinsicLoader(_SafeLoader):
+    def construct_intrinsic(self, tag, node):
+        if isinstance(node, yaml.ScalarNode):
+            value = self.construct_scalar(node)
+            if tag == "GetAtt":
+                value = value.split(".", 1)
+        elif isinstance(node, yaml.SequenceNode):
+            value = self.construct_sequence(node, deep=True)
+        else:
+            value = self.construct_mapping(node, deep=True)
+
+        if tag not in ["Ref", "Condition"]:
+            tag = "Fn::" + tag
+        return {tag: value}
+
+    def construct_number(self, node):
+        value = _SafeLoader.yaml_constructors[node.tag](self, node)
+        if json.dumps(value) == node.value:
+            return value
+        return node.value
+
+
+IntrinsicLoader.add_multi_constructor("!", IntrinsicLoader.construct_intrinsic)
+IntrinsicLoader.add_constructor("tag:yaml.org,2002:int", IntrinsicLoader.construct_number)
+IntrinsicLoader.add_constructor("tag:yaml.org,2002:float", IntrinsicLoader.construct_number)
+IntrinsicLoader.add_constructor("tag:yaml.org,2002:timestamp", IntrinsicLoader.construct_scalar)
+
+
+def _requires_cloudbender(template):
+    """Whether the template uses the CloudBender transform, which is kept
+    in the post-processed template as well"""
+    return "CloudBender::" in template or "Iterate:" in template
+
+
+def _uses_cloudbender(data):
+    """Whether the parsed template uses the CloudBender transform, same as
+    _requires_cloudbender for YAML as well as JSON templates"""
+    if not isinstance(data, dict):
+        return False
+
+    transform = data.get("Transform", [])
+    if "CloudBender" in (transform if isinstance(transform, list) else [transform]):
+        return True
+
+    todo = [data]
+    while todo:
+        node = todo.pop()
+        if isinstance(node, dict):
+            if "Iterate" in node:
+                return True
+            todo.extend(node.keys())
+            todo.extend(node.values())
+        elif isinstance(node, list):
+            todo.extend(node)
+        elif isinstance(node, str) and "CloudBender::" in node:
+            return True
+
+    return False
+
+
+# Jinja environments shared by all stacks using the same libraries, see
+# Stack._template_env
+_template_envs = {}
+_template_envs_lock = threading.Lock()
+
+
+def reset_template_envs():
+    """Drops all shared Jinja environments and their fetched libraries"""
+    with _template_envs_lock:
+        for (jenv, loaded_libraries, library_roots, policy_paths, work_dir) in _template_envs.values():
+            shutil.rmtree(work_dir, ignore_errors=True)
+        _template_envs.clear()
+
+
+atexit.register(reset_template_envs)
+
+
+def template_library_paths():
+    """Returns the folders of the local libraries of all shared Jinja
+    environments
+
+    Their loaders only see files added there after reset_template_envs(),
+    remote libraries never change for the version they were fetched with.
+    """
+    with _template_envs_lock:
+        return sorted({
+            path
+            for (jenv, loaded_libraries, library_roots, policy_paths, work_dir) in _template_envs.values()
+            for (ref, path) in library_roots
+            if ref.startswith("local://")
+        })
+
+
 class Stack(object):
     def __init__(self, name, template, path, rel_path, ctx):
         self.stackname = name
@@ -104,6 +198,11 @@ class Stack(object):
         self.libraries = []
         self.policy_paths = []
         self.loaded_libraries = []
+        self.template_files = set()
+        self.config_includes = set()
+        self.library_roots = []
+        self.fingerprint = None
+        self.refs = []
 
     def dump_config(self):
         logger.debug(
@@ -111,19 +210,21 @@ class Stack(object):
                 self.id, pprint.pformat(
                     vars(self))))
 
-    def read_config(self, sg_config={}):
-        """reads stack config"""
+    def read_config(self, sg_config={}, decrypted=False):
+        """reads stack config, decrypted if sg_config holds values decrypted
+        by sops"""
 
         # First set various attributes based on parent stackgroup config
-        self.tags.update(sg_config.get("tags", {}))
-        self.parameters.update(sg_config.get("parameters", {}))
-        self.options.update(sg_config.get("options", {}))
-        self.pulumi.update(sg_config.get("pulumi", {}))
+        # sg_config is shared read-only, so get our own mutable copies
+        self.tags.update(thaw(sg_config.get("tags", {})))
+        self.parameters.update(thaw(sg_config.get("parameters", {})))
+        self.options.update(thaw(sg_config.get("options", {})))
+        self.pulumi.update(thaw(sg_config.get("pulumi", {})))
 
         # by default inherit parent group settings
         for p in ["region", "notfication_sns", "template_bucket_url", "libraries"]:
             if p in sg_config:
-                setattr(self, p, sg_config[p])
+                setattr(self, p, thaw(sg_config[p]))
 
         # profile and region need special treatment due to cmd line overwrite
         # option
@@ -139,7 +240,9 @@ class Stack(object):
                 self.profile = "default"
 
         # now override stack specific settings
-        _config = read_config_file(self.path, sg_config.get("variables", {}))
+        with record_config_files() as includes:
+            _config = read_config_file(self.path, sg_config.get("variables", {}), decrypted)
+        self.config_includes.update(includes)
         for p in [
             "region",
             "stackname",
@@ -208,16 +311,18 @@ class Stack(object):
 
         logger.debug("Stack {} added.".format(self.id))
 
-    def _fetch_libraries(self):
-        """Fetch all configured libraries into a fresh work_dir.
+    def _fetch_libraries(self, dest_dir=None):
+        """Fetch all configured libraries into dest_dir or a fresh work_dir.
 
         Returns a dict of path buckets (pulumi, cloudformation, artifacts,
         policies), each listing the matching sub-folders across libraries in
         config order. The caller owns the work_dir lifecycle (cleanup).
         """
-        self.work_dir = tempfile.mkdtemp(
-            dir=tempfile.gettempdir(), prefix="cloudbender-"
-        )
+        if not dest_dir:
+            self.work_dir = tempfile.mkdtemp(
+                dir=tempfile.gettempdir(), prefix="cloudbender-"
+            )
+            dest_dir = self.work_dir
 
         paths = {
             "pulumi": [],
@@ -226,20 +331,22 @@ class Stack(object):
             "policies": [],
         }
         self.loaded_libraries = []
+        self.library_roots = []
 
         for lib in self.libraries:
             version = lib.get("version", "latest")
 
             try:
-                lib_root = fetch_library(
-                    self.connection_manager,
-                    self.profile,
-                    self.region,
-                    lib["url"],
-                    version,
-                    self.work_dir,
-                    root=self.ctx["root"],
-                )
+                with timings.phase("libraries", lib["url"]):
+                    lib_root = fetch_library(
+                        self.connection_manager,
+                        self.profile,
+                        self.region,
+                        lib["url"],
+                        version,
+                        dest_dir,
+                        root=self.ctx["root"],
+                    )
 
             # optional libs may be absent or unreachable; skip on any failure
             # to fetch/resolve them, otherwise surface the error
@@ -262,14 +369,63 @@ class Stack(object):
             else:
                 ref = "{}@{}".format(lib["url"], version)
             self.loaded_libraries.append(ref)
+            self.library_roots.append((ref, str(lib_root)))
             logger.info("Loaded library {}".format(ref))
 
         self.policy_paths = paths["policies"]
 
         return paths
 
+    def _template_env(self):
+        """Returns the Jinja environment for the templates of our libraries
+
+        Environments are shared by all stacks using the same libraries, so
+        each library is fetched and every template compiled only once per
+        run. Remote libraries are fetched per profile and region.
+        """
+        key = [self.ctx["root"]] + [
+            (lib["url"], lib.get("version", "latest"), bool(lib.get("optional")))
+            for lib in self.libraries
+        ]
+        if any(not lib["url"].startswith("local://") for lib in self.libraries):
+            key += [self.profile, self.region]
+        key = repr(key)
+
+        with _template_envs_lock:
+            if key not in _template_envs:
+                work_dir = tempfile.mkdtemp(
+                    dir=tempfile.gettempdir(), prefix="cloudbender-"
+                )
+                try:
+                    paths = self._fetch_libraries(work_dir)
+                except BaseException:
+                    shutil.rmtree(work_dir, ignore_errors=True)
+                    raise
+
+                # CloudFormation jinja templates and their included assets
+                # come from each library's cloudformation/ and artifacts/
+                jenv = JinjaEnv(paths["cloudformation"] + paths["artifacts"])
+                _template_envs[key] = (
+                    jenv, self.loaded_libraries, self.library_roots, self.policy_paths, work_dir)
+
+            else:
+                (jenv, self.loaded_libraries, self.library_roots, self.policy_paths,
+                 work_dir) = _template_envs[key]
+                for ref in self.loaded_libraries:
+                    logger.info("Loaded library {}".format(ref))
+
+        return jenv
+
     def render(self):
-        """Renders the cfn jinja template for this stack"""
+        """Renders the cfn jinja template for this stack
+
+        Skipped if the existing output was rendered from the very same
+        inputs, see _render_inputs.
+        """
+        inputs = self._render_inputs()
+        if inputs and self._read_unchanged(inputs):
+            logger.info("{} unchanged, render skipped.".format(self.stackname))
+            return
 
         template_metadata = {
             "Template.Name": self.template,
@@ -282,13 +438,20 @@ class Stack(object):
             "metadata": template_metadata,
         }
 
-        try:
-            # CloudFormation jinja templates and their included assets come
-            # from each library's cloudformation/ and artifacts/ folders
-            paths = self._fetch_libraries()
-            jenv = JinjaEnv(paths["cloudformation"] + paths["artifacts"])
-            jenv.globals["_config"] = _config
+        jenv = self._template_env()
+        # Stacks are rendered one at a time per process, option() needs
+        # _config in the globals of imported macros too
+        jenv.globals["_config"] = _config
+
+        # Imported templates keep their module, rendered with the globals of
+        # the first stack importing them
+        if jenv.cache is not None:
+            for cached in jenv.cache.values():
+                cached._module = None
 
+        # Remember all files the template depends on, even if rendering
+        # fails, see render --watch
+        with record_template_files() as self.template_files:
             try:
                 template = jenv.get_template(
                     "{0}{1}".format(
@@ -302,46 +465,172 @@ class Stack(object):
 
             logger.info("Rendering %s", template.filename)
 
-            try:
+            with timings.phase("render", self.stackname):
                 self.cfn_template = template.render(_config)
-                self.cfn_data = yaml.load(
-                    self.cfn_template,
-                    Loader=SafeLoaderIgnoreUnknown)
-            except Exception as e:
-                # In case we rendered invalid yaml this helps to debug
-                if self.cfn_template:
-                    _output = ""
-                    for i, line in enumerate(
-                            self.cfn_template.splitlines(), start=1):
-                        _output = _output + "{}: {}\n".format(i, line)
-                    logger.error(_output)
-                raise e
 
-        finally:
-            if self.work_dir and os.path.exists(self.work_dir):
-                shutil.rmtree(self.work_dir)
+        with timings.phase("postprocess", self.stackname):
+            self._post_process()
+
+        if inputs:
+            self.fingerprint = {
+                "inputs": inputs,
+                "files": {
+                    self._file_key(path): d
+                    for (path, d) in manifest.file_digests(self.template_files).items()
+                },
+                "listing": self._local_listing(),
+                "refs": self.refs,
+            }
+
+    def _render_inputs(self):
+        """Returns the digest of all inputs of render, but the template
+        files, or None if the rendered template must never be reused
+
+        Remote libraries are identified by url and version, so their
+        templates are only trusted for versions other than latest.
+        """
+        if not cache.enabled:
+            return None
+
+        for lib in self.libraries:
+            if not lib["url"].startswith("local://") and lib.get("version", "latest") == "latest":
+                return None
+
+        return self._render_key()
+
+    def _render_key(self):
+        """Returns the digest of all inputs of render, stacks with the same
+        one render the very same template"""
+        return manifest.digest(
+            {
+                "version": __version__,
+                "template": self.template,
+                "mode": self.mode,
+                "options": self.options,
+                "libraries": [[lib["url"], lib.get("version", "latest")] for lib in self.libraries],
+            }
+        )
+
+    def _read_unchanged(self, inputs):
+        """Loads the existing output if the manifest proves it was rendered
+        from inputs and the same template files"""
+        yaml_file = os.path.join(
+            self.ctx["template_path"], self.rel_path, self.stackname + ".yaml"
+        )
+        entry = manifest.get(os.path.dirname(yaml_file), os.path.basename(yaml_file))
+        if not entry or entry["inputs"] != inputs:
+            return False
+
+        # Files of remote libraries are identified by url and version
+        # already, see _render_inputs
+        root = os.path.realpath(self.ctx["root"])
+        files = {
+            os.path.join(root, k): v for (k, v) in entry["files"].items() if "://" not in k
+        }
+        if manifest.file_digests(files) != files:
+            return False
+
+        # A new file might take precedence over the ones used
+        if entry.get("listing") != self._local_listing():
+            return False
+
+        try:
+            with open(yaml_file) as f:
+                cfn_template = f.read()
+        except OSError:
+            return False
+
+        if not re.search('(Hash: |"Hash":"){}'.format(entry["md5"]), cfn_template):
+            return False
 
-        if not re.search("CloudBender::", self.cfn_template) and not re.search(
-            "Iterate:", self.cfn_template
-        ):
+        self.cfn_template = cfn_template
+        self.cfn_data = yaml.load(self.cfn_template, Loader=SafeLoaderIgnoreUnknown)
+        if _uses_cloudbender(self.cfn_data):
+            self.dependencies.add("CloudBender")
+
+        # The remote references found when rendering, JSON templates hold
+        # short form intrinsic functions in their long form
+        (refs, dependencies, hooks) = template_metadata(self.cfn_data, self.mode)
+        self._parse_metadata((entry.get("refs", refs), dependencies, hooks))
+
+        self.template_files = set(files)
+        self.fingerprint = {
+            "inputs": inputs,
+            "files": entry["files"],
+            "listing": entry["listing"],
+            "refs": self.refs,
+        }
+        return True
+
+    def _file_key(self, path):
+        """Returns how path is recorded in the manifest, which has to stay
+        the same across checkouts and runs
+
+        Files of remote libraries are keyed by url@version and their name
+        in the library, all others relative to the project root if below
+        it.
+        """
+        for (ref, lib_root) in self.library_roots:
+            if "://" in ref and not ref.startswith("local://") and path.startswith(lib_root + os.sep):
+                return "{}/{}".format(ref, os.path.relpath(path, lib_root).replace(os.sep, "/"))
+
+        root = os.path.realpath(self.ctx["root"])
+        path = os.path.realpath(path)
+        if path.startswith(root + os.sep):
+            return os.path.relpath(path, root).replace(os.sep, "/")
+        return path
+
+    def _local_listing(self):
+        """Returns the digest of the names of all files in the template
+        folders of local libraries"""
+        names = []
+        for lib in self.libraries:
+            if not lib["url"].startswith("local://"):
+                continue
+            try:
+                lib_root = local_path(lib["url"], self.ctx["root"])
+            except FileNotFoundError:
+                names.append([lib["url"], None])
+                continue
+
+            for sub in ["cloudformation", "artifacts"]:
+                for (dirpath, dirs, files) in os.walk(lib_root / sub):
+                    dirs.sort()
+                    names.extend(
+                        [lib["url"], os.path.relpath(os.path.join(dirpath, f), lib_root)]
+                        for f in sorted(files))
+
+        return manifest.digest(names)
+
+    def _post_process(self):
+        """Applies the CloudBender specific changes to the rendered template
+
+        The template is only parsed once, after the changes which depend
+        on the text alone. Changes depending on the parsed template are
+        applied to both the text and the parsed data, apart from adding
+        the Piped mode parameters which requires parsing again.
+        """
+        if not _requires_cloudbender(self.cfn_template):
             logger.info(
                 "CloudBender not required -> removing Transform and Conglomerate parameter"
             )
             self.cfn_template = self.cfn_template.replace(
                 "Transform: [CloudBender]", ""
-            )
-
-            _res = """
+            ).replace(
+                """
   Conglomerate:
     Type: String
     Description: Project / Namespace this stack is part of
-"""
-            self.cfn_template = re.sub(_res, "", self.cfn_template)
+""",
+                "",
+            )
         else:
             self.dependencies.add("CloudBender")
 
-        include = []
-        search_refs(self.cfn_data, include, self.mode)
+        self.cfn_data = self._load_rendered()
+
+        metadata = template_metadata(self.cfn_data, self.mode)
+        include = metadata[0]
         if self.mode == "Piped" and len(include):
             _res = ""
             for attr in include:
@@ -361,10 +650,8 @@ class Stack(object):
             logger.info(
                 "Piped mode: Added parameters for remote stack references")
 
-        # Re-read updated template
-        self.cfn_data = yaml.load(
-            self.cfn_template,
-            Loader=SafeLoaderIgnoreUnknown)
+            # Re-read updated template
+            self.cfn_data = self._load_rendered()
 
         # Check for empty top level Parameters, Outputs and Conditions and
         # remove
@@ -375,24 +662,49 @@ class Stack(object):
                     "\n" + key + ":", "")
 
         # Remove and condense multiple empty lines
-        self.cfn_template = re.sub(r"\n\s*\n", "\n\n", self.cfn_template)
-        self.cfn_template = re.sub(r"^\s*", "", self.cfn_template)
-        self.cfn_template = re.sub(r"\s*$", "", self.cfn_template)
+        self.cfn_template = re.sub(r"\n\s*\n", "\n\n", self.cfn_template).strip()
+
+        # Minified JSON is still valid YAML, so everything reading rendered
+        # templates keeps working
+        if self.options.get("TemplateFormat", "yaml") == "json":
+            self.cfn_data = yaml.load(self.cfn_template, Loader=IntrinsicLoader)
+            try:
+                self.cfn_template = json.dumps(self.cfn_data, separators=(",", ":"))
+            except TypeError as e:
+                raise ValueError(
+                    "Cannot write {} as JSON template: {}".format(self.stackname, e)) from None
 
         # set md5 last
         self.md5 = hashlib.md5(self.cfn_template.encode("utf-8")).hexdigest()
         self.cfn_template = self.cfn_template.replace("__HASH__", self.md5)
 
-        # Update internal data structures
-        self._parse_metadata()
+        # Update internal data structures, the added parameters hold no
+        # references so metadata is still complete. JSON templates keep the
+        # metadata of their YAML form, see _read_unchanged.
+        self._parse_metadata(metadata)
 
-    def _parse_metadata(self):
-        # Extract dependencies
+    def _load_rendered(self):
         try:
-            for dep in self.cfn_data["Metadata"]["CloudBender"]["Dependencies"]:
-                self.dependencies.add(dep)
-        except KeyError:
-            pass
+            return yaml.load(
+                self.cfn_template,
+                Loader=SafeLoaderIgnoreUnknown)
+        except Exception as e:
+            # In case we rendered invalid yaml this helps to debug
+            logger.error("".join(
+                "{}: {}\n".format(i, line)
+                for i, line in enumerate(self.cfn_template.splitlines(), start=1)))
+            raise e
+
+    def _parse_metadata(self, metadata=None):
+        """Sets dependencies, hooks and md5 from the parsed template,
+        metadata is template_metadata() of it if already known"""
+        if metadata is None:
+            metadata = template_metadata(self.cfn_data, self.mode)
+        (include, dependencies, hooks) = metadata
+        self.refs = list(include)
+
+        # Extract dependencies
+        self.dependencies.update(dependencies)
 
         # Get checksum
         if not self.md5:
@@ -401,7 +713,7 @@ class Stack(object):
 
                 # Verify embedded md5 hash
                 source_cfn = re.sub(
-                    "Hash: [0-9a-f]{32}", "Hash: __HASH__", self.cfn_template
+                    '(Hash: |"Hash":")[0-9a-f]{32}', r"\1__HASH__", self.cfn_template
                 )
                 our_md5 = hashlib.md5(source_cfn.encode("utf-8")).hexdigest()
                 if our_md5 != self.md5:
@@ -414,8 +726,6 @@ class Stack(object):
                     "Template missing Hash checksum!") from None
 
         # Add CloudBender dependencies
-        include = []
-        search_refs(self.cfn_data, include, self.mode)
         for ref in include:
             if self.mode != "Piped":
                 self.dependencies.add(ref.split(".")[0])
@@ -423,54 +733,79 @@ class Stack(object):
                 self.dependencies.add(ref.split("DoT")[0])
 
         # Extract hooks
-        try:
-            for hook, func in self.cfn_data["Metadata"]["Hooks"].items():
-                if hook in [
-                    "post_update",
-                    "post_create",
-                    "pre_create",
-                        "pre_update"]:
-                    if isinstance(func, list):
-                        self.hooks[hook].extend(func)
-                    else:
-                        self.hooks[hook].append(func)
-        except KeyError:
-            pass
+        for hook, funcs in hooks.items():
+            self.hooks[hook].extend(funcs)
 
     def write_template_file(self):
+        """Writes and uploads the rendered template, unless unchanged
+
+        Returns what happened: written or unchanged, plus uploaded or
+        upload_unchanged if template_bucket_url is set.
+        """
+        outcome = []
         if self.cfn_template:
+            body = self.cfn_template.encode("utf-8")
+            body_md5 = hashlib.md5(body).hexdigest()
+
             yaml_file = os.path.join(
                 self.ctx["template_path"],
                 self.rel_path,
                 self.stackname + ".yaml")
-            ensure_dir(os.path.join(self.ctx["template_path"], self.rel_path))
-            with open(yaml_file, "w") as yaml_contents:
-                yaml_contents.write(self.cfn_template)
-                logger.info("Wrote %s to %s", self.template, yaml_file)
+            try:
+                with open(yaml_file) as f:
+                    unchanged = hashlib.md5(f.read().encode("utf-8")).hexdigest() == body_md5
+            except OSError:
+                unchanged = False
+
+            if unchanged:
+                logger.debug("{} unchanged, not written".format(yaml_file))
+                outcome.append("unchanged")
+            else:
+                ensure_dir(os.path.join(self.ctx["template_path"], self.rel_path))
+                with open(yaml_file, "w") as yaml_contents:
+                    yaml_contents.write(self.cfn_template)
+                    logger.info("Wrote %s to %s", self.template, yaml_file)
+                outcome.append("written")
+
+            if self.fingerprint:
+                manifest.update(
+                    os.path.dirname(yaml_file),
+                    os.path.basename(yaml_file),
+                    dict(self.fingerprint, md5=self.md5),
+                )
 
             # upload template to s3 if set
             if self.template_bucket_url:
+                from botocore.exceptions import ClientError
+
                 try:
                     (bucket, path) = get_s3_url(
                         self.template_bucket_url,
                         self.rel_path,
                         self.stackname + ".yaml",
                     )
-                    self.connection_manager.call(
-                        "s3",
-                        "put_object",
-                        {
-                            "Bucket": bucket,
-                            "Key": path,
-                            "Body": self.cfn_template,
-                            "ServerSideEncryption": "AES256",
-                        },
-                        profile=self.profile,
-                        region=self.region,
-                    )
+                    if self._uploaded_md5(bucket, path) == body_md5:
+                        logger.debug(
+                            "s3://{}/{} unchanged, not uploaded".format(bucket, path))
+                        outcome.append("upload_unchanged")
+                    else:
+                        self.connection_manager.call(
+                            "s3",
+                            "put_object",
+                            {
+                                "Bucket": bucket,
+                                "Key": path,
+                                "Body": body,
+                                "Metadata": {"md5": body_md5},
+                                "ServerSideEncryption": "AES256",
+                            },
+                            profile=self.profile,
+                            region=self.region,
+                        )
 
-                    logger.info(
-                        "Uploaded template to s3://{}/{}".format(bucket, path))
+                        logger.info(
+                            "Uploaded template to s3://{}/{}".format(bucket, path))
+                        outcome.append("uploaded")
                 except ClientError as e:
                     logger.error(
                         "Error trying to upload template so S3: {}, {}".format(
@@ -490,6 +825,30 @@ class Stack(object):
                 "No cfn template rendered yet for stack {}.".format(
                     self.stackname))
 
+        return outcome
+
+    def _uploaded_md5(self, bucket, path):
+        """Returns the md5 of the template uploaded to bucket, if any
+
+        Uploads record it in their metadata, otherwise the ETag of plain
+        single part uploads is the md5 as well.
+        """
+        from botocore.exceptions import ClientError
+
+        try:
+            head = self.connection_manager.call(
+                "s3",
+                "head_object",
+                {"Bucket": bucket, "Key": path},
+                profile=self.profile,
+                region=self.region,
+            )
+        except ClientError as e:
+            logger.debug("Cannot get s3://{}/{}: {}".format(bucket, path, e))
+            return None
+
+        return head.get("Metadata", {}).get("md5", head.get("ETag", "").strip('"'))
+
     def delete_template_file(self):
         yaml_file = os.path.join(
             self.ctx["template_path"], self.rel_path, self.stackname + ".yaml"
@@ -500,7 +859,11 @@ class Stack(object):
         except OSError:
             pass
 
+        manifest.update(os.path.dirname(yaml_file), os.path.basename(yaml_file), None)
+
         if self.template_bucket_url:
+            from botocore.exceptions import ClientError
+
             try:
                 (bucket, path) = get_s3_url(self.template_bucket_url,
                                             self.rel_path, self.stackname + ".yaml")
@@ -525,6 +888,8 @@ class Stack(object):
         """Reads rendered yaml template from disk or s3 and extracts metadata"""
         if not self.cfn_template:
             if self.template_bucket_url:
+                from botocore.exceptions import ClientError
+
                 try:
                     (bucket, path) = get_s3_url(
                         self.template_bucket_url,
@@ -588,6 +953,8 @@ class Stack(object):
 
     def validate(self):
         """Validates the rendered template via cfn-lint"""
+        import cfnlint.core
+
         self.read_template_file()
 
         try:
@@ -653,6 +1020,8 @@ class Stack(object):
             self.outputs = self._get_pulumi_stack().outputs()
 
         else:
+            from botocore.exceptions import ClientError
+
             self.read_template_file()
             try:
                 stacks = self.connection_manager.call(
@@ -710,7 +1079,7 @@ class Stack(object):
                 data = {
                     "stackname": "/".join([self.rel_path, self.stackname]),
                     "timestamp": datetime.strftime(
-                        datetime.now(tzutc()), "%d/%m/%y %H:%M"
+                        datetime.now(timezone.utc), "%d/%m/%y %H:%M"
                     ),
                     "outputs": sanitized_outputs,
                     "parameters": self.parameters,
@@ -746,6 +1115,9 @@ class Stack(object):
 
         # For pulumi we use the embedded docstrings
         if self.mode == "pulumi":
+            import pulumi
+            from pydantic import BaseModel
+
             try:
                 pulumi_stack = self._get_pulumi_stack()
                 outputs = pulumi_stack.outputs()
@@ -915,6 +1287,8 @@ class Stack(object):
         """Creates a stack"""
 
         if self.mode == "pulumi":
+            from packaging.version import Version
+
             kwargs = self._set_pulumi_args()
             stack = self._get_pulumi_stack(create=True)
 
@@ -975,6 +1349,7 @@ class Stack(object):
     @exec_hooks
     def update(self):
         """Updates an existing stack"""
+        from botocore.exceptions import ClientError
 
         # Prepare parameters
         self.resolve_parameters()
@@ -1024,6 +1399,8 @@ class Stack(object):
         logger.info("Deleting {0} {1}".format(self.region, self.stackname))
 
         if self.mode == "pulumi":
+            import pulumi
+
             try:
                 pulumi_stack = self._get_pulumi_stack()
             except pulumi.automation.errors.StackNotFoundError:
@@ -1059,6 +1436,8 @@ class Stack(object):
     @pulumi_ws
     def preview(self):
         """Preview a Pulumi stack up operation"""
+        import rich.console
+        import rich.table
 
         kwargs = self._set_pulumi_args()
         ret = self._get_pulumi_stack(create=True).preview(**kwargs)
@@ -1163,6 +1542,7 @@ class Stack(object):
     @pulumi_ws
     def _import(self, pulumi_state_file):
         """Imports a Pulumi stack"""
+        import pulumi
 
         pulumi_stack = self._get_pulumi_stack()
 
@@ -1177,6 +1557,8 @@ class Stack(object):
     @pulumi_ws
     def set_config(self, key, value, secret):
         """Set a config or secret"""
+        import pulumi
+        import ruamel.yaml
 
         ryaml = ruamel.yaml.YAML()
         ryaml.indent(mapping=2)
@@ -1278,6 +1660,8 @@ class Stack(object):
         Returns the stack's status.
         :returns: The stack's status.
         """
+        from botocore.exceptions import ClientError
+
         try:
             status = self.connection_manager.call(
                 "cloudformation",
@@ -1298,6 +1682,8 @@ class Stack(object):
         Returns a dictionary contianing the stack events.
         :returns: The CloudFormation events for a stack.
         """
+        from botocore.exceptions import ClientError
+
         try:
             status = self.connection_manager.call(
                 "cloudformation",
@@ -1327,16 +1713,17 @@ class Stack(object):
         status = "IN_PROGRESS"
 
         self.most_recent_event_datetime = datetime.now(
-            tzutc()) - timedelta(seconds=3)
+            timezone.utc) - timedelta(seconds=3)
         elapsed = 0
-        while status == "IN_PROGRESS" and not timed_out(elapsed):
-            status = self._get_simplified_status(self.get_status())
-            if not status:
-                return None
+        with timings.phase("wait", self.stackname):
+            while status == "IN_PROGRESS" and not timed_out(elapsed):
+                status = self._get_simplified_status(self.get_status())
+                if not status:
+                    return None
 
-            self._log_new_events()
-            time.sleep(4)
-            elapsed += 4
+                self._log_new_events()
+                time.sleep(4)
+                elapsed += 4
 
         return status
 
@@ -1469,6 +1856,8 @@ class Stack(object):
             logger.info(" ".join([self.region, self.stackname, text]))
 
     def _get_pulumi_stack(self, create=False):
+        import importlib.metadata
+        import pulumi
 
         if create:
             pulumi_stack = pulumi.automation.create_or_select_stack(
@@ -1521,6 +1910,8 @@ class Stack(object):
     # Render a schema as a grouped markdown table; scalars first under
     # "Core", nested submodels each under their own H3.
     def _describe_stackconfig(self, schema, title=None):
+        from pydantic import BaseModel
+
         def _typename(ann):
             origin = typing.get_origin(ann)
             args = typing.get_args(ann)
@@ -1,20 +1,31 @@
 import logging
 import pprint
-import pexpect
-import pulumi
+import functools
 import tempfile
 
-import rich.table
-import rich.console
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
+from . import timings
 from .connection import BotoConnection
-from .utils import dict_merge
-from .jinja import read_config_file
+from .utils import config_merge, FrozenDict
+from .jinja import read_config_file, record_config_files, DecryptedConfig
 from .stack import Stack
+from .index import StackIndex
 
 logger = logging.getLogger(__name__)
 
 
+def _read_stack_config(stack, sg_config, decrypted):
+    stack.read_config(sg_config, decrypted)
+    return []
+
+
+def _run_jobs(jobs):
+    """Runs loader jobs depth-first in the calling thread"""
+    for job in jobs:
+        _run_jobs(job())
+
+
 class StackGroup(object):
     def __init__(self, path, ctx):
         self.name = None
@@ -24,6 +35,11 @@ class StackGroup(object):
         self.config = {}
         self.sgs = []
         self.stacks = []
+        self.index = None
+        # our config holds values decrypted by sops, our own or inherited
+        self.decrypted = False
+        # files included by our config.yaml or any we inherit from
+        self.config_includes = set()
 
         if self.rel_path == ".":
             self.rel_path = ""
@@ -40,15 +56,58 @@ class StackGroup(object):
         for s in self.stacks:
             s.dump_config()
 
-    def read_config(self, parent_config={}, loadStacks=True):
+    def read_config(self, parent_config={}, loadStacks=True, scope=None, loaded=None):
+        """Reads this group and all sub-groups and stacks below it
+
+        Each group's config.yaml has to be merged before any of its children
+        can be read, but siblings are independent. With ctx["workers"] > 1
+        sibling groups and stack files are fanned out to a thread pool.
+
+        scope optionally limits reading to a set of stack files and group
+        folders, incl. all groups along the way to them. loaded optionally
+        maps stack files to stacks already read, which are used as they are.
+        """
+        workers = self.ctx.get("workers") or 1
+
+        jobs = self._read_group_config(parent_config, loadStacks, scope, loaded)
+
+        if workers > 1:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                pending = set(pool.submit(job) for job in jobs)
+                while pending:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        for job in future.result():
+                            pending.add(pool.submit(job))
+        else:
+            _run_jobs(jobs)
+
+        self._set_index(StackIndex(root=self))
+
+    def _read_group_config(self, parent_config={}, loadStacks=True, scope=None, loaded=None):
+        """Reads our own config.yaml and registers all direct children
+
+        Returns a list of callables, each reading one child stack or group
+        and returning the jobs for its own children in turn.
+        Children are registered in directory order before any of them is
+        read, so the resulting tree is identical whatever order they
+        finish in.
+        """
         if not self.path.is_dir():
-            return None
+            return []
+
+        if scope is not None and self.path in scope:
+            scope = None
 
         # First read config.yaml if present
-        _config = read_config_file(
-            self.path.joinpath("config.yaml"), parent_config.get(
-                "variables", {})
-        )
+        with record_config_files() as includes:
+            _config = read_config_file(
+                self.path.joinpath("config.yaml"), parent_config.get(
+                    "variables", {}), self.decrypted
+            )
+        self.config_includes.update(includes)
+        if isinstance(_config, DecryptedConfig):
+            self.decrypted = True
 
         # Stack Group name if not explicit via config is derived from subfolder, or in case of root object the parent folder
         if "stackgroupname" in _config:
@@ -56,102 +115,131 @@ class StackGroup(object):
         elif not self.name:
             self.name = self.path.stem
 
-        # Merge config with parent config
-        self.config = dict_merge(parent_config, _config)
-        stackname_prefix = self.config.get("stacknameprefix", "")
+        # Merge config with parent config, shared with all children
+        self.config = config_merge(parent_config, _config)
 
         # profile and region need special treatment due to cmd line overwrite option
-        if self.ctx["region"]:
-            self.config["region"] = self.ctx["region"]
-
-        if self.ctx["profile"]:
-            self.config["profile"] = self.ctx["profile"]
+        overrides = {k: self.ctx[k] for k in ["region", "profile"] if self.ctx[k]}
+        if overrides:
+            self.config = FrozenDict(self.config, **overrides)
 
         logger.debug("StackGroup {} added.".format(self.name))
 
+        jobs = []
+
         # Add stacks
         if loadStacks:
-            stacks = [
-                s for s in self.path.glob("*.yaml") if not s.name == "config.yaml"
-            ]
+            with timings.phase("discovery", self.path):
+                stacks = [
+                    s for s in self.path.glob("*.yaml") if not s.name == "config.yaml"
+                ]
             for stack_path in stacks:
-                stackname = stack_path.name.split(".")[0]
-                template = stackname
-                if stackname_prefix:
-                    stackname = stackname_prefix + stackname
-
-                new_stack = Stack(
-                    name=stackname,
-                    template=template,
-                    path=stack_path,
-                    rel_path=str(self.rel_path),
-                    ctx=self.ctx,
-                )
-                new_stack.read_config(self.config)
+                if scope is not None and stack_path not in scope:
+                    continue
+
+                if loaded and stack_path in loaded:
+                    self.stacks.append(loaded[stack_path])
+                    continue
+
+                new_stack = self._new_stack(stack_path)
                 self.stacks.append(new_stack)
+                jobs.append(functools.partial(
+                    _read_stack_config, new_stack, self.config, self.decrypted))
 
         # Create StackGroups recursively
-        for sub_group in [s for s in self.path.iterdir() if s.is_dir()]:
-            sg = StackGroup(sub_group, self.ctx)
-            sg.read_config(self.config, loadStacks=loadStacks)
+        with timings.phase("discovery", self.path):
+            sub_groups = [s for s in self.path.iterdir() if s.is_dir()]
+
+        for sub_group in sub_groups:
+            sub_scope = scope
+            if scope is not None:
+                if sub_group in scope:
+                    sub_scope = None
+                elif not any(sub_group in p.parents for p in scope):
+                    continue
 
+            sg = StackGroup(sub_group, self.ctx)
+            sg.decrypted = self.decrypted
+            sg.config_includes = set(self.config_includes)
             self.sgs.append(sg)
+            jobs.append(functools.partial(
+                sg._read_group_config, self.config, loadStacks, sub_scope, loaded))
+
+        return jobs
+
+    def _new_stack(self, stack_path):
+        stackname = stack_path.name.split(".")[0]
+        template = stackname
+        stackname_prefix = self.config.get("stacknameprefix", "")
+        if stackname_prefix:
+            stackname = stackname_prefix + stackname
+
+        stack = Stack(
+            name=stackname,
+            template=template,
+            path=stack_path,
+            rel_path=str(self.rel_path),
+            ctx=self.ctx,
+        )
+        stack.config_includes.update(self.config_includes)
+        return stack
+
+    def reload_stack(self, stack):
+        """Replaces stack by a freshly read one, eg. after its file changed"""
+        new_stack = self._new_stack(stack.path)
+        new_stack.read_config(self.config, self.decrypted)
+        self.stacks[self.stacks.index(stack)] = new_stack
+        return new_stack
 
     def get_stacks(self, name=None, recursive=True, match_by="name"):
         """Returns [stack] matching stack_name or [all]"""
-        stacks = []
         if name:
             logger.debug(
                 "Looking for stack {} in group {}".format(name, self.name))
 
-        for s in self.stacks:
-            if name:
-                if match_by == "name" and s.stackname != name:
-                    continue
-
-                if match_by == "path" and not s.path.match(name):
-                    continue
-
-            if self.rel_path:
+        stacks = self._get_index().get_stacks(self, name, recursive, match_by)
+        for s in stacks:
+            if s.rel_path:
                 logger.debug(
                     "Found stack {} in group {}".format(
-                        s.stackname, self.rel_path)
+                        s.stackname, s.rel_path)
                 )
             else:
                 logger.debug("Found stack {}".format(s.stackname))
-            stacks.append(s)
-
-        if recursive:
-            for sg in self.sgs:
-                s = sg.get_stacks(name, recursive, match_by)
-                if s:
-                    stacks = stacks + s
 
         return stacks
 
     def get_stackgroup(self, name=None, match_by="path"):
         """Returns stack group matching stackgroup_name or all if None"""
-        if self.path.match(name):
-            logger.debug("Found stack_group {}".format(self.name))
-            return self
-
         if name and name != "config":
             logger.debug(
                 "Looking for stack_group {} in group {}".format(
                     name, self.name)
             )
 
-        for sg in self.sgs:
-            s = sg.get_stackgroup(name, match_by)
-            if s:
-                return s
+        sg = self._get_index().get_stackgroup(self, name)
+        if sg:
+            logger.debug("Found stack_group {}".format(sg.name))
 
-        return None
+        return sg
+
+    def _get_index(self):
+        """Index of the tree below us, built once after reading the config"""
+        if not self.index:
+            self._set_index(StackIndex(root=self))
+
+        return self.index
+
+    def _set_index(self, index):
+        self.index = index
+        for sg in self.sgs:
+            sg._set_index(index)
 
     def wrap(self, cmd):
         """
         Set AWS environment based on profile before executing a custom command, eg. steampipe
         """
+        import pexpect
 
         profile = self.config.get("profile", "default")
         region = self.config.get("region", "global")
@@ -167,6 +255,7 @@ class StackGroup(object):
         Check and upgrade Pulumi state backend for this stack group.
         Verifies if .pulumi/meta.yaml exists in S3 and runs 'pulumi state upgrade' if not.
         """
+        import pexpect
 
         project_name = self.config["parameters"]["Conglomerate"]
         pulumi_backend = "{}/{}/{}".format(
@@ -187,6 +276,10 @@ class StackGroup(object):
         child.interact()
 
     def list_stacks(self):
+        import pulumi
+        import rich.console
+        import rich.table
+
         project_name = self.config["parameters"]["Conglomerate"]
         pulumi_backend = "{}/{}/{}".format(
             self.config["pulumi"]["backend"], project_name, self.config["region"])
@@ -0,0 +1,148 @@
+import contextlib
+import heapq
+import json
+import threading
+import time
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# eg. via --timings
+enabled = False
+
+# Number of slowest files / stacks reported per phase
+SLOWEST = 5
+
+# Report order, phases may nest, eg. sops within config
+PHASES = [
+    "discovery",
+    "config",
+    "sops",
+    "libraries",
+    "render",
+    "postprocess",
+    "aws",
+    "wait",
+    "pulumi",
+]
+
+_lock = threading.Lock()
+_phases = {}
+_started = None
+
+
+def enable():
+    global enabled, _started
+
+    enabled = True
+    _started = (time.perf_counter(), time.process_time())
+
+
+def reset():
+    global enabled, _started
+
+    with _lock:
+        enabled = False
+        _started = None
+        _phases.clear()
+
+
+@contextlib.contextmanager
+def phase(name, item=None):
+    """Records wall and cpu time of the block as part of phase name
+
+    item, eg. a file or stack, is used to report the slowest ones.
+    CPU time is per thread, so parallel workers do not add up.
+    """
+    if not enabled:
+        yield
+        return
+
+    wall = time.perf_counter()
+    cpu = time.thread_time()
+    try:
+        yield
+    finally:
+        _record(name, item, time.perf_counter() - wall, time.thread_time() - cpu)
+
+
+def _record(name, item, wall, cpu):
+    with _lock:
+        p = _phases.setdefault(name, {"count": 0, "wall": 0.0, "cpu": 0.0, "items": {}})
+        p["count"] += 1
+        p["wall"] += wall
+        p["cpu"] += cpu
+        if item is not None:
+            item = str(item)
+            p["items"][item] = p["items"].get(item, 0.0) + wall
+
+
+def collect():
+    """Returns and clears the raw phases recorded so far, see merge"""
+    with _lock:
+        phases = dict(_phases)
+        _phases.clear()
+
+    return phases
+
+
+def merge(phases):
+    """Adds raw phases recorded elsewhere, eg. by render workers"""
+    for name, p in phases.items():
+        with _lock:
+            mine = _phases.setdefault(name, {"count": 0, "wall": 0.0, "cpu": 0.0, "items": {}})
+            mine["count"] += p["count"]
+            mine["wall"] += p["wall"]
+            mine["cpu"] += p["cpu"]
+            for item, wall in p["items"].items():
+                mine["items"][item] = mine["items"].get(item, 0.0) + wall
+
+
+def results():
+    """Returns all recorded phases incl. their slowest items"""
+    with _lock:
+        phases = {}
+        for name in sorted(_phases, key=lambda n: PHASES.index(n) if n in PHASES else len(PHASES)):
+            p = _phases[name]
+            phases[name] = {
+                "count": p["count"],
+                "wall": round(p["wall"], 6),
+                "cpu": round(p["cpu"], 6),
+                "slowest": [
+                    [item, round(wall, 6)]
+                    for item, wall in heapq.nlargest(SLOWEST, p["items"].items(), key=lambda i: i[1])
+                ],
+            }
+
+    total = {}
+    if _started:
+        total = {
+            "wall": round(time.perf_counter() - _started[0], 6),
+            "cpu": round(time.process_time() - _started[1], 6),
+        }
+
+    return {"total": total, "phases": phases}
+
+
+def report():
+    """Returns the results as human readable text"""
+    data = results()
+
+    lines = ["{:<12} {:>6} {:>10} {:>10}".format("Phase", "Count", "Wall [s]", "CPU [s]")]
+    for name, p in data["phases"].items():
+        lines.append("{:<12} {:>6} {:>10.3f} {:>10.3f}".format(name, p["count"], p["wall"], p["cpu"]))
+        for item, wall in p["slowest"]:
+            lines.append("  {:>10.3f}  {}".format(wall, item))
+
+    if data["total"]:
+        lines.append("{:<12} {:>6} {:>10.3f} {:>10.3f}".format(
+            "total", "", data["total"]["wall"], data["total"]["cpu"]))
+
+    return "\n".join(lines) + "\n"
+
+
+def write(path):
+    with open(path, "w") as f:
+        json.dump(results(), f, indent=2)
+    logger.info("Wrote timings to {}".format(path))
@@ -42,12 +42,101 @@ def dict_merge(a, b):
     return result
 
 
+def _immutable(self, *args, **kwargs):
+    raise TypeError("{} is immutable".format(type(self).__name__))
+
+
+class FrozenDict(dict):
+    """Read-only dict, shared between configs instead of copied"""
+
+    __setitem__ = __delitem__ = __ior__ = _immutable
+    clear = pop = popitem = setdefault = update = _immutable
+
+    def __reduce__(self):
+        return (FrozenDict, (dict(self),))
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+
+class FrozenList(list):
+    """Read-only list, see FrozenDict"""
+
+    __setitem__ = __delitem__ = __iadd__ = __imul__ = _immutable
+    append = extend = insert = pop = remove = clear = sort = reverse = _immutable
+
+    def __reduce__(self):
+        return (FrozenList, (list(self),))
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+
+def freeze(data):
+    """Returns a read-only version of data, already frozen parts are reused"""
+    if isinstance(data, (FrozenDict, FrozenList)):
+        return data
+
+    if isinstance(data, dict):
+        return FrozenDict((k, freeze(v)) for k, v in data.items())
+
+    if isinstance(data, list):
+        return FrozenList(freeze(v) for v in data)
+
+    return data
+
+
+def thaw(data):
+    """Returns a mutable deep copy of frozen data"""
+    if isinstance(data, dict):
+        return {k: thaw(v) for k, v in data.items()}
+
+    if isinstance(data, list):
+        return [thaw(v) for v in data]
+
+    return data
+
+
+def config_merge(a, b):
+    """Same as dict_merge but returns frozen data
+
+    Only the dicts along the merged keys are created, all other branches of
+    a and b are shared with the result instead of copied.
+    """
+    if not a:
+        return freeze(b)
+
+    if not b:
+        return freeze(a)
+
+    if not isinstance(a, dict) or not isinstance(b, dict):
+        raise TypeError
+
+    result = {k: freeze(v) for k, v in a.items()}
+    for k, v in b.items():
+        if k in result and isinstance(result[k], dict):
+            result[k] = config_merge(result[k], v)
+        else:
+            result[k] = freeze(v)
+    return FrozenDict(result)
+
+
 def ensure_dir(path):
     """Creates dir if it does not already exist."""
     if not os.path.exists(path):
         os.makedirs(path)
 
 
+# Handler added by setup_logging, replaced on every call
+_log_handler = None
+
+
 def setup_logging(debug):
     if debug:
         our_level = logging.DEBUG
@@ -64,10 +153,16 @@ def setup_logging(debug):
             fmt="[%(asctime)s] %(message)s", datefmt="%Y-%m-%d %H:%M:%S"
         )
 
-    log_handler = logging.StreamHandler()
-    log_handler.setFormatter(formatter)
+    global _log_handler
+
     logger = logging.getLogger("cloudbender")
-    logger.addHandler(log_handler)
+    if _log_handler:
+        logger.removeHandler(_log_handler)
+
+    # Current sys.stderr, which the daemon redirects per command
+    _log_handler = logging.StreamHandler()
+    _log_handler.setFormatter(formatter)
+    logger.addHandler(_log_handler)
     logger.setLevel(our_level)
     return logger
 
@@ -75,9 +170,16 @@ def setup_logging(debug):
 def search_refs(template, attributes, mode):
     """Traverses a template and searches for any remote references and
     adds them to the attributes set
+
+    Walks iteratively in document order, deeply nested templates must not
+    hit the recursion limit.
     """
-    if isinstance(template, dict):
-        for k, v in template.items():
+    if not isinstance(template, (dict, list)):
+        return
+
+    todo = [_children(template)]
+    while todo:
+        for (k, v) in todo[-1]:
             # FortyTwo Fn::GetAtt
             if k == "Fn::GetAtt" and isinstance(v, list):
                 if v[0] == "FortyTwo":
@@ -95,12 +197,43 @@ def search_refs(template, attributes, mode):
                 attributes.append(v)
 
             if isinstance(v, dict) or isinstance(v, list):
-                search_refs(v, attributes, mode)
+                todo.append(_children(v))
+                break
+        else:
+            todo.pop()
+
+
+def _children(node):
+    if isinstance(node, dict):
+        return iter(node.items())
+    return ((None, v) for v in node)
+
+
+# Metadata.Hooks supported by Stack
+HOOKS = ["post_update", "post_create", "pre_create", "pre_update"]
+
+
+def template_metadata(template, mode):
+    """Returns the remote references, the dependencies and the hooks of a
+    parsed template, walking it only once"""
+    refs = []
+    search_refs(template, refs, mode)
+
+    dependencies = []
+    try:
+        dependencies.extend(template["Metadata"]["CloudBender"]["Dependencies"])
+    except KeyError:
+        pass
+
+    hooks = {}
+    try:
+        for hook, func in template["Metadata"]["Hooks"].items():
+            if hook in HOOKS:
+                hooks[hook] = func if isinstance(func, list) else [func]
+    except KeyError:
+        pass
 
-    elif isinstance(template, list):
-        for k in template:
-            if isinstance(k, dict) or isinstance(k, list):
-                search_refs(k, attributes, mode)
+    return (refs, dependencies, hooks)
 
 
 def get_s3_url(url, *args):
@@ -0,0 +1,113 @@
+import os
+import time
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Seconds between checks for changed files
+INTERVAL = 1
+
+
+def config_files(stack):
+    """Returns the stack file and all config.yaml files it inherits from"""
+    files = [str(stack.path)]
+
+    path = stack.path.parent
+    while True:
+        files.append(os.path.join(path, "config.yaml"))
+        if path == stack.ctx["config_path"] or path == path.parent:
+            break
+        path = path.parent
+
+    return files
+
+
+def snapshot(paths):
+    """Returns mtime and size of all paths, None for missing ones"""
+    files = {}
+    for p in paths:
+        try:
+            st = os.stat(p)
+            files[p] = (st.st_mtime_ns, st.st_size)
+        except OSError:
+            files[p] = None
+
+    return files
+
+
+def watch(stacks, find, render, interval=INTERVAL):
+    """Re-renders stacks whenever any of their inputs change, until interrupted
+
+    The inputs of a stack are its config file, all config.yaml files it
+    inherits from, any files these include and all templates, includes and include_raw files of
+    local libraries it rendered from. Files of remote libraries only exist
+    during rendering and are never watched.
+
+    find() has to re-read the config and return the current stacks, it is
+    called whenever any config file or config folder changed.
+    render(stack) renders and writes a single stack.
+    """
+    stacks = {s.path: s for s in stacks}
+    (config, inputs, paths) = _inputs(stacks.values())
+    state = snapshot(paths)
+
+    logger.info("Watching {} files of {} stacks".format(len(state), len(stacks)))
+    try:
+        while True:
+            time.sleep(interval)
+
+            current = snapshot(state)
+            changed = set(p for p in state if current[p] != state[p])
+            if not changed:
+                continue
+
+            logger.debug("Changed: {}".format(", ".join(sorted(changed))))
+
+            # Config changes may add, remove or change any stack below,
+            # unaffected stacks keep their already rendered state
+            if changed & config:
+                try:
+                    current_stacks = find()
+                except Exception as e:
+                    logger.error("Reading config failed: {}".format(e))
+                    state = current
+                    continue
+
+                found = {}
+                for s in current_stacks:
+                    if s.path in stacks and not inputs[s.path] & changed:
+                        s = stacks[s.path]
+                    found[s.path] = s
+                affected = [s for p, s in found.items() if s is not stacks.get(p)]
+                stacks = found
+            else:
+                affected = [s for p, s in stacks.items() if inputs[p] & changed]
+
+            for s in affected:
+                try:
+                    render(s)
+                except Exception as e:
+                    logger.error("Rendering {} failed: {}".format(s.stackname, e))
+
+            # Anything changing while we rendered is picked up next time
+            (config, inputs, paths) = _inputs(stacks.values())
+            state = {p: current[p] if p in current else v for p, v in snapshot(paths).items()}
+
+    except KeyboardInterrupt:
+        pass
+
+
+def _inputs(stacks):
+    """Returns all config files and folders, the inputs per stack and all
+    paths to watch"""
+    config = set()
+    inputs = {}
+    for s in stacks:
+        files = config_files(s)
+        config.update(files)
+        config.update(os.path.dirname(f) for f in files[1:])
+        config.update(s.config_includes)
+        inputs[s.path] = set(files) | s.config_includes | set(s.template_files)
+
+    return (config, inputs, config.union(*inputs.values()))
@@ -0,0 +1,9 @@
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path_factory, monkeypatch):
+    """Keep persistent caches out of the users home"""
+    path = tmp_path_factory.mktemp("cache")
+    monkeypatch.setenv("CLOUDBENDER_CACHE_DIR", str(path))
+    return path
@@ -0,0 +1,39 @@
+import jinja2
+
+from cloudbender import cache
+from cloudbender import sops
+from cloudbender.jinja import read_config_file
+
+
+def test_config_plain_yaml_skips_jinja(tmp_path, monkeypatch):
+    monkeypatch.setattr(cache, "enabled", False)
+
+    def _fail(*args, **kwargs):
+        raise AssertionError("template compiled")
+
+    monkeypatch.setattr(jinja2, "Environment", _fail)
+
+    path = tmp_path / "config.yaml"
+    path.write_text("parameters:\n  Name: vpc\n")
+    assert read_config_file(path) == {"parameters": {"Name": "vpc"}}
+
+
+def test_config_sops_detection(tmp_path, monkeypatch):
+    monkeypatch.setattr(cache, "enabled", False)
+    calls = []
+
+    def _decrypt(path, config_raw):
+        calls.append(path)
+        return "secret: plain\n"
+
+    monkeypatch.setattr(sops, "decrypt", _decrypt)
+
+    # only top level sops keys
+    path = tmp_path / "config.yaml"
+    path.write_text("parameters:\n  sops: true\n")
+    assert read_config_file(path) == {"parameters": {"sops": True}}
+    assert not calls
+
+    path.write_text("secret: ENC[AES256_GCM,data:abc]\nsops:\n  version: 3.8.1\n")
+    assert read_config_file(path) == {"secret": "plain"}
+    assert len(calls) == 1
@@ -0,0 +1,196 @@
+from cloudbender import cache
+from cloudbender import jinja
+from cloudbender import sops
+from cloudbender.jinja import read_config_file, config_cache
+
+
+def _stats():
+    return (config_cache.hits, config_cache.misses)
+
+
+def test_config_cache_hit(tmp_path):
+    path = tmp_path / "stack.yaml"
+    path.write_text("parameters:\n  Name: '{{ Name }}'\n")
+
+    hits, misses = _stats()
+    first = read_config_file(path, {"Name": "vpc"})
+    second = read_config_file(path, {"Name": "vpc"})
+
+    assert first == second == {"parameters": {"Name": "vpc"}}
+    assert _stats() == (hits + 1, misses + 1)
+
+
+def test_config_cache_keyed_by_content_and_variables(tmp_path):
+    path = tmp_path / "stack.yaml"
+    path.write_text("parameters:\n  Name: '{{ Name }}'\n")
+
+    assert read_config_file(path, {"Name": "vpc"}) == {
+        "parameters": {"Name": "vpc"}}
+    assert read_config_file(path, {"Name": "dns"}) == {
+        "parameters": {"Name": "dns"}}
+
+    path.write_text("parameters:\n  Name: 'x{{ Name }}'\n")
+    assert read_config_file(path, {"Name": "dns"}) == {
+        "parameters": {"Name": "xdns"}}
+
+
+def test_config_cache_tracks_env(tmp_path, monkeypatch):
+    path = tmp_path / "config.yaml"
+    path.write_text("region: '{{ ENV.TEST_REGION }}'\n")
+
+    monkeypatch.setenv("TEST_REGION", "eu-central-1")
+    assert read_config_file(path) == {"region": "eu-central-1"}
+
+    # unrelated variables must not invalidate the entry
+    hits = config_cache.hits
+    monkeypatch.setenv("TEST_UNRELATED", "1")
+    assert read_config_file(path) == {"region": "eu-central-1"}
+    assert config_cache.hits == hits + 1
+
+    monkeypatch.setenv("TEST_REGION", "us-east-1")
+    assert read_config_file(path) == {"region": "us-east-1"}
+
+
+def test_config_cache_disabled(tmp_path, monkeypatch):
+    monkeypatch.setattr(cache, "enabled", False)
+    path = tmp_path / "stack.yaml"
+    path.write_text("a: 1\n")
+
+    hits, misses = _stats()
+    read_config_file(path)
+    read_config_file(path)
+    assert _stats() == (hits, misses)
+
+
+def test_config_templates_compiled_once(tmp_path, monkeypatch, cache_dir):
+    bytecode = jinja.config_bytecode_cache
+    path = tmp_path / "stack.yaml"
+    path.write_text("parameters:\n  Name: '{{ Name }}'\n")
+
+    # the rendered config is cached, so vary the variables
+    compiled, reused = bytecode.compiled, bytecode.reused
+    assert read_config_file(path, {"Name": "vpc"}) == {"parameters": {"Name": "vpc"}}
+    assert read_config_file(path, {"Name": "dns"}) == {"parameters": {"Name": "dns"}}
+    assert (bytecode.compiled, bytecode.reused) == (compiled + 1, reused + 1)
+    assert list((cache_dir / "jinja" / "config").iterdir())
+
+    # persisted across processes
+    fresh = jinja.BytecodeCache("config")
+    monkeypatch.setattr(jinja._get_config_env(), "bytecode_cache", fresh)
+    assert read_config_file(path, {"Name": "eks"}) == {"parameters": {"Name": "eks"}}
+    assert (fresh.compiled, fresh.reused) == (0, 1)
+
+
+def test_config_templates_of_sops_files_not_persisted(tmp_path, monkeypatch, cache_dir):
+    monkeypatch.setattr(sops, "decrypt", lambda path, raw: "secret: '{{ Name }}-plain'\n")
+    path = tmp_path / "secrets.yaml"
+    path.write_text("secret: ENC[AES256_GCM,data:abc]\nsops:\n  version: 3.8.1\n")
+
+    assert read_config_file(path, {"Name": "db"}) == {"secret": "db-plain"}
+    assert not (cache_dir / "jinja" / "config").exists()
+
+
+def test_cfn_templates_shared_across_paths(tmp_path, monkeypatch, cache_dir):
+    bytecode = jinja.TemplateBytecodeCache("cloudformation", 1024 * 1024)
+    monkeypatch.setattr(jinja, "template_bytecode_cache", bytecode)
+    for lib in ["one", "two"]:
+        (tmp_path / lib).mkdir()
+        (tmp_path / lib / "vpc.yaml.jinja").write_text(
+            "{% macro name(n) %}{{ n }}{% endmacro %}Name: {{ name(Name) }}\n")
+
+    for lib in ["one", "two"]:
+        template = jinja.JinjaEnv([tmp_path / lib]).get_template("vpc.yaml.jinja")
+        assert template.render(Name="vpc") == "Name: vpc"
+        assert template.filename == str(tmp_path / lib / "vpc.yaml.jinja")
+
+    assert (bytecode.compiled, bytecode.reused) == (1, 1)
+
+    # persisted across processes, eg. for the next temporary work_dir
+    fresh = jinja.TemplateBytecodeCache("cloudformation", 1024 * 1024)
+    monkeypatch.setattr(jinja, "template_bytecode_cache", fresh)
+    (tmp_path / "three").mkdir()
+    (tmp_path / "three" / "vpc.yaml.jinja").write_text((tmp_path / "one" / "vpc.yaml.jinja").read_text())
+    jinja.JinjaEnv([tmp_path / "three"]).get_template("vpc.yaml.jinja")
+    assert (fresh.compiled, fresh.reused) == (0, 1)
+
+
+def test_cfn_template_cache_evicts_oldest(tmp_path, monkeypatch, cache_dir):
+    bytecode = jinja.TemplateBytecodeCache("cloudformation", 1)
+    monkeypatch.setattr(jinja, "template_bytecode_cache", bytecode)
+    (tmp_path / "a.jinja").write_text("a: {{ 1 }}\n")
+    (tmp_path / "b.jinja").write_text("b: {{ 2 }}\n")
+
+    jenv = jinja.JinjaEnv([tmp_path])
+    jenv.get_template("a.jinja")
+    jenv.get_template("b.jinja")
+
+    # Only ever the most recent entry survives a tiny limit
+    assert len(list((cache_dir / "jinja" / "cloudformation").glob("*.cache"))) <= 1
+
+
+def test_pyminify_cached(monkeypatch):
+    import python_minifier
+
+    source = "def handler(event, context):\n    return event\n"
+    misses = jinja.pyminify_cache.misses
+    packed = jinja.pyminify(source)
+    assert jinja.pyminify_cache.misses == misses + 1
+
+    def fail(*args, **kwargs):
+        raise AssertionError("minified again")
+
+    monkeypatch.setattr(python_minifier, "awslambda", fail)
+    hits = jinja.pyminify_cache.hits
+    assert jinja.pyminify(source) == packed
+    assert jinja.pyminify_cache.hits == hits + 1
+
+
+def test_include_raw_gz_cached(tmp_path):
+    import base64
+    import gzip
+
+    (tmp_path / "init.sh").write_text("#!/bin/sh\n## template: jinja\n\n  # comment\necho hi\n")
+    jenv = jinja.JinjaEnv([tmp_path])
+    template = jenv.from_string("{{ include_raw(['init.sh'], remove_comments=True) }}")
+
+    hits = jinja._pack_raw.cache_info().hits
+    first = template.render()
+    assert template.render() == first
+    assert jinja._pack_raw.cache_info().hits == hits + 1
+    assert gzip.decompress(base64.b64decode(first)) == b"#!/bin/sh\n## template: jinja\necho hi\n"
+
+
+def test_cache_dirs_are_private(tmp_path, monkeypatch):
+    monkeypatch.delenv("CLOUDBENDER_CACHE_DIR")
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "xdg" / "cache"))
+    monkeypatch.setenv("XDG_CONFIG_HOME", str(tmp_path / "xdg" / "config"))
+    monkeypatch.setattr(sops, "_decrypt_age", lambda config_raw: None)
+    monkeypatch.setattr(sops, "_decrypt_sops", lambda path, config_raw: ("a: 1\n", True))
+
+    sops.decrypt("a.yaml", "a: ENC[]\nsops: {}\n")
+
+    created = [p for p in (tmp_path / "xdg").rglob("*") if p.is_dir()] + [tmp_path / "xdg"]
+    assert len(created) > 4
+    for p in created:
+        assert p.stat().st_mode & 0o777 == 0o700, p
+
+
+def test_config_cache_skips_decrypted_variables(tmp_path, cache_dir, monkeypatch):
+    from cloudbender.core import CloudBender
+
+    (tmp_path / "config" / "prod" / "eu").mkdir(parents=True)
+    (tmp_path / "config" / "config.yaml").write_text("region: eu-central-1\n")
+    (tmp_path / "config" / "prod" / "config.yaml").write_text("variables: ENC\nsops:\n  version: 3\n")
+    (tmp_path / "config" / "prod" / "eu" / "config.yaml").write_text("tags:\n  Owner: '{{ Secret }}'\n")
+    (tmp_path / "config" / "prod" / "eu" / "vpc.yaml").write_text("parameters:\n  Password: '{{ Secret }}'\n")
+    monkeypatch.setattr(sops, "decrypt", lambda path, raw: "variables:\n  Secret: hunter2\n")
+
+    cb = CloudBender(tmp_path, None, None)
+    cb.read_config()
+    (stack,) = cb.all_stacks
+    assert stack.parameters["Password"] == stack.tags["Owner"] == "hunter2"
+
+    entries = [p for p in (cache_dir / "config").rglob("*") if p.is_file()]
+    assert entries
+    for p in entries:
+        assert b"hunter2" not in p.read_bytes()
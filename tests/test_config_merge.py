@@ -0,0 +1,90 @@
+import copy
+import pickle
+
+import pytest
+
+from cloudbender.utils import dict_merge, config_merge, freeze, thaw, FrozenDict, FrozenList
+
+hypothesis = pytest.importorskip("hypothesis")
+st = hypothesis.strategies
+
+# yaml like config data
+scalars = st.none() | st.booleans() | st.integers() | st.text(max_size=5)
+keys = st.sampled_from(["a", "b", "c", "tags", "parameters", "region"])
+configs = st.recursive(
+    scalars,
+    lambda children: st.lists(children, max_size=3) | st.dictionaries(keys, children, max_size=4),
+    max_leaves=20,
+)
+
+
+def _merge(func, a, b):
+    try:
+        return ("ok", func(a, b))
+    except TypeError:
+        return ("TypeError", None)
+
+
+@hypothesis.given(configs, configs)
+def test_config_merge_equals_dict_merge(a, b):
+    expected = _merge(dict_merge, copy.deepcopy(a), copy.deepcopy(b))
+    result = _merge(config_merge, a, b)
+
+    assert result[0] == expected[0]
+    assert thaw(result[1]) == expected[1]
+
+
+@hypothesis.given(configs, configs, configs)
+def test_config_merge_chain_equals_dict_merge(a, b, c):
+    expected = _merge(dict_merge, copy.deepcopy(a), copy.deepcopy(b))
+    result = _merge(config_merge, freeze(a), freeze(b))
+    hypothesis.assume(expected[0] == result[0] == "ok")
+
+    assert thaw(_merge(config_merge, result[1], c)[1]) == _merge(dict_merge, expected[1], copy.deepcopy(c))[1]
+
+
+@hypothesis.given(configs, configs)
+def test_config_merge_leaves_inputs_untouched(a, b):
+    (a_copy, b_copy) = (copy.deepcopy(a), copy.deepcopy(b))
+    _merge(config_merge, a, b)
+
+    assert a == a_copy
+    assert b == b_copy
+
+
+@hypothesis.given(configs)
+def test_freeze_roundtrip(data):
+    frozen = freeze(data)
+
+    assert frozen == data
+    assert thaw(frozen) == data
+    assert freeze(frozen) is frozen
+    assert pickle.loads(pickle.dumps(frozen)) == frozen
+
+
+def test_config_merge_shares_branches():
+    parent = freeze({"tags": {"Owner": "ops"}, "parameters": {"Size": "small"}})
+    merged = config_merge(parent, {"parameters": {"Name": "vpc"}})
+
+    assert merged["tags"] is parent["tags"]
+    assert merged["parameters"] == {"Size": "small", "Name": "vpc"}
+
+
+def test_frozen_is_immutable():
+    data = freeze({"list": [1, 2], "dict": {"a": 1}})
+
+    for mutate in [
+        lambda: data.update(a=1),
+        lambda: data.__setitem__("a", 1),
+        lambda: data.pop("list"),
+        lambda: data["dict"].setdefault("b", 2),
+        lambda: data["list"].append(3),
+        lambda: data["list"].__setitem__(0, 3),
+        lambda: data["list"].sort(),
+    ]:
+        with pytest.raises(TypeError):
+            mutate()
+
+    assert isinstance(pickle.loads(pickle.dumps(data)), FrozenDict)
+    assert isinstance(pickle.loads(pickle.dumps(data))["list"], FrozenList)
+    assert thaw(data)["list"].append(3) is None
@@ -0,0 +1,145 @@
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+import pytest
+
+from cloudbender import daemon
+from cloudbender.core import CloudBender
+from tests.test_importtime import _make_project
+
+
+@pytest.fixture
+def project(tmp_path, monkeypatch):
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    monkeypatch.setenv("CLOUDBENDER_DAEMON_SOCKET", str(tmp_path / "daemon.sock"))
+    _make_project(tmp_path)
+    return tmp_path
+
+
+@pytest.fixture
+def served(project):
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "cloudbender.cli", "--dir", str(project), "daemon"])
+    path = daemon.socket_path(project)
+    for _ in range(200):
+        if daemon._alive(path):
+            break
+        time.sleep(0.05)
+
+    yield path
+
+    proc.send_signal(signal.SIGINT)
+    proc.wait(timeout=10)
+    assert not os.path.exists(path)
+
+
+@pytest.fixture
+def warm(project):
+    cb = CloudBender(project, None, None)
+    cb.read_config()
+    return daemon.Daemon(cb)
+
+
+def test_forward_runs_command(served, project, capsys):
+    code = daemon.forward(served, ["--dir", str(project), "render", "prod/vpc.yaml"], project)
+
+    assert code == 0
+    assert "Wrote vpc" in capsys.readouterr().err
+    assert (project / "cloudformation" / "prod" / "vpc.yaml").is_file()
+
+
+def test_forward_exit_code(served, project, capsys):
+    code = daemon.forward(served, ["--dir", str(project), "render", "nope.yaml"], project)
+
+    assert code == 1
+    assert "Cannot find stack matching" in capsys.readouterr().err
+
+
+def test_forward_without_daemon(tmp_path):
+    assert daemon.forward(str(tmp_path / "missing.sock"), ["render"], tmp_path) is None
+
+
+def test_changed_stack_is_reread(warm, project):
+    before = warm.project(None, None)
+    (project / "config" / "prod" / "vpc.yaml").write_text(
+        "parameters:\n  Conglomerate: prod2\n")
+
+    after = warm.project(None, None)
+    (stack,) = after.sg.get_stacks("vpc")
+    assert stack.parameters["Conglomerate"] == "prod2"
+    assert before.sg.get_stacks("vpc")[0].parameters["Conglomerate"] == "prod"
+
+    # Every command gets its own copy
+    stack.cfn_template = "changed"
+    assert warm.project(None, None).sg.get_stacks("vpc")[0].cfn_template is None
+
+
+def test_only_targets_are_copied(warm, project):
+    (project / "config" / "prod" / "db.yaml").write_text("parameters:\n  Conglomerate: prod\n")
+
+    cb = warm.project(None, None, ["prod/vpc.yaml"])
+    (vpc,) = cb.sg.get_stacks("vpc")
+    (db,) = cb.sg.get_stacks("db")
+    assert vpc is not warm.cb.sg.get_stacks("vpc")[0]
+    assert db is warm.cb.sg.get_stacks("db")[0]
+
+
+def test_other_profile_is_not_served(warm):
+    assert warm.project("other", None) is None
+
+
+def test_changed_environment_rereads_project(project, monkeypatch):
+    (project / "config" / "prod" / "vpc.yaml").write_text(
+        "parameters:\n  Conglomerate: \"{{ ENV.CB_TEST_NAME | default('prod') }}\"\n")
+    monkeypatch.delenv("CB_TEST_NAME", raising=False)
+    cb = CloudBender(project, None, None)
+    cb.read_config()
+    warm = daemon.Daemon(cb)
+
+    monkeypatch.setenv("CB_TEST_NAME", "client")
+    (stack,) = warm.project(None, None).sg.get_stacks("vpc")
+    assert stack.parameters["Conglomerate"] == "client"
+
+
+def test_unused_environment_keeps_project(warm, monkeypatch):
+    cb = warm.cb
+    monkeypatch.setenv("CB_TEST_UNUSED", "client")
+
+    warm.project(None, None)
+    assert warm.cb is cb
+
+
+def test_new_library_template_is_rendered(served, project):
+    (project / "libs" / "override" / "cloudformation").mkdir(parents=True)
+    (project / "config" / "config.yaml").write_text(
+        "region: eu-central-1\nlibraries:\n  - url: local://libs/override\n  - url: local://libs/cfn\n")
+    assert daemon.forward(served, ["--dir", str(project), "render", "prod/vpc.yaml"], project) == 0
+
+    template = (project / "libs" / "cfn" / "cloudformation" / "vpc.yaml.jinja").read_text()
+    (project / "libs" / "override" / "cloudformation" / "vpc.yaml.jinja").write_text(
+        template.replace("Description: VPC", "Description: Override"))
+
+    assert daemon.forward(served, ["--dir", str(project), "render", "prod/vpc.yaml"], project) == 0
+    assert "Override" in (project / "cloudformation" / "prod" / "vpc.yaml").read_text()
+
+
+def test_invalid_request_keeps_serving(served, project):
+    for request in [b"not json\n", b"{}\n", b"[1]\n"]:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(served)
+            sock.sendall(request)
+            assert b'"exit": 2' in sock.makefile("rb").read()
+
+    assert daemon.forward(served, ["--dir", str(project), "render", "prod/vpc.yaml"], project) == 0
+
+
+def test_other_root_is_refused(served, tmp_path):
+    assert daemon.forward(served, ["render"], tmp_path / "other") is None
+
+
+def test_state_upgrade_is_local():
+    assert "state-upgrade" in daemon.LOCAL_COMMANDS
@@ -0,0 +1,79 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+# Heavy dependencies, only to be imported by commands actually using them
+HEAVY = ["pulumi", "cfnlint", "ruamel", "rich", "pydantic", "boto3", "botocore", "dateutil", "pexpect"]
+
+# Cumulative import time of cloudbender.cli in microseconds, used to be >1s
+BUDGET = 600000
+
+
+def _make_project(root):
+    (root / "config" / "prod").mkdir(parents=True)
+    (root / "config" / "config.yaml").write_text(
+        "region: eu-central-1\nlibraries:\n  - url: local://libs/cfn\n")
+    (root / "config" / "prod" / "vpc.yaml").write_text(
+        "parameters:\n  Conglomerate: prod\n")
+    (root / "libs" / "cfn" / "cloudformation").mkdir(parents=True)
+    (root / "libs" / "cfn" / "cloudformation" / "vpc.yaml.jinja").write_text(
+        "AWSTemplateFormatVersion: '2010-09-09'\n"
+        "Description: VPC\n"
+        "Metadata:\n"
+        "  Template:\n"
+        "    Name: {{ metadata['Template.Name'] }}\n"
+        "    Hash: {{ metadata['Template.Hash'] }}\n"
+        "Resources:\n"
+        "  Vpc:\n"
+        "    Type: AWS::EC2::VPC\n"
+        "    Properties:\n"
+        "      CidrBlock: 10.0.0.0/16\n"
+    )
+
+
+def _imports(tmp_path, *args):
+    """Runs cloudbender and returns its imported top level modules and the
+    cumulative import time of cloudbender.cli"""
+    env = dict(os.environ, AWS_EC2_METADATA_DISABLED="true", AWS_CONFIG_FILE=os.devnull,
+               AWS_SHARED_CREDENTIALS_FILE=os.devnull)
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "from cloudbender.cli import cli; cli()", "--dir", str(tmp_path)]
+        + list(args),
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        env=env,
+        cwd=str(tmp_path),
+    )
+
+    modules = set()
+    cumulative = None
+    for line in proc.stderr.decode().splitlines():
+        if line.startswith("import time:") and "|" in line:
+            (_, total, name) = line.split("|")
+            name = name.strip()
+            modules.add(name.split(".")[0])
+            if name == "cloudbender.cli":
+                cumulative = int(total)
+
+    return (proc.returncode, modules, cumulative)
+
+
+@pytest.mark.parametrize(
+    "args, allowed",
+    [
+        (["version"], []),
+        (["render", "prod/vpc.yaml"], []),
+        # CloudFormation outputs need boto, nothing else, fails without AWS
+        (["outputs", "prod/vpc.yaml"], ["boto3", "botocore", "dateutil"]),
+    ],
+)
+def test_import_time(tmp_path, args, allowed):
+    _make_project(tmp_path)
+    (returncode, modules, cumulative) = _imports(tmp_path, *args)
+
+    assert returncode == 0 or args[0] == "outputs"
+    assert cumulative is not None
+    assert not (modules & (set(HEAVY) - set(allowed)))
+    assert cumulative < BUDGET
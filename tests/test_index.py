@@ -0,0 +1,104 @@
+import pathlib
+import types
+
+import pytest
+
+from cloudbender.cli import sort_stacks
+from cloudbender.core import CloudBender
+from cloudbender.index import StackIndex
+
+from .test_stackgroup import _make_project
+
+
+def _walk_stacks(sg):
+    return sg.stacks + [s for child in sg.sgs for s in _walk_stacks(child)]
+
+
+def _walk_groups(sg):
+    return [sg] + [g for child in sg.sgs for g in _walk_groups(child)]
+
+
+@pytest.fixture
+def cb(tmp_path):
+    _make_project(tmp_path)
+    cb = CloudBender(str(tmp_path), None, None, 1)
+    cb.read_config()
+    return cb
+
+
+@pytest.mark.parametrize(
+    "pattern", ["vpc.yaml", "us-east-1/dns.yaml", "prod/*/eks.yaml", "*.yaml", "missing.yaml"]
+)
+def test_index_get_stacks_by_path(cb, pattern):
+    for sg in _walk_groups(cb.sg):
+        assert sg.get_stacks(pattern, match_by="path") == [
+            s for s in _walk_stacks(sg) if s.path.match(pattern)
+        ]
+        assert sg.get_stacks(pattern, recursive=False, match_by="path") == [
+            s for s in sg.stacks if s.path.match(pattern)
+        ]
+
+
+def test_index_get_stacks_by_name(cb):
+    for sg in _walk_groups(cb.sg):
+        assert sg.get_stacks() == _walk_stacks(sg)
+        assert sg.get_stacks("vpc") == [s for s in _walk_stacks(sg) if s.stackname == "vpc"]
+
+
+@pytest.mark.parametrize("pattern", ["config", "prod", "us-east-1", "dev/us-east-1", "*-1", "missing"])
+def test_index_get_stackgroup(cb, pattern):
+    for sg in _walk_groups(cb.sg):
+        expected = [g for g in _walk_groups(sg) if g.path.match(pattern)]
+        assert sg.get_stackgroup(pattern) == (expected[0] if expected else None)
+
+
+def test_index_filter(cb):
+    for filter_by in [
+        {"provides": "vpc", "region": "us-east-1", "profile": "default"},
+        {"region": "eu-west-1", "profile": "default"},
+        {"stackname": "dns"},
+        {"mode": "CloudBender"},
+    ]:
+        assert cb.filter_stacks(filter_by) == [
+            s for s in cb.all_stacks if all(getattr(s, p) == v for p, v in filter_by.items())
+        ]
+
+
+def _stack(name, provides=None, dependencies=()):
+    s = types.SimpleNamespace(
+        id=("default", "eu-central-1", name),
+        stackname=name,
+        path=pathlib.Path(name + ".yaml"),
+        mode="CloudBender",
+        provides=provides or name,
+        profile="default",
+        region="eu-central-1",
+        dependencies=set(dependencies),
+    )
+    s.read_template_file = lambda: None
+    return s
+
+
+def test_sort_stacks():
+    stacks = [
+        _stack("app", dependencies=["dns", "vpc"]),
+        _stack("dns", dependencies=["vpc"]),
+        _stack("network", provides="vpc"),
+        _stack("other", dependencies=["unknown"]),
+    ]
+
+    steps = [sorted(s.stackname for s in step) for step in sort_stacks(None, stacks)]
+    assert [step for step in steps if step] == [["network", "other"], ["dns"], ["app"]]
+    assert len(StackIndex(stacks).by_provides["vpc"]) == 1
+
+
+def test_sort_stacks_ignores_unselected_providers():
+    # network provides vpc, but is not selected
+    stacks = [
+        _stack("app", dependencies=["dns"]),
+        _stack("dns", dependencies=["vpc"]),
+        _stack("other"),
+    ]
+
+    steps = [sorted(s.stackname for s in step) for step in sort_stacks(None, stacks)]
+    assert steps == [["dns", "other"], ["app"]]
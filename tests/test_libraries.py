@@ -136,3 +136,28 @@ def test_fetch_rejects_path_traversal(tmp_path):
         fetch_library(conn, None, "global", "s3://b/libs/bad",
                       "1.0", str(tmp_path))
     assert not (tmp_path.parent / "evil.py").exists()
+
+
+class NotModified(Exception):
+    response = {"ResponseMetadata": {"HTTPStatusCode": 304}}
+
+
+class CachingConn(FakeConn):
+    def call(self, service, command, kwargs={}, profile=None, region=None):
+        self.calls.append((service, command, dict(kwargs), profile, region))
+        if kwargs.get("IfNoneMatch") == '"v1"':
+            raise NotModified()
+        return {"Body": FakeBody(self._data), "ETag": '"v1"'}
+
+
+def test_fetch_s3_revalidates_cached_archive(tmp_path, monkeypatch):
+    monkeypatch.setattr("cloudbender.libraries.archives", {})
+    conn = CachingConn(_make_targz({"pulumi/vpc.py": "x = 1\n"}))
+
+    for dest in ["a", "b"]:
+        lib_root = fetch_library(conn, None, "global", "s3://b/libs/vpc",
+                                 "latest", str(tmp_path / dest))
+        assert (lib_root / "pulumi" / "vpc.py").is_file()
+
+    assert "IfNoneMatch" not in conn.calls[0][2]
+    assert conn.calls[1][2]["IfNoneMatch"] == '"v1"'
@@ -0,0 +1,379 @@
+import pathlib
+import shutil
+
+import pytest
+
+from cloudbender import cache
+from cloudbender.core import CloudBender
+from cloudbender.render import render_stacks
+from cloudbender.stack import reset_template_envs
+
+TEMPLATE = """AWSTemplateFormatVersion: '2010-09-09'
+Description: {{ metadata['Template.Name'] }}
+Metadata:
+  Template:
+    Name: {{ metadata['Template.Name'] }}
+    Hash: {{ metadata['Template.Hash'] }}
+  CloudBender:
+    Dependencies:
+      - base
+Resources:
+  Topic:
+    Type: AWS::SNS::Topic
+"""
+
+
+@pytest.fixture
+def project(tmp_path, monkeypatch):
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+
+    (tmp_path / "config" / "prod").mkdir(parents=True)
+    (tmp_path / "config" / "config.yaml").write_text(
+        "region: eu-central-1\nlibraries:\n  - url: local://libs/cfn\n")
+    cfn = tmp_path / "libs" / "cfn" / "cloudformation"
+    cfn.mkdir(parents=True)
+    for name in ["a", "b", "c"]:
+        (tmp_path / "config" / "prod" / (name + ".yaml")).write_text("options: {}\n")
+        (cfn / (name + ".yaml.jinja")).write_text(TEMPLATE)
+
+    return tmp_path
+
+
+def _render(project, workers):
+    cb = CloudBender(project, None, None)
+    cb.read_config()
+    stacks = cb.sg.get_stacks()
+    render_stacks(stacks, workers)
+
+    files = {
+        s.stackname: (project / "cloudformation" / "prod" / (s.stackname + ".yaml")).read_text()
+        for s in stacks
+    }
+    return (stacks, files)
+
+
+def test_pool_matches_sequential(project, caplog, monkeypatch):
+    # Always render, see test_unchanged_render_is_skipped
+    monkeypatch.setattr(cache, "enabled", False)
+    caplog.set_level("INFO", logger="cloudbender")
+    (stacks, files) = _render(project, 1)
+    sequential = [r.getMessage() for r in caplog.records]
+
+    # Unchanged templates are not written again
+    shutil.rmtree(project / "cloudformation")
+    caplog.clear()
+    (pooled_stacks, pooled_files) = _render(project, 2)
+    pooled = [r.getMessage() for r in caplog.records]
+
+    assert pooled_files == files
+    assert pooled == sequential
+    for s, p in zip(stacks, pooled_stacks):
+        assert p.md5 == s.md5
+        assert p.dependencies == s.dependencies == {"base"}
+        assert p.template_files == s.template_files
+
+
+def test_pool_raises_worker_errors(project):
+    (project / "libs" / "cfn" / "cloudformation" / "b.yaml.jinja").write_text("{{ broken")
+    cb = CloudBender(project, None, None)
+    cb.read_config()
+    stacks = cb.sg.get_stacks()
+
+    with pytest.raises(Exception, match="unexpected"):
+        render_stacks(stacks, 2)
+
+    # Stacks before the failing one are still written, none after it
+    names = [s.stackname for s in stacks]
+    for name in names:
+        written = (project / "cloudformation" / "prod" / (name + ".yaml")).is_file()
+        assert written == (names.index(name) < names.index("b"))
+
+
+def test_unchanged_render_is_skipped(project, caplog):
+    caplog.set_level("INFO", logger="cloudbender")
+    (stacks, files) = _render(project, 1)
+    assert not any(r.getMessage().endswith("render skipped.") for r in caplog.records)
+
+    caplog.clear()
+    (again, again_files) = _render(project, 1)
+    assert sorted(r.getMessage() for r in caplog.records if r.getMessage().endswith("render skipped.")) == [
+        "a unchanged, render skipped.",
+        "b unchanged, render skipped.",
+        "c unchanged, render skipped.",
+    ]
+    assert again_files == files
+    for s, a in zip(stacks, again):
+        assert (a.md5, a.dependencies, a.template_files) == (s.md5, s.dependencies, s.template_files)
+
+    # Any input changed renders again
+    (project / "libs" / "cfn" / "cloudformation" / "b.yaml.jinja").write_text(TEMPLATE + "# changed\n")
+    (project / "config" / "prod" / "c.yaml").write_text("options:\n  Changed: true\n")
+    caplog.clear()
+    _render(project, 1)
+    assert [r.getMessage() for r in caplog.records if r.getMessage().endswith("render skipped.")] == [
+        "a unchanged, render skipped."
+    ]
+
+
+def test_remote_library_render_is_skipped(project, caplog, monkeypatch):
+    import json
+
+    from cloudbender import stack as stack_module
+
+    fetch_local = stack_module.fetch_library
+
+    def fetch_library(conn, profile, region, url, version, dest_dir, root=None):
+        if url.startswith("local://"):
+            return fetch_local(conn, profile, region, url, version, dest_dir, root)
+        lib_root = pathlib.Path(dest_dir) / "remote-{}".format(version)
+        (lib_root / "cloudformation").mkdir(parents=True, exist_ok=True)
+        (lib_root / "cloudformation" / "remote.yaml.jinja").write_text(TEMPLATE)
+        return lib_root
+
+    monkeypatch.setattr(stack_module, "fetch_library", fetch_library)
+    (project / "config" / "prod" / "remote.yaml").write_text(
+        "options: {}\nlibraries:\n  - url: s3://bucket/lib\n    version: '1.0'\n")
+
+    caplog.set_level("INFO", logger="cloudbender")
+    _render(project, 1)
+    # the work_dir with the fetched library is gone with every run
+    reset_template_envs()
+
+    caplog.clear()
+    _render(project, 1)
+    assert "remote unchanged, render skipped." in [r.getMessage() for r in caplog.records]
+
+    entries = json.loads((project / "cloudformation" / "prod" / ".manifest.json").read_text())
+    assert list(entries["remote.yaml"]["files"]) == ["s3://bucket/lib@1.0/cloudformation/remote.yaml.jinja"]
+    assert list(entries["a.yaml"]["files"]) == ["libs/cfn/cloudformation/a.yaml.jinja"]
+
+
+def test_new_template_earlier_in_search_path_renders(project, caplog):
+    (project / "config" / "config.yaml").write_text(
+        "region: eu-central-1\nlibraries:\n  - url: local://libs/override\n  - url: local://libs/cfn\n")
+    (project / "libs" / "override" / "cloudformation").mkdir(parents=True)
+    _render(project, 1)
+
+    (project / "libs" / "override" / "cloudformation" / "a.yaml.jinja").write_text(
+        TEMPLATE + "  Override:\n    Type: AWS::SNS::Topic\n")
+    reset_template_envs()
+    caplog.set_level("INFO", logger="cloudbender")
+    (stacks, files) = _render(project, 1)
+    assert "a unchanged, render skipped." not in [r.getMessage() for r in caplog.records]
+    assert "Override:" in files["a"]
+
+
+def test_post_process(tmp_path):
+    from cloudbender.stack import Stack
+
+    stack = Stack("vpc", "vpc", tmp_path / "vpc.yaml", "", {})
+    stack.mode = "CloudBender"
+    stack.cfn_template = """
+
+AWSTemplateFormatVersion: '2010-09-09'
+Transform: [CloudBender]
+Metadata:
+  Template:
+    Hash: __HASH__
+
+Parameters:
+
+  Conglomerate:
+    Type: String
+    Description: Project / Namespace this stack is part of
+
+Conditions:
+Resources:
+  Topic:
+    Type: AWS::SNS::Topic
+
+
+
+Outputs:
+  Arn:
+    Value:
+      Fn::GetAtt: [FortyTwo, base.Arn]
+"""
+    stack._post_process()
+
+    assert stack.cfn_template == """AWSTemplateFormatVersion: '2010-09-09'
+
+Metadata:
+  Template:
+    Hash: {}
+
+Resources:
+  Topic:
+    Type: AWS::SNS::Topic
+
+Outputs:
+  Arn:
+    Value:
+      Fn::GetAtt: [FortyTwo, base.Arn]""".format(stack.md5)
+    assert list(stack.cfn_data) == ["AWSTemplateFormatVersion", "Metadata", "Resources", "Outputs"]
+    assert stack.dependencies == {"base"}
+
+
+def test_loader_ignores_unknown_tags():
+    import yaml
+
+    from cloudbender.stack import SafeLoaderIgnoreUnknown
+
+    doc = "A: !Ref Vpc\nB: !GetAtt [Vpc, Arn]\nC: !Sub\n  - x\nD: [1, yes, '2']\n"
+    assert yaml.load(doc, Loader=SafeLoaderIgnoreUnknown) == {
+        "A": "!Ref", "B": "!GetAtt", "C": "!Sub", "D": [1, True, "2"]}
+    if yaml.__with_libyaml__:
+        assert issubclass(SafeLoaderIgnoreUnknown, yaml.CSafeLoader)
+
+
+def test_identical_stacks_render_once(project, caplog, monkeypatch):
+    monkeypatch.setattr(cache, "enabled", False)
+    for region in ["eu-west-1", "us-east-1"]:
+        (project / "config" / "prod" / region).mkdir()
+        (project / "config" / "prod" / region / "config.yaml").write_text("region: {}\n".format(region))
+        (project / "config" / "prod" / region / "a.yaml").write_text(
+            "options: {}\n" + ("dependencies: [dns]\n" if region == "us-east-1" else ""))
+
+    caplog.set_level("INFO", logger="cloudbender")
+    (stacks, files) = _render(project, 1)
+
+    rendering = [r.getMessage() for r in caplog.records if r.getMessage().startswith("Rendering")]
+    assert len(rendering) == 3
+    reused = [s for s in stacks if s.stackname == "a" and s.rel_path != "prod"]
+    assert len(reused) == 2
+    first = [s for s in stacks if s.stackname == "a" and s.rel_path == "prod"][0]
+    for s in reused:
+        assert s.cfn_template == first.cfn_template and s.md5 == first.md5
+        assert (project / "cloudformation" / s.rel_path / "a.yaml").read_text() == first.cfn_template
+        assert s.cfn_data == first.cfn_data and s.cfn_data is not first.cfn_data
+        assert s.hooks is not first.hooks and s.hooks["post_create"] is not first.hooks["post_create"]
+    assert sorted(s.dependencies for s in reused) == [{"base"}, {"base", "dns"}]
+
+
+class _FakeS3:
+    def __init__(self):
+        self.objects = {}
+        self.puts = 0
+
+    def call(self, service, command, kwargs={}, profile=None, region=None):
+        from botocore.exceptions import ClientError
+
+        key = (kwargs["Bucket"], kwargs["Key"])
+        if command == "head_object":
+            if key not in self.objects:
+                raise ClientError({"Error": {"Code": "404"}}, command)
+            return {"ETag": '"etag"', "Metadata": self.objects[key]}
+
+        self.puts += 1
+        self.objects[key] = kwargs["Metadata"]
+        return {}
+
+
+def test_unchanged_templates_not_written(project, caplog, monkeypatch):
+    monkeypatch.setattr(cache, "enabled", False)
+    s3 = _FakeS3()
+    cb = CloudBender(project, None, None)
+    cb.read_config()
+    stacks = cb.sg.get_stacks()
+    for s in stacks:
+        s.template_bucket_url = "s3://bucket/templates"
+        s.connection_manager = s3
+
+    caplog.set_level("INFO", logger="cloudbender")
+    render_stacks(stacks)
+    assert caplog.records[-1].getMessage() == "Templates: 3 written, 0 unchanged, 3 uploaded, 0 unchanged in S3"
+    assert s3.puts == 3
+
+    caplog.clear()
+    render_stacks(stacks)
+    assert caplog.records[-1].getMessage() == "Templates: 0 written, 3 unchanged, 0 uploaded, 3 unchanged in S3"
+    assert s3.puts == 3
+
+
+def test_json_template_format(project):
+    import json
+
+    (project / "libs" / "cfn" / "cloudformation" / "a.yaml.jinja").write_text(
+        TEMPLATE + "    Properties:\n      TopicName: !Sub '${AWS::StackName}-topic'\n"
+        "Outputs:\n  Arn:\n    Value: !GetAtt Topic.TopicArn\n")
+    (project / "config" / "prod" / "a.yaml").write_text("options:\n  TemplateFormat: json\n")
+
+    (stacks, files) = _render(project, 1)
+    data = json.loads(files["a"])
+    a = [s for s in stacks if s.stackname == "a"][0]
+    assert "\n" not in files["a"]
+    assert data["Metadata"]["Template"]["Hash"] == a.md5
+    assert data["AWSTemplateFormatVersion"] == "2010-09-09"
+    assert data["Resources"]["Topic"]["Properties"]["TopicName"] == {"Fn::Sub": "${AWS::StackName}-topic"}
+    assert data["Outputs"]["Arn"]["Value"] == {"Fn::GetAtt": ["Topic", "TopicArn"]}
+
+    # The embedded hash still verifies when read back
+    a.cfn_template = None
+    a.md5 = None
+    a.read_template_file()
+    assert a.md5 == data["Metadata"]["Template"]["Hash"]
+    assert a.dependencies == {"base"}
+
+
+def test_json_template_format_dependencies(project):
+    (project / "libs" / "cfn" / "cloudformation" / "a.yaml.jinja").write_text(
+        TEMPLATE + "Outputs:\n  Vpc:\n    Value: !GetAtt FortyTwo.vpc.VpcId\n")
+
+    dependencies = {}
+    for template_format in ["yaml", "json", "json"]:
+        (project / "config" / "prod" / "a.yaml").write_text(
+            "options:\n  TemplateFormat: {}\n".format(template_format))
+        (stacks, files) = _render(project, 1)
+        a = [s for s in stacks if s.stackname == "a"][0]
+        dependencies.setdefault(template_format, []).append(a.dependencies)
+
+    assert dependencies["json"] == [dependencies["yaml"][0]] * 2
+
+
+def test_json_template_format_unsupported(project):
+    (project / "libs" / "cfn" / "cloudformation" / "a.yaml.jinja").write_text(
+        TEMPLATE + "    Properties:\n      Tags: !!binary aGVsbG8=\n")
+    (project / "config" / "prod" / "a.yaml").write_text("options:\n  TemplateFormat: json\n")
+
+    with pytest.raises(ValueError, match="Cannot write a as JSON template"):
+        _render(project, 1)
+
+
+@pytest.mark.parametrize(
+    "template_format,resource",
+    [
+        ("yaml", "  Vpc:\n    Type: CloudBender::EC2::VPC\n"),
+        ("json", "  Vpc:\n    Type: CloudBender::EC2::VPC\n"),
+        ("yaml", "  Topics:\n    Type: AWS::SNS::Topic\n    Iterate: [a, b]\n"),
+        ("json", "  Topics:\n    Type: AWS::SNS::Topic\n    Iterate: [a, b]\n"),
+    ],
+)
+def test_skipped_render_keeps_dependencies(project, template_format, resource):
+    (project / "libs" / "cfn" / "cloudformation" / "a.yaml.jinja").write_text(TEMPLATE + resource)
+    (project / "config" / "prod" / "a.yaml").write_text(
+        "options:\n  TemplateFormat: {}\n".format(template_format))
+
+    (stacks, files) = _render(project, 1)
+    manifest = project / "cloudformation" / "prod" / ".manifest.json"
+    mtime = manifest.stat().st_mtime_ns
+
+    (again, again_files) = _render(project, 1)
+    assert [s.dependencies for s in again] == [s.dependencies for s in stacks]
+    assert {"base", "CloudBender"} in [s.dependencies for s in again]
+
+    # Nothing changed, so neither did the manifest
+    assert manifest.stat().st_mtime_ns == mtime
+
+
+def test_imported_macros_use_own_config(project):
+    cfn = project / "libs" / "cfn" / "cloudformation"
+    (cfn / "macros.jinja").write_text(
+        "{% macro name() %}direct={{ _config.options.Name }} option={{ option('Name') }}{% endmacro %}\n")
+    for name in ["a", "b"]:
+        (cfn / (name + ".yaml.jinja")).write_text(
+            "{% import 'macros.jinja' as m %}\n" + TEMPLATE + "Outputs:\n  Name:\n    Value: {{ m.name() }}\n")
+        (project / "config" / "prod" / (name + ".yaml")).write_text("options:\n  Name: {}\n".format(name))
+
+    (stacks, files) = _render(project, 1)
+    for name in ["a", "b"]:
+        assert "Value: direct={0} option={0}".format(name) in files[name]
@@ -0,0 +1,309 @@
+import base64
+import hashlib
+import os
+
+import pytest
+import yaml
+
+from cloudbender import sops
+
+
+ENCRYPTED = "password: ENC[AES256_GCM,data:abc]\nsops:\n  version: 3.8.1\n"
+PLAIN = "password: secret\n"
+
+
+@pytest.fixture
+def fake_sops(monkeypatch, tmp_path):
+    monkeypatch.setenv("XDG_CONFIG_HOME", str(tmp_path / "config"))
+    calls = []
+
+    def _decrypt_sops(path, config_raw):
+        calls.append(config_raw)
+        return (PLAIN, True)
+
+    monkeypatch.setattr(sops, "_decrypt_sops", _decrypt_sops)
+    return calls
+
+
+def test_sops_cache_hit(fake_sops):
+    assert sops.decrypt("a.yaml", ENCRYPTED) == PLAIN
+    assert sops.decrypt("a.yaml", ENCRYPTED) == PLAIN
+    assert len(fake_sops) == 1
+
+
+def test_sops_cache_invalidated_by_change(fake_sops):
+    sops.decrypt("a.yaml", ENCRYPTED)
+    sops.decrypt("a.yaml", ENCRYPTED + "# changed\n")
+    assert len(fake_sops) == 2
+
+
+def test_sops_cache_encrypted_at_rest(fake_sops, cache_dir):
+    sops.decrypt("a.yaml", ENCRYPTED)
+
+    entries = [p for p in cache_dir.rglob("*") if p.is_file()]
+    assert entries
+    for p in entries:
+        assert b"secret" not in p.read_bytes()
+
+
+def test_sops_cache_wrong_key(fake_sops, monkeypatch):
+    monkeypatch.setenv("CLOUDBENDER_SOPS_CACHE_KEY", "one")
+    sops.decrypt("a.yaml", ENCRYPTED)
+
+    monkeypatch.setenv("CLOUDBENDER_SOPS_CACHE_KEY", "two")
+    assert sops.decrypt("a.yaml", ENCRYPTED) == PLAIN
+    assert len(fake_sops) == 2
+
+
+def test_sops_cache_disabled(fake_sops, monkeypatch):
+    monkeypatch.setattr(sops, "cache_enabled", False)
+    sops.decrypt("a.yaml", ENCRYPTED)
+    sops.decrypt("a.yaml", ENCRYPTED)
+    assert len(fake_sops) == 2
+
+
+def test_sops_cache_ignores_failed_decrypt(fake_sops, monkeypatch):
+    working = sops._decrypt_sops
+    monkeypatch.setattr(sops, "_decrypt_sops", lambda path, raw: ("", False))
+    assert sops.decrypt("a.yaml", ENCRYPTED) == ""
+
+    monkeypatch.setattr(sops, "_decrypt_sops", working)
+    assert sops.decrypt("a.yaml", ENCRYPTED) == PLAIN
+    assert len(fake_sops) == 1
+
+
+# Minimal sops / age encryption, enough to test the in process decryption
+def _age_encrypt(plain, public):
+    from cryptography.hazmat.primitives import hashes, hmac
+    from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey, X25519PublicKey
+    from cryptography.hazmat.primitives.ciphers.aead import ChaCha20Poly1305
+    from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+    from cryptography.hazmat.primitives.serialization import Encoding, PublicFormat
+
+    def _hkdf(key, salt, info):
+        return HKDF(algorithm=hashes.SHA256(), length=32, salt=salt, info=info).derive(key)
+
+    def _b64(b):
+        return base64.b64encode(b).rstrip(b"=")
+
+    file_key = os.urandom(16)
+    ephemeral = X25519PrivateKey.generate()
+    ephemeral_public = ephemeral.public_key().public_bytes(Encoding.Raw, PublicFormat.Raw)
+    shared = ephemeral.exchange(X25519PublicKey.from_public_bytes(public))
+    wrap_key = _hkdf(shared, ephemeral_public + public, b"age-encryption.org/v1/X25519")
+    body = ChaCha20Poly1305(wrap_key).encrypt(b"\0" * 12, file_key, None)
+
+    header = b"age-encryption.org/v1\n-> X25519 " + _b64(ephemeral_public) + b"\n" + _b64(body) + b"\n---"
+    h = hmac.HMAC(_hkdf(file_key, b"", b"header"), hashes.SHA256())
+    h.update(header)
+
+    nonce = os.urandom(16)
+    payload = ChaCha20Poly1305(_hkdf(file_key, nonce, b"payload")).encrypt(b"\0" * 11 + b"\1", plain, None)
+    data = header + b" " + _b64(h.finalize()) + b"\n" + nonce + payload
+
+    return "-----BEGIN AGE ENCRYPTED FILE-----\n{}\n-----END AGE ENCRYPTED FILE-----\n".format(
+        base64.encodebytes(data).decode())
+
+
+def _sops_encrypt(tree, public):
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+    data_key = os.urandom(32)
+    mac = hashlib.sha512()
+
+    def _enc(value, aad, _type):
+        iv = os.urandom(32)
+        ct = AESGCM(data_key).encrypt(iv, value.encode(), aad.encode())
+        return "ENC[AES256_GCM,data:{},iv:{},tag:{},type:{}]".format(
+            base64.b64encode(ct[:-16]).decode(), base64.b64encode(iv).decode(),
+            base64.b64encode(ct[-16:]).decode(), _type)
+
+    def _walk(node, path):
+        if isinstance(node, dict):
+            return {k: _walk(v, path + [k]) for k, v in node.items()}
+        if isinstance(node, list):
+            return [_walk(v, path) for v in node]
+        # floats as Go formats them, 2.0 -> 2
+        plain = repr(node).rstrip("0").rstrip(".") if isinstance(node, float) else str(node)
+        mac.update(plain.encode())
+        return _enc(plain, ":".join(path) + ":", type(node).__name__)
+
+    encrypted = _walk(tree, [])
+    lastmodified = "2024-01-01T00:00:00Z"
+    encrypted["sops"] = {
+        "age": [{"recipient": "age1test", "enc": _age_encrypt(data_key, public)}],
+        "lastmodified": lastmodified,
+        "mac": _enc(mac.hexdigest().upper(), lastmodified, "str"),
+        "version": "3.8.1",
+    }
+    return (yaml.safe_dump(encrypted, sort_keys=False), data_key, _enc)
+
+
+@pytest.fixture
+def age_key(monkeypatch, tmp_path):
+    from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey
+    from cryptography.hazmat.primitives.serialization import Encoding, PublicFormat, PrivateFormat, NoEncryption
+
+    key = X25519PrivateKey.generate()
+    private = key.private_bytes(Encoding.Raw, PrivateFormat.Raw, NoEncryption())
+
+    # bech32 encode
+    charset = "qpzry9x8gf2tvdw0s3jn54khce6mua7l"
+    hrp = "age-secret-key-"
+    data = []
+    acc = bits = 0
+    for b in private:
+        acc = (acc << 8) | b
+        bits += 8
+        while bits >= 5:
+            bits -= 5
+            data.append((acc >> bits) & 31)
+    data.append((acc << (5 - bits)) & 31)
+    chk = 1
+    for v in [ord(c) >> 5 for c in hrp] + [0] + [ord(c) & 31 for c in hrp] + data + [0] * 6:
+        b = chk >> 25
+        chk = (chk & 0x1FFFFFF) << 5 ^ v
+        for i, g in enumerate([0x3B6A57B2, 0x26508E6D, 0x1EA119FA, 0x3D4233DD, 0x2A1462B3]):
+            chk ^= g if ((b >> i) & 1) else 0
+    chk ^= 1
+    data += [(chk >> 5 * (5 - i)) & 31 for i in range(6)]
+
+    key_file = tmp_path / "keys.txt"
+    key_file.write_text("# test\n" + (hrp + "1" + "".join(charset[d] for d in data)).upper() + "\n")
+    monkeypatch.setenv("SOPS_AGE_KEY_FILE", str(key_file))
+    monkeypatch.setattr(sops, "cache_enabled", False)
+
+    return key.public_key().public_bytes(Encoding.Raw, PublicFormat.Raw)
+
+
+TREE = {
+    "password": "secret",
+    "port": 5432,
+    "ratio": 1.5,
+    "enabled": True,
+    "nested": {"hosts": ["a", "b"], "empty": 2.0},
+}
+
+
+# Written by sops 3.11.0 for the age identity below, only used by these tests
+AGE_IDENTITY = "AGE-SECRET-KEY-14TRTWPN6SRWUX4XVR7K3JVFHUGDZ6K8V5X4XPZNPCCMVP8Z8VK2SUPU6HZ"
+
+SOPS_ENCRYPTED = """\
+#ENC[AES256_GCM,data:zA5bDLpkDwlW,iv:huezyomonQ0x6HLvtUKzF6IGlHdnIdBwebnTkeelIF0=,tag:sp1oY+HXiKgU5sPykJNxUg==,type:comment]
+password: ENC[AES256_GCM,data:DrDGXFs4q0S6bxRD,iv:Dwn7etE61MYSRtF66VIXwPN35Mx9wFZDkt1vLirVHV8=,tag:c00sTfMDb+yrV/0WYbkc/Q==,type:str]
+port: ENC[AES256_GCM,data:zsDG8w==,iv:5T9AjvLXIC6LqiaQbjYP+apwmPMkxQHFAubRUJTX4qM=,tag:XeGLn3Hi0o1KLxDm6/VGPw==,type:int]
+ratio: ENC[AES256_GCM,data:8e6k,iv:axRK6I/KgzfFJbOzi3rrBRW4GTeq8LgGhoDJyopWm7A=,tag:G1SQ5+55u6gNW9EkM31uJg==,type:float]
+large: ENC[AES256_GCM,data:hsUc0YW68w==,iv:Nyo0cbVzcL9GyArpbqQAhjVnwSGd9AuMAbNimoyf2CE=,tag:Wck6K/t8rAxsR/2MwTNWPg==,type:float]
+enabled: ENC[AES256_GCM,data:m+915w==,iv:6QUtAwgm/7S+mmfy69FzL9U2BoWoMv+I0SaZ8J2kgIA=,tag:yp6eZp3SMy6HGNC9CgMo1Q==,type:bool]
+nested:
+    #ENC[AES256_GCM,data:xKEeLX0jZpO1UPv4G8oK,iv:i7/SFnuFkI9UBtuyFlHJx2yIMIo7/MPYgjEoCmMy7Q4=,tag:RIB9kds03e+99w/5qd4GSg==,type:comment]
+    hosts:
+        - ENC[AES256_GCM,data:cr3R9DILUw3EWDWvKvMG,iv:SlihLuRxohKly55cK6Iid1vPqZInl+VcjnKeFxqyr14=,tag:LHd8RwfegSsLOTV+zX4MGg==,type:str]
+        - ENC[AES256_GCM,data:IVgvxivXcASdTbjnTpgz,iv:ezl6oas+PA7wl181Mg5yniStlGa6j98TgL7Ck/G+WpY=,tag:NL09YmwHXefw4Sio5mkWOg==,type:str]
+    empty: ENC[AES256_GCM,data:0w==,iv:dQ3KtfSekXzC82REk8NQf3CfPEEpOcQyLJ4GP8TiZ0k=,tag:4e9mYTGtyvzLqeqKise+Yg==,type:float]
+sops:
+    age:
+        - recipient: age1pjlqru2pglsz0zv6n7tr39d3f5xgxnhytaccsy7m5xu58awx6uksv849fy
+          enc: |
+            -----BEGIN AGE ENCRYPTED FILE-----
+            YWdlLWVuY3J5cHRpb24ub3JnL3YxCi0+IFgyNTUxOSA1ZElJU05Vc1BONE5VNmlv
+            VlAvOXhhM3JwaCt4WkVOVzJ2azF3bCtZM1FnCmsraFNqT2lyVWk2a3FHeWlFTVdY
+            OW9VTEtRVXpRTGtTdkRyWmZTR2VZRHcKLS0tIEdCVmRQTjFTRVpXR29yQnRLSXZP
+            K0crS0NjaGtlY2ZLR25oVHVDSC90RDAKRgQhdJVPr+mmi//irm6p3sxABWXYaIyt
+            ZRNrPyaNCeF4FmfKa4pQberq+ZpHTpBb6r9wB1gjLcTWsMtOIHoNjQ==
+            -----END AGE ENCRYPTED FILE-----
+    lastmodified: "2026-10-16T23:40:36Z"
+    mac: ENC[AES256_GCM,data:58fGHMWklpL/kQRyCaKohTVyRmKqoPwuauKTHZ8Zmc3rwBOwbjVvtIDmjKO5NCXy7Fd4S3WMU5zOFvo/QPXbV+NOzjcYrAhUOpw5weVjs1/WnpxARCuW/Eii2ekGHdnA7kL6zZwCUUsKpdoThZGmzQdHteP1amBLQfogQDlra+Y=,iv:VTCwj47O/wuKyNIEq1hrD/upI1R0p40jaVSeFIpDJOc=,tag:01KuPE2nWsVfcvTCevRHHw==,type:str]
+    unencrypted_suffix: _unencrypted
+    version: 3.11.0
+"""
+
+# sops --decrypt of SOPS_ENCRYPTED
+SOPS_DECRYPTED = """\
+# database
+password: p4ssw0rd-X_.
+port: 5432
+ratio: 1.5
+large: 1e+06
+enabled: true
+nested:
+    # hosts to allow
+    hosts:
+        - db1.example.com
+        - db2.example.com
+    empty: 2
+"""
+
+# Needs quoting, which we leave to sops
+SOPS_QUOTED = """\
+password: ENC[AES256_GCM,data:MNyYP4nSreaMI3c=,iv:87GcaD95LV6oVzL4ezAsHFcoXkOB1fIVoBIbnBbmkXI=,tag:JJdfEotKUbmpYDOWWQVfsQ==,type:str]
+sops:
+    age:
+        - recipient: age1pjlqru2pglsz0zv6n7tr39d3f5xgxnhytaccsy7m5xu58awx6uksv849fy
+          enc: |
+            -----BEGIN AGE ENCRYPTED FILE-----
+            YWdlLWVuY3J5cHRpb24ub3JnL3YxCi0+IFgyNTUxOSBzbENjYzA2RW53TjJnN2xR
+            NGNYaTNSUExGejA5L09vWXFCeTlwa0JTR0N3ClpHVEdaWEZDYTd5cVlIc1RwYkI5
+            VG5CSTk0b1hrQ1hUalZGM29uU2NYUHMKLS0tIEpqYVREbU5OY05nUFFqOVFlayto
+            aVhrZ1hDbVFMWmtSZGhMMkgyT2lpakUKyxMXowlIF2zrGsRtjTxCxAdwSpNnMynG
+            t0rapHaA0YKHsQ5aMMrDCPf2YQF/JaA1JmI2WIsM+V2QjGXo+OyCpA==
+            -----END AGE ENCRYPTED FILE-----
+    lastmodified: "2026-10-16T23:40:36Z"
+    mac: ENC[AES256_GCM,data:T2yKuIRLUr6hkuMCGUV6npFzVhUhyLDYIBIQOMpWNrAAXKQGRIgyvv5+Kq9HcBdrmJ3RlXYnUjt7PiRKW8cMBFJ0Pi3YmNG5VfWU9pnR0pRSlidF71PjUJmLUS3FPy3PgqxLQcyZwRBq/R8+1xqi0Xm17BLN6bC28WmlalqpqD4=,iv:ZPpVStCf40sy8U5ZAuh9m/k0fkL7FvtE1qZhQmRYVzw=,tag:0qOtV6XIW4GBky+OL3ksHw==,type:str]
+    unencrypted_suffix: _unencrypted
+    version: 3.11.0
+"""
+
+
+@pytest.fixture
+def sops_identity(monkeypatch, tmp_path):
+    monkeypatch.setenv("SOPS_AGE_KEY", AGE_IDENTITY)
+    monkeypatch.setenv("SOPS_AGE_KEY_FILE", str(tmp_path / "missing.txt"))
+    monkeypatch.setattr(sops, "cache_enabled", False)
+
+
+def test_sops_age_matches_sops(sops_identity, fake_sops):
+    assert sops.decrypt("a.yaml", SOPS_ENCRYPTED) == SOPS_DECRYPTED
+    assert not fake_sops
+
+
+def test_sops_age_fallback_for_quoted_values(sops_identity, fake_sops):
+    assert sops.decrypt("a.yaml", SOPS_QUOTED) == PLAIN
+
+    # unknown value outside of the tree
+    unknown = SOPS_ENCRYPTED + "# ENC[AES256_GCM,data:AA==,iv:AA==,tag:AA==,type:str]\n"
+    assert sops.decrypt("a.yaml", unknown) == PLAIN
+    assert len(fake_sops) == 2
+
+
+def test_sops_go_float():
+    assert [sops._go_float(v) for v in ["2", "1.5", "-0", "1000000", "123456", "0.0001", "0.00001"]] == [
+        "2", "1.5", "-0", "1e+06", "123456", "0.0001", "1e-05"]
+
+
+def test_sops_age_comments(age_key, fake_sops):
+    (encrypted, data_key, _enc) = _sops_encrypt(TREE, age_key)
+    encrypted = "#{}\n".format(_enc(" top", ":", "comment")) + encrypted.replace(
+        "  hosts:", "  #{}\n  hosts:".format(_enc(" nested", "nested:", "comment")))
+
+    plain = sops.decrypt("a.yaml", encrypted)
+    assert not fake_sops
+    assert plain.startswith("# top\n")
+    assert "  # nested\n  hosts:" in plain
+    assert yaml.safe_load(plain) == TREE
+
+
+def test_sops_age_fallback(age_key, fake_sops):
+    (encrypted, data_key, _enc) = _sops_encrypt(TREE, age_key)
+
+    # tampered data fails the MAC
+    tampered = encrypted.replace("port: ENC", "other: 1\nport: ENC")
+    assert sops.decrypt("a.yaml", tampered) == PLAIN
+
+    # not our key
+    from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey
+    from cryptography.hazmat.primitives.serialization import Encoding, PublicFormat
+
+    other = X25519PrivateKey.generate().public_key().public_bytes(Encoding.Raw, PublicFormat.Raw)
+    assert sops.decrypt("a.yaml", _sops_encrypt(TREE, other)[0]) == PLAIN
+    assert len(fake_sops) == 2
@@ -1,8 +1,10 @@
 import io
 import tarfile
 
+import jinja2
 import pytest
 
+from cloudbender.jinja import JinjaEnv
 from cloudbender.stack import Stack
 
 
@@ -33,7 +35,8 @@ def _targz_file(path, content):
 
 
 def _make_stack(tmp_path, libraries):
-    ctx = {"root": str(tmp_path), "region": None, "profile": None}
+    ctx = {"root": str(tmp_path), "region": None, "profile": None,
+           "template_path": tmp_path / "cloudformation"}
     stack = Stack(
         name="vpc",
         template="vpc",
@@ -157,3 +160,42 @@ def test_render_missing_template_lists_loaded_libraries(tmp_path):
     # work_dir is cleaned up even on the failure path
     assert not stack.work_dir or not __import__(
         "os").path.exists(stack.work_dir)
+
+
+def test_stacks_share_template_env(tmp_path):
+    lib1 = _make_lib(tmp_path, "lib1", ["cloudformation"])
+    (lib1 / "cloudformation" / "vpc.yaml.jinja").write_text("Description: vpc\n")
+
+    stacks = []
+    for name in ["vpc1", "vpc2"]:
+        stack = _make_stack(tmp_path, [{"url": "local://{}".format(lib1)}])
+        stack.stackname = name
+        stack.mode = "CloudBender"
+        stack.render()
+        stacks.append(stack)
+
+    assert stacks[0]._template_env() is stacks[1]._template_env()
+    assert stacks[1].loaded_libraries == ["local://{}".format(lib1)]
+    # the cached template still counts as input of every stack
+    assert stacks[1].template_files == {str(lib1 / "cloudformation" / "vpc.yaml.jinja")}
+
+
+def test_indexed_loader_precedence(tmp_path):
+    lib1 = _make_lib(tmp_path, "lib1", ["cloudformation/sub"])
+    lib2 = _make_lib(tmp_path, "lib2", ["cloudformation/sub"])
+    (lib1 / "cloudformation" / "sub" / "a.jinja").write_text("lib1")
+    (lib2 / "cloudformation" / "sub" / "a.jinja").write_text("lib2")
+    (lib2 / "cloudformation" / "b.jinja").write_text("lib2")
+
+    jenv = JinjaEnv([lib1 / "cloudformation", lib2 / "cloudformation"])
+    assert jenv.get_template("sub/a.jinja").render() == "lib1"
+    assert jenv.get_template("b.jinja").render() == "lib2"
+
+    # files added or removed after indexing
+    (lib1 / "cloudformation" / "c.jinja").write_text("lib1")
+    assert jenv.get_template("c.jinja").render() == "lib1"
+    (lib1 / "cloudformation" / "sub" / "a.jinja").unlink()
+    assert jenv.get_template("sub/a.jinja").render() == "lib2"
+
+    with pytest.raises(jinja2.TemplateNotFound):
+        jenv.get_template("../lib1/cloudformation/c.jinja")
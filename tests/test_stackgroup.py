@@ -0,0 +1,114 @@
+import pytest
+
+from cloudbender.core import CloudBender
+
+
+def _make_project(root):
+    config = root / "config"
+    config.mkdir()
+    (config / "config.yaml").write_text(
+        "region: eu-central-1\n"
+        "variables:\n"
+        "  Owner: ops\n"
+        "options:\n"
+        "  Size: small\n"
+    )
+
+    for env in ["dev", "prod"]:
+        group = config / env
+        group.mkdir()
+        (group / "config.yaml").write_text(
+            "variables:\n"
+            "  Env: {}\n"
+            "tags:\n"
+            "  Owner: '{{{{ Owner }}}}'\n"
+            "parameters:\n"
+            "  Conglomerate: {}\n".format(env, env)
+        )
+        for region in ["eu-west-1", "us-east-1"]:
+            sub = group / region
+            sub.mkdir()
+            (sub / "config.yaml").write_text("region: {}\n".format(region))
+            for name in ["vpc", "dns", "eks"]:
+                (sub / "{}.yaml".format(name)).write_text(
+                    "tags:\n"
+                    "  Env: '{{{{ Env }}}}'\n"
+                    "options:\n"
+                    "  Name: {}\n".format(name)
+                )
+
+
+def _load(root, workers):
+    cb = CloudBender(str(root), None, None, workers)
+    cb.read_config()
+    return cb
+
+
+def _summary(cb):
+    return [
+        (s.id, s.rel_path, s.tags, s.parameters, s.options) for s in cb.all_stacks
+    ]
+
+
+@pytest.mark.parametrize("workers", [2, 8])
+def test_parallel_read_config_matches_sequential(tmp_path, workers):
+    _make_project(tmp_path)
+
+    sequential = _load(tmp_path, 1)
+    parallel = _load(tmp_path, workers)
+
+    assert len(sequential.all_stacks) == 12
+    assert _summary(parallel) == _summary(sequential)
+
+
+def test_parallel_read_config_inherits_parent_config(tmp_path):
+    _make_project(tmp_path)
+
+    cb = _load(tmp_path, 4)
+    stacks = cb.resolve_stacks("prod/us-east-1/vpc.yaml")
+
+    assert len(stacks) == 1
+    assert stacks[0].region == "us-east-1"
+    assert stacks[0].tags == {"Owner": "ops", "Env": "prod", "Artifact": "vpc"}
+    assert stacks[0].options == {"Size": "small", "Name": "vpc"}
+    assert stacks[0].parameters == {"Conglomerate": "prod"}
+
+
+@pytest.mark.parametrize(
+    "token",
+    [
+        "prod/us-east-1/vpc.yaml",
+        "config/prod/us-east-1/vpc.yaml",
+        "vpc.yaml",
+        "prod",
+        "config/dev/eu-west-1/",
+        "config",
+    ],
+)
+def test_scoped_read_config_matches_full(tmp_path, token):
+    _make_project(tmp_path)
+
+    full = _load(tmp_path, 1)
+    cb = CloudBender(str(tmp_path), None, None, 1)
+    cb.read_config(targets=[token])
+
+    assert [(s.id, s.tags, s.options) for s in cb.resolve_stacks(token)] == [
+        (s.id, s.tags, s.options) for s in full.resolve_stacks(token)
+    ]
+
+
+def test_scoped_read_config_only_reads_targets(tmp_path):
+    _make_project(tmp_path)
+
+    cb = CloudBender(str(tmp_path), None, None, 1)
+    cb.read_config(targets=["prod/us-east-1/vpc.yaml"])
+
+    assert [s.path for s in cb.sg.get_stacks()] == [
+        tmp_path / "config/prod/us-east-1/vpc.yaml"]
+    assert [sg.path.name for sg in cb.sg.sgs] == ["prod"]
+
+    # everything else is read on demand, keeping the stacks read so far
+    (vpc,) = cb.sg.get_stacks()
+    assert len(cb.all_stacks) == 12
+    assert vpc in cb.all_stacks
+    assert cb.resolve_stacks("prod/us-east-1/vpc.yaml") == [vpc]
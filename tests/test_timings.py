@@ -0,0 +1,75 @@
+import json
+
+import pytest
+
+from click.testing import CliRunner
+
+from cloudbender import timings
+from cloudbender.cli import cli
+from tests.test_importtime import _make_project
+
+
+@pytest.fixture
+def recording(monkeypatch):
+    monkeypatch.setattr(timings, "enabled", False)
+    monkeypatch.setattr(timings, "_phases", {})
+    monkeypatch.setattr(timings, "_started", None)
+    timings.enable()
+
+
+def test_disabled_records_nothing(monkeypatch):
+    monkeypatch.setattr(timings, "enabled", False)
+    monkeypatch.setattr(timings, "_phases", {})
+
+    with timings.phase("render", "a"):
+        pass
+
+    assert timings.results()["phases"] == {}
+
+
+def test_slowest_items(recording, monkeypatch):
+    monkeypatch.setattr(timings, "SLOWEST", 2)
+    for item, wall in [("a", 1.0), ("b", 3.0), ("c", 2.0), ("a", 0.5)]:
+        timings._record("render", item, wall, 0.1)
+    timings._record("config", None, 1.0, 0.5)
+
+    data = timings.results()
+    assert list(data["phases"]) == ["config", "render"]
+    assert data["phases"]["render"]["count"] == 4
+    assert data["phases"]["render"]["wall"] == 6.5
+    assert data["phases"]["render"]["slowest"] == [["b", 3.0], ["c", 2.0]]
+    assert data["phases"]["config"]["slowest"] == []
+    assert "render" in timings.report()
+
+
+def test_phase_records_exceptions(recording):
+    with pytest.raises(ValueError):
+        with timings.phase("aws", "sts:get_caller_identity"):
+            raise ValueError()
+
+    assert timings.results()["phases"]["aws"]["count"] == 1
+
+
+def test_cli_writes_json(recording, tmp_path, monkeypatch):
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    _make_project(tmp_path)
+    out = tmp_path / "timings.json"
+
+    result = CliRunner().invoke(
+        cli, ["--dir", str(tmp_path), "--timings-json", str(out), "render", "prod/vpc.yaml"])
+    assert result.exit_code == 0, result.output
+
+    phases = json.loads(out.read_text())["phases"]
+    for name in ["discovery", "config", "libraries", "render", "postprocess"]:
+        assert name in phases
+    assert phases["render"]["slowest"][0][0] == "vpc"
+
+
+def test_cli_timings_flag(recording, tmp_path, monkeypatch):
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    _make_project(tmp_path)
+
+    result = CliRunner().invoke(
+        cli, ["--dir", str(tmp_path), "--timings", "render", "prod/vpc.yaml"])
+    assert result.exit_code == 0, result.output
+    assert "render" in result.stderr
@@ -2,7 +2,7 @@
 
 import logging
 
-from cloudbender.utils import setup_logging
+from cloudbender.utils import search_refs, setup_logging, template_metadata
 
 
 def test_setup_logging_debug():
@@ -12,3 +12,33 @@ def test_setup_logging_debug():
 
     # Silence logging for the rest of the tests
     logger.setLevel(logging.CRITICAL)
+
+
+def test_search_refs_deeply_nested():
+    template = {"Fn::GetAtt": ["FortyTwo", "last.Arn"]}
+    for i in range(5000):
+        template = {"Fn::If": ["c", template, {"Ref": "v{}DoTArn".format(i)}]}
+    template = {"Outputs": template, "Other": {"Fn::GetAtt": ["FortyTwo", "first.Arn"]}}
+
+    refs = []
+    search_refs(template, refs, "Piped")
+    # in document order
+    assert refs == ["last.Arn"] + ["v{}DoTArn".format(i) for i in range(5000)] + ["first.Arn"]
+
+
+def test_template_metadata():
+    template = {
+        "Metadata": {
+            "CloudBender": {"Dependencies": ["dns"]},
+            "Hooks": {"post_create": "notify", "pre_update": ["a", "b"], "unknown": "x"},
+        },
+        "Resources": {
+            "Ref": {"CloudBender::StackRef": {"StackTags": {"Artifact": "vpc"}}},
+            "Sub": [{"Fn::GetAtt": ["FortyTwo", "base.Arn"]}],
+        },
+    }
+    assert template_metadata(template, "CloudBender") == (
+        ["vpc", "base.Arn"],
+        ["dns"],
+        {"post_create": ["notify"], "pre_update": ["a", "b"]},
+    )
@@ -0,0 +1,113 @@
+import pytest
+
+from cloudbender import watch
+from cloudbender.core import CloudBender
+
+TEMPLATE = """AWSTemplateFormatVersion: '2010-09-09'
+Description: {{ metadata['Template.Name'] }}
+Resources:
+__RESOURCES__
+"""
+
+
+@pytest.fixture
+def project(tmp_path, monkeypatch):
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+
+    (tmp_path / "config" / "prod").mkdir(parents=True)
+    (tmp_path / "config" / "config.yaml").write_text(
+        "region: eu-central-1\nlibraries:\n  - url: local://libs/cfn\n")
+    for name in ["vpc", "app", "db"]:
+        if name != "db":
+            (tmp_path / "config" / "prod" / (name + ".yaml")).write_text("options: {}\n")
+
+    cfn = tmp_path / "libs" / "cfn" / "cloudformation"
+    cfn.mkdir(parents=True)
+    (cfn / "vpc.yaml.jinja").write_text(TEMPLATE.replace("__RESOURCES__", "{% include 'vpc.inc' %}"))
+    (cfn / "vpc.inc").write_text("  Vpc:\n    Type: AWS::EC2::VPC\n")
+    (cfn / "app.yaml.jinja").write_text(TEMPLATE.replace("__RESOURCES__", "  App:\n    Type: AWS::SNS::Topic"))
+    (cfn / "db.yaml.jinja").write_text(TEMPLATE.replace("__RESOURCES__", "  Db:\n    Type: AWS::SNS::Topic"))
+
+    return tmp_path
+
+
+def _watch(project, monkeypatch, *edits):
+    """Runs watch once per edit, returns the names of the stacks rendered after each"""
+    cb = CloudBender(project, None, None)
+    cb.read_config()
+    stacks = cb.sg.get_stacks()
+    for s in stacks:
+        s.render()
+
+    def _find():
+        cb.reload()
+        return cb.sg.get_stacks()
+
+    rendered = []
+
+    def _render(s):
+        s.render()
+        rendered[-1].add(s.stackname)
+
+    edits = list(edits)
+
+    def _sleep(seconds):
+        if not edits:
+            raise KeyboardInterrupt()
+        edits.pop(0)()
+        rendered.append(set())
+
+    monkeypatch.setattr(watch.time, "sleep", _sleep)
+    watch.watch(stacks, _find, _render)
+    return rendered
+
+
+def test_only_affected_stacks_are_rendered(project, monkeypatch):
+    cfn = project / "libs" / "cfn" / "cloudformation"
+    prod = project / "config" / "prod"
+
+    rendered = _watch(
+        project,
+        monkeypatch,
+        lambda: (cfn / "vpc.inc").write_text("  Vpc:\n    Type: AWS::EC2::VPC\n  Igw:\n    Type: AWS::EC2::InternetGateway\n"),
+        lambda: (prod / "app.yaml").write_text("options:\n  Changed: true\n"),
+        lambda: (prod / "db.yaml").write_text("options: {}\n"),
+        lambda: (project / "config" / "config.yaml").write_text(
+            "region: eu-west-1\nlibraries:\n  - url: local://libs/cfn\n"),
+        lambda: None,
+    )
+
+    assert rendered == [{"vpc"}, {"app"}, {"db"}, {"vpc", "app", "db"}, set()]
+
+
+def test_config_files(project):
+    cb = CloudBender(project, None, None)
+    cb.read_config()
+    (stack,) = cb.sg.get_stacks("vpc")
+
+    assert watch.config_files(stack) == [
+        str(project / "config" / "prod" / "vpc.yaml"),
+        str(project / "config" / "prod" / "config.yaml"),
+        str(project / "config" / "config.yaml"),
+    ]
+
+
+def test_config_includes_are_watched(project, monkeypatch):
+    shared = project / "config" / "shared.inc"
+    shared.write_text("Shared: 1\n")
+    (project / "config" / "prod" / "config.yaml").write_text(
+        "options:\n  {{% include '{}' %}}\n".format(shared))
+    (project / "config" / "prod" / "db.yaml").write_text("options: {}\n")
+    vpc = project / "config" / "prod" / "vpc.inc"
+    vpc.write_text("Cidr: 10.0.0.0/16\n")
+    (project / "config" / "prod" / "vpc.yaml").write_text(
+        "parameters:\n  {{% include '{}' %}}\n".format(vpc))
+
+    rendered = _watch(
+        project,
+        monkeypatch,
+        lambda: vpc.write_text("Cidr: 10.1.0.0/16\n"),
+        lambda: shared.write_text("Shared: 2\n"),
+    )
+
+    assert rendered == [{"vpc"}, {"vpc", "app", "db"}]